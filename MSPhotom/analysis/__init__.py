@@ -6,4 +6,6 @@ Created on Mon Jul  1 12:05:14 2024
 """
 
 import MSPhotom.analysis.imageprocess as imageprocess
+import MSPhotom.analysis.extractcache as extractcache
+import MSPhotom.analysis.regcache as regcache
 import MSPhotom.analysis.regression as regression
\ No newline at end of file
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of per-image ROI means, so re-processing a dataset
+only decodes images or masks that changed since the last run.
+"""
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+CACHE_DIRNAME = '.msphotom_cache'
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+class ExtractionCache:
+    """
+    Cache of ROI means keyed by image file identity and mask.
+
+    Each run is stored as two files in cache_dir. A memory-mapped .npy array
+    holds the means with one row per image and one column per mask. A small
+    JSON index holds the identity (name, size, mtime) of every row and the
+    hash of every column's mask. An image whose identity is unchanged is
+    served from the cache. Only masks without a cached column are
+    recomputed, so changing one fiber only recomputes that column.
+
+    Entries are evicted least recently used first once the cache grows
+    beyond max_bytes.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cache files, created if needed.
+    root : str, optional
+        Directory run paths are made relative to, so the cache survives the
+        dataset being moved. Defaults to the parent of cache_dir.
+    max_bytes : int, optional
+        Size limit of the cache directory.
+    """
+
+    def __init__(self, cache_dir, root=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.root = root if root is not None else os.path.dirname(
+            os.path.abspath(cache_dir))
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def for_dataset(cls, target_directory, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Cache stored next to the dataset, in target_directory.
+        """
+        return cls(os.path.join(target_directory, CACHE_DIRNAME),
+                   root=target_directory, max_bytes=max_bytes)
+
+    def process(self, run_path, valid_imgs, masks, extract, progress=None):
+        """
+        Get the raw traces of a run, extracting only what is not cached.
+
+        Parameters
+        ----------
+        run_path : str
+            Path of the run, used as the cache key.
+        valid_imgs : list of str
+            Paths of the images of the run, in order.
+        masks : list of numpy.ndarray
+            Boolean fiber masks.
+        extract : callable
+            extract(img_paths, masks) -> (traces_raw, image_mod_times), one
+            of the process_run functions.
+        progress : RunProgress, optional
+            Advanced for the images served entirely from the cache.
+
+        Returns
+        -------
+        traces_raw : list of numpy.ndarray
+            One raw trace per mask.
+        image_mod_times : numpy.ndarray
+            Modification time of each image.
+
+        """
+        stats = [_file_stat(img_nm) for img_nm in valid_imgs]
+        identities = [None if stat is None else
+                      (os.path.basename(img_nm), stat.st_size, stat.st_mtime_ns)
+                      for img_nm, stat in zip(valid_imgs, stats)]
+        image_mod_times = np.array([np.nan if stat is None else stat.st_mtime
+                                    for stat in stats])
+        columns = [mask_hash(mask) for mask in masks]
+        traces_raw = np.full((len(masks), len(valid_imgs)), np.nan)
+
+        index, values = self._load(run_path)
+        cached_rows = {}
+        cached_cols = {}
+        if index is not None:
+            cached_rows = {(name, size, mtime): row for row, (name, size, mtime)
+                           in enumerate(zip(index['names'], index['sizes'],
+                                            index['mtimes_ns']))}
+            cached_cols = {col: ind for ind, col in enumerate(index['columns'])}
+        rows = np.array([cached_rows.get(ident, -1) for ident in identities],
+                        dtype=np.int64)
+        hit = rows >= 0
+        missing_cols = [ind for ind, col in enumerate(columns)
+                        if col not in cached_cols]
+        for ind, col in enumerate(columns):
+            if col in cached_cols:
+                traces_raw[ind, hit] = values[rows[hit], cached_cols[col]]
+        del values
+
+        new_imgs = np.flatnonzero(~hit)
+        if len(missing_cols) == 0 and progress is not None:
+            progress.advance(int(hit.sum()))
+        if len(new_imgs) > 0:
+            new_traces, _ = extract([valid_imgs[i] for i in new_imgs], masks)
+            traces_raw[:, new_imgs] = np.array(new_traces)
+        hit_imgs = np.flatnonzero(hit)
+        if len(missing_cols) > 0 and len(hit_imgs) > 0:
+            col_traces, _ = extract([valid_imgs[i] for i in hit_imgs],
+                                    [masks[ind] for ind in missing_cols])
+            traces_raw[np.ix_(missing_cols, hit_imgs)] = np.array(col_traces)
+
+        if len(new_imgs) > 0 or len(missing_cols) > 0:
+            self._store(run_path, identities, columns, traces_raw)
+            self.evict(keep=self._run_key(run_path))
+        return list(traces_raw), image_mod_times
+
+    def evict(self, keep=None):
+        """
+        Delete least recently used entries until the cache fits in max_bytes.
+        """
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.json'):
+                    continue
+                key = name[:-len('.json')]
+                paths = self._paths(key)
+                try:
+                    size = sum(os.path.getsize(path) for path in paths)
+                    last_used = os.path.getmtime(paths[1])
+                except OSError:
+                    continue
+                total += size
+                entries.append((last_used, key, size))
+            for last_used, key, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                for path in self._paths(key):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+
+    def clear(self):
+        """
+        Delete every entry of the cache.
+        """
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.npy') or name.endswith('.json'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def _run_key(self, run_path):
+        try:
+            rel_path = os.path.relpath(run_path, self.root)
+        except ValueError:
+            rel_path = run_path
+        rel_path = rel_path.replace('\\', '/')
+        return hashlib.sha1(rel_path.encode('utf-8')).hexdigest()[:20]
+
+    def _paths(self, key):
+        return (os.path.join(self.cache_dir, f'{key}.npy'),
+                os.path.join(self.cache_dir, f'{key}.json'))
+
+    def _load(self, run_path):
+        values_path, index_path = self._paths(self._run_key(run_path))
+        try:
+            with open(index_path, 'r', encoding='utf-8') as file:
+                index = json.load(file)
+            values = np.load(values_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None, None
+        if values.shape != (len(index['names']), len(index['columns'])):
+            return None, None
+        # Mark the entry as recently used for eviction
+        os.utime(index_path)
+        return index, values
+
+    def _store(self, run_path, identities, columns, traces_raw):
+        # Rows that failed to load are not cached, so they are retried
+        stored = [ind for ind, ident in enumerate(identities)
+                  if ident is not None and not np.isnan(traces_raw[:, ind]).all()]
+        index = {'run_path': run_path,
+                 'names': [identities[i][0] for i in stored],
+                 'sizes': [identities[i][1] for i in stored],
+                 'mtimes_ns': [identities[i][2] for i in stored],
+                 'columns': columns}
+        values_path, index_path = self._paths(self._run_key(run_path))
+        # The index is written last, so a partial write is never read back
+        # as a valid entry
+        _atomic_save_npy(values_path, np.ascontiguousarray(traces_raw[:, stored].T))
+        tmp_path = f'{index_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(index, file)
+        os.replace(tmp_path, index_path)
+
+
+def mask_hash(mask):
+    """
+    Content hash of a boolean mask, including its shape.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    digest = hashlib.sha1(str(mask.shape).encode('utf-8'))
+    digest.update(np.packbits(mask).tobytes())
+    return digest.hexdigest()
+
+
+def _file_stat(img_nm):
+    try:
+        return os.stat(img_nm)
+    except OSError:
+        return None
+
+
+def _atomic_save_npy(path, array):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.save(file, array)
+    os.replace(tmp_path, path)
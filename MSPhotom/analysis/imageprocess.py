@@ -2,51 +2,123 @@
 """
 Load images and extract and organize trace data
 """
-from typing import List
+from typing import List, Tuple
+from functools import lru_cache
 import os
 import re
+import struct
 import numpy as np
 from PIL import Image
 import time
-import asyncio
-import nest_asyncio
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from MSPhotom.data import precision_dtype
+try:
+    from scipy import sparse
+except ImportError:  # Optional, batched extraction falls back to dense weights
+    sparse = None
+
+EXTRACTION_MODES = ('sync', 'threaded', 'process')
+DEFAULT_PARALLEL_RUNS = 4
 
-nest_asyncio.apply()
 
 def process_main(data,
                  controller=None,
-                 threaded = False):
+                 threaded = False,
+                 mode = None,
+                 max_workers = None,
+                 max_parallel_runs = None,
+                 cache = None,
+                 incremental = False,
+                 batch_size = None,
+                 precision = None):
+    """
+    Extract raw traces from every run in data.run_path_list and organize
+    them by run, signal and trial.
+
+    Parameters
+    ----------
+    data : MSPData
+        Photometry data object, updated in place.
+    controller : MSPApp, optional
+        Controller used to update progress in the view.
+    threaded : bool, optional
+        Legacy switch selecting the 'threaded' mode when mode is not given.
+    mode : str, optional
+        One of EXTRACTION_MODES. 'sync' processes images one at a time,
+        'threaded' streams images through loader and extractor threads and
+        'process' spreads chunks of images over a process pool.
+    max_workers : int, optional
+        Global worker budget shared by all runs processed at once. Defaults
+        to the CPU count.
+    max_parallel_runs : int, optional
+        Maximum number of runs processed at once, see process_runs.
+    cache : ExtractionCache, optional
+        On-disk cache of ROI means, images already extracted with the same
+        masks are not decoded again.
+    incremental : bool, optional
+        Only process runs that are new or whose images or masks changed
+        since they were last processed into data, see run_has_changed. The
+        results are merged into the existing run dictionaries of data in
+        place, previously processed runs are kept untouched.
+    batch_size : int, optional
+        Number of frames reduced at once with a single matrix product, see
+        process_runs. Frames are reduced one by one if not given.
+    precision : str, optional
+        One of PRECISIONS, the dtype the raw and split traces are stored
+        as. Defaults to data.precision. ROI means are always accumulated in
+        float64.
+
+    """
+    if mode is None:
+        mode = 'threaded' if threaded else 'sync'
+    if mode not in EXTRACTION_MODES:
+        raise ValueError(f'Unknown extraction mode {mode}, expected one of {EXTRACTION_MODES}')
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if precision is None:
+        precision = data.precision
+    dtype = precision_dtype(precision)
+    if controller is not None:
+        controller.view.image_tab.longprog['value'] = 0
+        controller.view.image_tab.longprogstat.set('Listing run images')
+    # Directory listings are I/O bound, list every run at once
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        valid_imgs_by_run = list(executor.map(
+            lambda run_path: get_valid_images(run_path, data.img_prefix),
+            data.run_path_list))
+    runs = [(run_path, valid_imgs) for run_path, valid_imgs
+            in zip(data.run_path_list, valid_imgs_by_run)
+            if len(valid_imgs) > 0]
+
     # STEP 1: Generate all the mask arrays for each region from the dataset info.
     # Each mask is a boolean numpy array with the selected region as "True" and all else as "False"
-    fiber_coords_xyr = [(sum(coord[0:3:2])/2, # X coordinate
-                            sum(coord[1:4:2])/2, # Y coordinate
-                            (coord[2] - coord[0])/2) # Radius of circle
-                           for coord in data.fiber_coords]
-    fiber_masks = [npy_circlemask(424,424,*coords) 
-                   for coords in fiber_coords_xyr]
-    
+    # The frame size is taken from the first image found
+    if len(runs) > 0:
+        fiber_masks = fiber_masks_from_coords(data.fiber_coords,
+                                              get_frame_shape(runs[0][1][0]))
+    else:
+        fiber_masks = []
+    if incremental:
+        runs = [(run_path, valid_imgs) for run_path, valid_imgs in runs
+                if run_has_changed(data, run_path, valid_imgs, fiber_masks)]
+        print(f'Incremental processing of {len(runs)} new or changed runs')
+
+    progress = ProgressTracker(controller, num_runs=len(runs))
+    results = process_runs(runs, fiber_masks, mode,
+                           max_workers=max_workers,
+                           max_parallel_runs=max_parallel_runs,
+                           progress=progress,
+                           cache=cache,
+                           batch_size=batch_size,
+                           dtype=dtype)
+
     traces_raw_by_run_reg = {}
     traces_by_run_signal_trial = {}
     image_mod_times_by_run = {}
-    run_path_list_len = len(data.run_path_list)
-    # Pull from images
-    for ind, run_path in enumerate(data.run_path_list):
-        # Update view if needed
-        if controller is not None:
-            controller.view.image_tab.longprog['value'] = (ind/run_path_list_len)*100
-            controller.view.image_tab.longprogstat.set(
-                f'Processing run {run_path.split("/")[-2]}/{run_path.split("/")[-1]}')
-    
-        valid_imgs = get_valid_images(run_path, data.img_prefix)
-        if len(valid_imgs) == 0:
-            continue
-        if not threaded:
-            print(f'Performing synchronous processing of {run_path}')
-            traces_raw, image_mod_times = process_run(valid_imgs, fiber_masks, controller)
-        else:
-            print(f'Attempting asynchronous processing of {run_path}')
-            traces_raw, image_mod_times = process_run_async_wrapper(valid_imgs, fiber_masks, controller)
+    # Results are stored in run order, regardless of completion order
+    for (run_path, _), (traces_raw, image_mod_times) in zip(runs, results):
         traces_raw_by_run_reg[run_path] = traces_raw
         image_mod_times_by_run[run_path] = image_mod_times
         # STEP 1: REMOVE BACKGROUND
@@ -70,14 +142,19 @@ def process_main(data,
         traces_by_run_signal_trial[run_path] = {label : trace for label, trace 
                                            in zip(trace_labels, traces)}
 
-    data.fiber_masks = {label : mask for label, mask 
-                        in zip(data.fiber_labels, fiber_masks)}
-    data.traces_raw_by_run_reg = traces_raw_by_run_reg
-    data.traces_by_run_signal_trial = traces_by_run_signal_trial
-    data.source_image_modification_times_by_run = image_mod_times_by_run
-    runs_names = "\n    ".join([f'{run_path.split("/")[-2]}/{run_path.split("/")[-1]}' 
-                            for run_path in data.run_path_list])
-    data.log('imageprocess finished processing: \n    {runs_names}')
+    if not incremental or len(fiber_masks) > 0:
+        data.fiber_masks = {label : mask for label, mask 
+                            in zip(data.fiber_labels, fiber_masks)}
+    if incremental and data.traces_raw_by_run_reg is not None:
+        merge_runs(data, traces_raw_by_run_reg, traces_by_run_signal_trial,
+                   image_mod_times_by_run)
+    else:
+        data.traces_raw_by_run_reg = traces_raw_by_run_reg
+        data.traces_by_run_signal_trial = traces_by_run_signal_trial
+        data.source_image_modification_times_by_run = image_mod_times_by_run
+    runs_names = "\n    ".join([run_display_name(run_path)
+                            for run_path, _ in runs])
+    data.log(f'imageprocess finished processing: \n    {runs_names}')
     print('imageprocess completed')
 
     if controller is not None:
@@ -89,89 +166,816 @@ def process_main(data,
         controller.autosave_data()
 
 
-def process_run(valid_imgs, masks, controller = None, update_interval = 3):
-    start_time = time.time()
-    traces_raw = [np.full(len(valid_imgs), np.nan) for _ in masks]
+def run_has_changed(data, run_path, valid_imgs, masks=None):
+    """
+    Check whether a run needs to be (re)processed into data.
+
+    A run has changed if it was never processed, if the number or
+    modification times of its images differ from the recorded ones, or if
+    the fiber masks differ from the masks stored in data.
+
+    Parameters
+    ----------
+    data : MSPData
+        Photometry data object holding previously processed runs.
+    run_path : str
+        Path of the run.
+    valid_imgs : list of str
+        Current images of the run.
+    masks : list of numpy.ndarray, optional
+        Fiber masks the run would be processed with.
+
+    Returns
+    -------
+    bool
+
+    """
+    if data.traces_raw_by_run_reg is None or run_path not in data.traces_raw_by_run_reg:
+        return True
+    if masks is not None:
+        stored_masks = list((data.fiber_masks or {}).values())
+        if len(stored_masks) != len(masks) or not all(
+                np.array_equal(a, b) for a, b in zip(stored_masks, masks)):
+            return True
+    stored_times = (data.source_image_modification_times_by_run or {}).get(run_path)
+    if stored_times is None or len(stored_times) != len(valid_imgs):
+        return True
     image_mod_times = np.full(len(valid_imgs), np.nan)
-    max_img = len(valid_imgs)
+    for ind, img_nm in enumerate(valid_imgs):
+        try:
+            image_mod_times[ind] = os.path.getmtime(img_nm)
+        except OSError:
+            pass
+    return not np.array_equal(image_mod_times, stored_times, equal_nan=True)
+
+
+def find_changed_runs(data):
+    """
+    List the runs of data.run_path_list that are new or changed, see
+    run_has_changed.
+    """
+    changed = []
+    masks = None
+    for run_path in data.run_path_list:
+        valid_imgs = get_valid_images(run_path, data.img_prefix)
+        if len(valid_imgs) == 0:
+            continue
+        if masks is None and data.fiber_coords is not None:
+            masks = fiber_masks_from_coords(data.fiber_coords,
+                                            get_frame_shape(valid_imgs[0]))
+        if run_has_changed(data, run_path, valid_imgs, masks):
+            changed.append(run_path)
+    return changed
+
+
+def merge_runs(data, traces_raw_by_run_reg, traces_by_run_signal_trial,
+               image_mod_times_by_run):
+    """
+    Merge newly processed runs into data in place. Nothing is copied, run
+    entries are added to or replaced in the existing dictionaries, and
+    regression results of replaced runs are dropped as they are stale.
+    """
+    data.traces_raw_by_run_reg.update(traces_raw_by_run_reg)
+    if data.traces_by_run_signal_trial is None:
+        data.traces_by_run_signal_trial = {}
+    data.traces_by_run_signal_trial.update(traces_by_run_signal_trial)
+    if data.source_image_modification_times_by_run is None:
+        data.source_image_modification_times_by_run = {}
+    data.source_image_modification_times_by_run.update(image_mod_times_by_run)
+    for results in (data.regressed_traces_by_run_signal_trial,
+                    data.corrsig_reg_results):
+        if results is None:
+            continue
+        for run_path in traces_raw_by_run_reg:
+            results.pop(run_path, None)
+    data.run_path_list = list(dict.fromkeys([*data.traces_raw_by_run_reg,
+                                             *data.run_path_list]))
+
+
+def process_runs(runs, masks, mode='sync', max_workers=None,
+                 max_parallel_runs=None, progress=None, cache=None,
+                 batch_size=None, dtype=np.float64):
+    """
+    Process several runs at once under a global worker budget.
+
+    In 'sync' mode runs are processed one after the other. In 'threaded'
+    mode up to max_parallel_runs runs are processed at once and the budget
+    is split between them. In 'process' mode the runs share a single
+    process pool of max_workers workers, so the tail of one run overlaps
+    with the start of the next.
+
+    Parameters
+    ----------
+    runs : list of tuple
+        (run_path, valid_imgs) pairs.
+    masks : list of numpy.ndarray
+        Boolean fiber masks.
+    mode : str, optional
+        One of EXTRACTION_MODES.
+    max_workers : int, optional
+        Global worker budget, defaults to the CPU count.
+    max_parallel_runs : int, optional
+        Maximum number of runs processed at once, defaults to
+        DEFAULT_PARALLEL_RUNS.
+    progress : ProgressTracker, optional
+        Aggregates progress of all runs.
+    cache : ExtractionCache, optional
+        On-disk cache of ROI means consulted before extracting each run.
+    batch_size : int, optional
+        Number of frames reduced at once in 'sync' and 'process' mode, see
+        RoiExtractor.extract_batch. The threaded pipeline streams single
+        frames and ignores it.
+    dtype : numpy.dtype, optional
+        Floating point type of the returned traces.
+
+    Returns
+    -------
+    list of tuple
+        (traces_raw, image_mod_times) for each run, in the order of runs.
+
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_parallel_runs is None:
+        max_parallel_runs = DEFAULT_PARALLEL_RUNS
+    if progress is None:
+        progress = ProgressTracker(num_runs=len(runs))
+    if mode == 'sync':
+        max_parallel_runs = 1
+    max_parallel_runs = max(1, min(max_parallel_runs, len(runs), max_workers))
+    run_workers = max(1, max_workers // max_parallel_runs)
+    executor = extraction_pool(masks, max_workers) if mode == 'process' else None
+
+    def run_one(run):
+        run_path, valid_imgs = run
+        run_progress = progress.start_run(run_path, len(valid_imgs))
+
+        def extract(img_paths, run_masks):
+            if mode == 'sync':
+                print(f'Performing synchronous processing of {run_path}')
+                return process_run(img_paths, run_masks, progress=run_progress,
+                                   batch_size=batch_size, dtype=dtype)
+            elif mode == 'threaded':
+                print(f'Performing threaded processing of {run_path}')
+                return process_run_threaded(img_paths, run_masks,
+                                            progress=run_progress,
+                                            max_workers=run_workers,
+                                            dtype=dtype)
+            print(f'Performing multiprocess processing of {run_path}')
+            # The shared pool only holds the full mask set
+            return process_run_multiprocess(
+                img_paths, run_masks, progress=run_progress,
+                executor=executor if run_masks is masks else None,
+                batch_size=batch_size, dtype=dtype)
+
+        if cache is None:
+            result = extract(valid_imgs, masks)
+        else:
+            traces_raw, image_mod_times = cache.process(
+                run_path, valid_imgs, masks, extract, progress=run_progress)
+            result = ([trace.astype(dtype, copy=False) for trace in traces_raw],
+                      image_mod_times)
+        run_progress.finish()
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel_runs) as run_executor:
+            return list(run_executor.map(run_one, runs))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def process_run(valid_imgs, masks, controller = None, progress = None,
+                batch_size = None, dtype = np.float64):
+    extractor = RoiExtractor(masks)
+    reader = TiffFrameReader(valid_imgs[0]) if len(valid_imgs) > 0 else None
+    traces_raw = np.full((len(masks), len(valid_imgs)), np.nan, dtype=dtype)
+    image_mod_times = np.full(len(valid_imgs), np.nan)
+    progress, owned = RunProgress.ensure(progress, controller, valid_imgs)
+    if batch_size is not None and batch_size > 1:
+        extract_batched(valid_imgs, extractor, reader, traces_raw.T,
+                        image_mod_times, batch_size, progress=progress)
+        if owned:
+            progress.finish()
+        return list(traces_raw), image_mod_times
+    # Every frame is decoded into the same buffer
+    frame_buffer = reader.new_buffer() if reader is not None else None
     # Iterate through all images
     for ind, img_nm in enumerate(valid_imgs):
         try:
             image_mod_times[ind] = os.path.getmtime(img_nm)
-            img_PIL = Image.open(img_nm)
-            img_np = np.array(img_PIL)
+            img_np = reader.read(img_nm, out=frame_buffer)
         except:
             print(f'Failed to load {img_nm}, trace value was skipped')
+            progress.advance(1, img_nm)
             continue
-        for trace, mask in zip(traces_raw, masks):
-            trace[ind] = img_np[mask].mean()
-        if controller is not None and ind % update_interval == 0:
-            controller.view.image_tab.runprog['value'] = (ind/max_img)*100
-            controller.view.image_tab.shortprogstat.set(f'{img_nm.split("/")[-1]}')
-            if (time.time()-start_time) == 0:
+        extractor.extract(img_np, out=traces_raw[:, ind])
+        progress.advance(1, img_nm)
+    if owned:
+        progress.finish()
+    return list(traces_raw), image_mod_times
+
+
+def extract_batched(img_paths, extractor, reader, means, mod_times,
+                    batch_size, progress=None):
+    """
+    Extract ROI means from images in blocks of batch_size frames, each
+    block being reduced with RoiExtractor.extract_batch.
+
+    Frames are decoded into a reused (batch_size, height, width) buffer.
+    Images that fail to load are left as NaN.
+
+    Parameters
+    ----------
+    img_paths : list of str
+        Paths of consecutive images.
+    extractor : RoiExtractor
+        Extractor for the fiber masks.
+    reader : TiffFrameReader
+        Reader for the images.
+    means : numpy.ndarray
+        Float64 array of shape (len(img_paths), n_roi) receiving the means,
+        typically the transposed trace array.
+    mod_times : numpy.ndarray
+        Array receiving the modification time of each image.
+    batch_size : int
+        Number of frames reduced at once.
+    progress : RunProgress, optional
+        Advanced after each block.
+
+    """
+    frame_buffer = reader.new_buffer() if reader is not None else None
+    dtype = np.float64 if frame_buffer is None else frame_buffer.dtype
+    batch = np.empty((batch_size,) + extractor.frame_shape, dtype=dtype)
+    for start in range(0, len(img_paths), batch_size):
+        block_paths = img_paths[start:start + batch_size]
+        loaded = np.zeros(len(block_paths), dtype=bool)
+        unbatched = []
+        for ind, img_nm in enumerate(block_paths):
+            slot = batch[ind]
+            try:
+                mod_times[start + ind] = os.path.getmtime(img_nm)
+                img_np = reader.read(img_nm, out=slot)
+            except Exception:
+                print(f'Failed to load {img_nm}, trace value was skipped')
                 continue
-            controller.view.image_tab.speedout.set(f'{round(ind/(time.time()-start_time),1)} images/second')
-    if controller is not None:
-        controller.view.image_tab.runprog['value'] = 100
-        controller.view.image_tab.shortprogstat.set('Processing Complete')
-        elapsed = time.time() - start_time
-        if elapsed > 0:
-            speed = max_img / (time.time() - start_time)
-            speed = round(speed, 1)
-        else:
-            speed = 'NaN'
-        controller.view.image_tab.speedout.set(f'{speed} images/second')
-    return traces_raw, image_mod_times
+            if img_np is slot:
+                loaded[ind] = True
+            else:
+                # Frame did not fit the batch buffer, it is reduced on its own
+                unbatched.append((ind, img_np))
+        rows = means[start:start + len(block_paths)]
+        extractor.extract_batch(batch[:len(block_paths)], out=rows)
+        rows[~loaded] = np.nan
+        for ind, img_np in unbatched:
+            extractor.extract(img_np, out=rows[ind])
+        if progress is not None:
+            progress.advance(len(block_paths), block_paths[-1])
 
 
-async def process_run_async(valid_imgs, masks, controller=None, update_interval = 111):
-    start_time = time.time()
-    traces_raw = [np.full(len(valid_imgs), np.nan) for _ in masks]
-    max_img = len(valid_imgs)
+def process_run_threaded(valid_imgs, masks, controller=None, progress=None,
+                         max_workers=None, num_extractors=None, prefetch=None,
+                         dtype=np.float64):
+    """
+    Process a run with a streaming pipeline of threads.
+
+    Loader threads decode images into frame buffers taken from a fixed pool
+    and push them onto a bounded prefetch queue, which a fixed pool of
+    extractor threads drains. Each extractor has its own RoiExtractor
+    scratch space, writes its ROI means at the image index of preallocated
+    trace arrays and hands the buffer back to the pool. The output order
+    does not depend on completion order, and as frames are only decoded into
+    pooled buffers, memory use does not grow with the length of the run.
+
+    Parameters
+    ----------
+    valid_imgs : list of str
+        Paths of the images of the run, in order.
+    masks : list of numpy.ndarray
+        Boolean fiber masks.
+    controller : MSPApp, optional
+        Controller used to update progress in the view.
+    progress : RunProgress, optional
+        Progress handle of the run, takes precedence over controller.
+    max_workers : int, optional
+        Number of loader threads, defaults to the CPU count.
+    num_extractors : int, optional
+        Number of extractor threads, defaults to a quarter of max_workers.
+    prefetch : int, optional
+        Capacity of the decoded frame queue, defaults to 4 * max_workers.
+    dtype : numpy.dtype, optional
+        Floating point type of the returned traces.
+
+    Returns
+    -------
+    traces_raw : list of numpy.ndarray
+        One raw trace per mask.
+    image_mod_times : numpy.ndarray
+        Modification time of each image.
+
+    """
+    extractor = RoiExtractor(masks)
+    reader = TiffFrameReader(valid_imgs[0]) if len(valid_imgs) > 0 else None
+    traces_raw = np.full((len(masks), len(valid_imgs)), np.nan, dtype=dtype)
     image_mod_times = np.full(len(valid_imgs), np.nan)
+    progress, owned = RunProgress.ensure(progress, controller, valid_imgs)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if num_extractors is None:
+        num_extractors = max(1, max_workers // 4)
+    if prefetch is None:
+        prefetch = 4 * max_workers
+    frames = queue.Queue(maxsize=prefetch)
+    # Enough buffers for a full queue plus one being read by every extractor
+    free_buffers = queue.Queue()
+    for _ in range(prefetch + num_extractors):
+        free_buffers.put(reader.new_buffer() if reader is not None else None)
+    img_iter = enumerate(valid_imgs)
+    img_iter_lock = threading.Lock()
+
+    def load_images():
+        while True:
+            with img_iter_lock:
+                ind, img_nm = next(img_iter, (None, None))
+            if ind is None:
+                return
+            buffer = free_buffers.get()
+            try:
+                image_mod_times[ind] = os.path.getmtime(img_nm)
+                frames.put((ind, img_nm, reader.read(img_nm, out=buffer), buffer))
+            except Exception as e:
+                print(f'Failed to load {img_nm}, trace value was skipped. Error: {e}')
+                free_buffers.put(buffer)
+                progress.advance(1, img_nm)
+
+    def extract_images():
+        worker_extractor = extractor.clone()
+        while True:
+            item = frames.get()
+            if item is None:
+                return
+            ind, img_nm, img_np, buffer = item
+            try:
+                worker_extractor.extract(img_np, out=traces_raw[:, ind])
+            except Exception as e:
+                print(f'Failed to extract {img_nm}, trace value was skipped. Error: {e}')
+            free_buffers.put(buffer)
+            progress.advance(1, img_nm)
+
+    loaders = [threading.Thread(target=load_images, daemon=True)
+               for _ in range(max_workers)]
+    extractors = [threading.Thread(target=extract_images, daemon=True)
+                  for _ in range(num_extractors)]
+    for thread in loaders + extractors:
+        thread.start()
+    for thread in loaders:
+        thread.join()
+    # One sentinel per extractor once every frame has been queued
+    for _ in extractors:
+        frames.put(None)
+    for thread in extractors:
+        thread.join()
+
+    if owned:
+        progress.finish()
+    return list(traces_raw), image_mod_times
 
-    def load_extract_image(img_nm, ind):
+
+def process_run_multiprocess(valid_imgs, masks, controller=None, progress=None,
+                             max_workers=None, chunksize=None, executor=None,
+                             batch_size=None, dtype=np.float64):
+    """
+    Process a run with a pool of worker processes, sidestepping the GIL held
+    during TIFF decoding and ROI reduction.
+
+    Each worker builds a RoiExtractor from the masks once, when the pool
+    starts, and then receives chunks of image paths. Workers return compact
+    (image, roi) float arrays which are written into the run traces as the
+    chunks complete.
+
+    Parameters
+    ----------
+    valid_imgs : list of str
+        Paths of the images of the run, in order.
+    masks : list of numpy.ndarray
+        Boolean fiber masks.
+    controller : MSPApp, optional
+        Controller used to update progress in the view.
+    progress : RunProgress, optional
+        Progress handle of the run, takes precedence over controller.
+    max_workers : int, optional
+        Number of worker processes, defaults to the CPU count.
+    chunksize : int, optional
+        Number of images sent to a worker per task. By default chosen so
+        that each worker gets several chunks.
+    executor : ProcessPoolExecutor, optional
+        Pool created by extraction_pool with the same masks, shared between
+        runs. A pool is created for this run if not given.
+    batch_size : int, optional
+        Number of frames each worker reduces at once with
+        RoiExtractor.extract_batch, frames are reduced one by one if not
+        given.
+    dtype : numpy.dtype, optional
+        Floating point type of the returned traces.
+
+    Returns
+    -------
+    traces_raw : list of numpy.ndarray
+        One raw trace per mask.
+    image_mod_times : numpy.ndarray
+        Modification time of each image.
+
+    """
+    max_img = len(valid_imgs)
+    traces_raw = np.full((len(masks), max_img), np.nan, dtype=dtype)
+    image_mod_times = np.full(max_img, np.nan)
+    progress, owned = RunProgress.ensure(progress, controller, valid_imgs)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, min(256, max_img // (max_workers * 4)))
+    chunks = [(start, valid_imgs[start:start + chunksize])
+              for start in range(0, max_img, chunksize)]
+    # The header is parsed once here and shipped to the workers with each chunk
+    reader = TiffFrameReader(valid_imgs[0]) if max_img > 0 else None
+    owned_executor = executor is None
+    if owned_executor:
+        executor = extraction_pool(masks, max_workers)
+    try:
+        futures = [executor.submit(_extract_chunk, start, img_paths, reader,
+                                   batch_size)
+                   for start, img_paths in chunks]
+        for future in as_completed(futures):
+            start, means, mod_times = future.result()
+            stop = start + len(mod_times)
+            traces_raw[:, start:stop] = means.T
+            image_mod_times[start:stop] = mod_times
+            progress.advance(len(mod_times), valid_imgs[stop - 1])
+    finally:
+        if owned_executor:
+            executor.shutdown()
+    if owned:
+        progress.finish()
+    return list(traces_raw), image_mod_times
+
+
+def extraction_pool(masks, max_workers=None):
+    """
+    Create a process pool whose workers keep a RoiExtractor for the masks
+    resident, for use with process_run_multiprocess.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers,
+                               initializer=_init_extraction_worker,
+                               initargs=(masks,))
+
+
+_worker_extractor = None
+
+
+def _init_extraction_worker(masks):
+    """
+    Process pool initializer, keeps the compiled masks resident in the worker.
+    """
+    global _worker_extractor
+    _worker_extractor = RoiExtractor(masks)
+
+
+def _extract_chunk(start, img_paths, reader, batch_size=None):
+    """
+    Process pool task, extract ROI means from a chunk of consecutive images.
+    """
+    means = np.full((len(img_paths), _worker_extractor.n_roi), np.nan)
+    mod_times = np.full(len(img_paths), np.nan)
+    if batch_size is not None and batch_size > 1:
+        extract_batched(img_paths, _worker_extractor, reader, means, mod_times,
+                        batch_size)
+        return start, means, mod_times
+    frame_buffer = reader.new_buffer()
+    for ind, img_nm in enumerate(img_paths):
         try:
-            image_mod_times[ind] = os.path.getmtime(img_nm)
-            with Image.open(img_nm) as img_PIL:
-                img_np = np.array(img_PIL)
-            for trace, mask in zip(traces_raw, masks):
-                trace[ind] = img_np[mask].mean()
+            mod_times[ind] = os.path.getmtime(img_nm)
+            _worker_extractor.extract(reader.read(img_nm, out=frame_buffer),
+                                      out=means[ind])
         except Exception as e:
             print(f'Failed to load {img_nm}, trace value was skipped. Error: {e}')
-        if controller is not None and ind % update_interval == 0:
-            controller.view.image_tab.runprog['value'] = (ind / max_img) * 100
-            controller.view.image_tab.shortprogstat.set(f'{img_nm.split("/")[-1]}')
-            speed = ind / (time.time() - start_time)
-            controller.view.image_tab.speedout.set(f'{round(speed, 1)} images/second')
-
-    loop = asyncio.get_running_loop()
-    with ThreadPoolExecutor() as executor:
-        tasks = [
-            loop.run_in_executor(executor, load_extract_image, img_nm, ind)
-            for ind, img_nm in enumerate(valid_imgs)
-        ]
-        await asyncio.gather(*tasks)
-    
-    if controller is not None:
-        controller.view.image_tab.runprog['value'] = 100
-        controller.view.image_tab.shortprogstat.set('Processing Complete')
-        speed = max_img / (time.time() - start_time)
-        controller.view.image_tab.speedout.set(f'{round(speed, 1)} images/second')
-    return traces_raw, image_mod_times
+    return start, means, mod_times
 
 
-def process_run_async_wrapper(valid_imgs, masks, controller=None):
-    try:
-        # Runs async function in a temporary event loop and closes it after completion
-        return asyncio.run(process_run_async(valid_imgs, masks, controller))
-    except RuntimeError as e:
-        print("Error in running async wrapper:", e)
-        print("Defaulting to synchronous processing...")
-        print(""""If you notice this, you are probobly running MSPhotom app inside Spyder or Jupityr notebooks.
-              This is NOT RECOMMENDED. Please close the program and run the app via command line or pyinstaller executable""")
-        # Optionally: Fallback to process_run if async processing fails
-        return process_run(valid_imgs, masks, controller, 111)
+class ProgressTracker:
+    """
+    Thread-safe aggregation of image processing progress over all runs that
+    are being processed at once.
+
+    The longprog bar shows the fraction of runs completed, counting partial
+    progress of active runs, and the runprog bar shows the fraction of images
+    completed across the active runs. The view is only touched when a
+    controller is given, at most every min_interval seconds.
+    """
+
+    def __init__(self, controller=None, num_runs=1, min_interval=0.1):
+        self.controller = controller
+        self.num_runs = max(num_runs, 1)
+        self.min_interval = min_interval
+        self.runs_done = 0
+        self.images_done = 0
+        self._active = {}
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._last_update = 0
+
+    def start_run(self, run_path, num_images):
+        """
+        Register a run and return its RunProgress handle.
+        """
+        with self._lock:
+            self._active[run_path] = [0, num_images]
+        self._update(force=True)
+        return RunProgress(self, run_path)
+
+    def advance(self, run_path, num=1, img_nm=None):
+        with self._lock:
+            self._active[run_path][0] += num
+            self.images_done += num
+        self._update(img_nm=img_nm)
+
+    def finish_run(self, run_path):
+        with self._lock:
+            self._active.pop(run_path, None)
+            self.runs_done += 1
+        self._update(force=True)
+
+    def _update(self, img_nm=None, force=False):
+        if self.controller is None:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_update < self.min_interval:
+                return
+            self._last_update = now
+            active = dict(self._active)
+            runs_done = self.runs_done
+            images_done = self.images_done
+        active_done = sum(done for done, _ in active.values())
+        active_total = sum(total for _, total in active.values())
+        run_fraction = sum(done / total for done, total in active.values()
+                           if total > 0)
+        image_tab = self.controller.view.image_tab
+        image_tab.longprog['value'] = ((runs_done + run_fraction) / self.num_runs) * 100
+        if len(active) == 0:
+            image_tab.runprog['value'] = 100
+            image_tab.shortprogstat.set('Processing Complete')
+        else:
+            image_tab.runprog['value'] = (active_done / max(active_total, 1)) * 100
+            if len(active) == 1:
+                image_tab.longprogstat.set(
+                    f'Processing run {run_display_name(next(iter(active)))}')
+            else:
+                image_tab.longprogstat.set(
+                    f'Processing {len(active)} runs ({runs_done}/{self.num_runs} done)')
+        if img_nm is not None:
+            image_tab.shortprogstat.set(f'{img_nm.split("/")[-1]}')
+        elapsed = now - self._start_time
+        if elapsed > 0:
+            image_tab.speedout.set(f'{round(images_done / elapsed, 1)} images/second')
+
+
+class RunProgress:
+    """
+    Progress handle of a single run, reporting to a ProgressTracker.
+    """
+
+    def __init__(self, tracker, run_path):
+        self.tracker = tracker
+        self.run_path = run_path
+
+    def advance(self, num=1, img_nm=None):
+        self.tracker.advance(self.run_path, num, img_nm)
+
+    def finish(self):
+        self.tracker.finish_run(self.run_path)
+
+    @classmethod
+    def ensure(cls, progress, controller, valid_imgs):
+        """
+        Return (progress, owned). A handle on a new single run tracker is
+        created when progress is None, in which case the caller owns it and
+        must finish it.
+        """
+        if progress is not None:
+            return progress, False
+        return ProgressTracker(controller).start_run(None, len(valid_imgs)), True
+
+
+def run_display_name(run_path):
+    """
+    Short 'date/run' name of a run path, used for display and logs.
+    """
+    if run_path is None:
+        return ''
+    return '/'.join(run_path.split('/')[-2:])
+
+
+class RoiExtractor:
+    """
+    Precompiled extractor for the mean pixel value of several regions of
+    interest (ROIs) in a frame.
+
+    Each boolean mask is compiled once into the flat indices of its pixels.
+    The indices of all ROIs are concatenated, grouped by ROI, so a frame is
+    reduced by gathering only the ROI pixels and summing each ROI's segment
+    with a single ``np.add.reduceat``, rather than scanning the full frame
+    once per mask. Overlapping masks are supported as a pixel may appear in
+    several ROIs.
+
+    Blocks of frames can instead be reduced with extract_batch, which
+    gathers the pixels covered by any ROI from every frame of the block and
+    computes all means with one matrix product against a (pixel, roi)
+    weight matrix holding 1 / roi size.
+
+    The gather and reduction use scratch buffers owned by the extractor, so
+    extracting a frame into a preallocated output does not allocate. An
+    extractor must therefore not be shared between threads, use clone to
+    get one per worker.
+
+    Parameters
+    ----------
+    masks : list of numpy.ndarray
+        Boolean masks, all with the shape of the frames to be processed.
+    weights : str, optional
+        Storage of the weight matrix used by extract_batch, 'dense' or
+        'sparse'. 'sparse' requires scipy and only pays off for many ROIs
+        covering few common pixels.
+    """
+
+    def __init__(self, masks, weights='dense'):
+        masks = [np.asarray(mask, dtype=bool) for mask in masks]
+        if len(masks) == 0:
+            raise ValueError('RoiExtractor requires at least one mask')
+        self.frame_shape = masks[0].shape
+        if any(mask.shape != self.frame_shape for mask in masks):
+            raise ValueError('All masks must share the same shape')
+        flat_indices = [np.flatnonzero(mask) for mask in masks]
+        self.n_roi = len(masks)
+        self.counts = np.array([len(ind) for ind in flat_indices])
+        self.indices = np.concatenate(flat_indices).astype(np.intp)
+        self.nonempty = self.counts > 0
+        # Empty ROIs have no segment, they are left out of the reduction
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])[self.nonempty]
+        if weights not in ('dense', 'sparse'):
+            raise ValueError(f'Unknown weight storage {weights}')
+        if weights == 'sparse' and sparse is None:
+            raise ImportError('Sparse ROI weights require scipy')
+        self.weight_format = weights
+        self._weights = None
+        self._allocate_scratch()
+
+    def _allocate_scratch(self):
+        self._gather = {}
+        self._gather64 = np.empty(len(self.indices))
+        self._sums = np.empty(len(self.starts))
+        self._batch_gather = {}
+        self._batch_gather64 = None
+
+    @property
+    def pixels(self):
+        """
+        Sorted flat indices of the pixels covered by at least one ROI.
+        """
+        if self._weights is None:
+            self._build_weights()
+        return self._pixels
+
+    @property
+    def weights(self):
+        """
+        (pixel, roi) weight matrix over pixels, with 1 / roi size where the
+        pixel is part of the ROI, so that frames @ weights gives the means.
+        """
+        if self._weights is None:
+            self._build_weights()
+        return self._weights
+
+    def _build_weights(self):
+        self._pixels, columns = np.unique(self.indices, return_inverse=True)
+        rois = np.repeat(np.arange(self.n_roi), self.counts)
+        values = 1 / np.repeat(self.counts, self.counts)
+        if self.weight_format == 'sparse':
+            self._weights = sparse.csr_matrix(
+                (values, (columns, rois)),
+                shape=(len(self._pixels), self.n_roi))
+        else:
+            weights = np.zeros((len(self._pixels), self.n_roi))
+            np.add.at(weights, (columns, rois), values)
+            self._weights = weights
+
+    def clone(self):
+        """
+        Copy of the extractor sharing the compiled indices but with its own
+        scratch buffers, for use in another thread.
+        """
+        clone = object.__new__(RoiExtractor)
+        clone.__dict__.update(self.__dict__)
+        clone._allocate_scratch()
+        return clone
+
+    def extract(self, frame, out=None):
+        """
+        Calculate the mean value of every ROI in a frame.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            2D image array with the same shape as the masks.
+        out : numpy.ndarray, optional
+            Float64 array of length n_roi, which may be a strided view such
+            as a column of the trace array, receiving the means.
+
+        Returns
+        -------
+        means : numpy.ndarray
+            Float64 array with one mean per ROI, NaN for empty ROIs.
+
+        """
+        if frame.shape != self.frame_shape:
+            raise ValueError(f'Frame of shape {frame.shape} does not match '
+                             f'mask shape {self.frame_shape}')
+        if out is None:
+            out = np.empty(self.n_roi)
+        if len(self.starts) == 0:
+            out[...] = np.nan
+            return out
+        flat = frame.reshape(-1)
+        if flat.dtype == self._gather64.dtype:
+            np.take(flat, self.indices, out=self._gather64, mode='clip')
+        else:
+            gather = self._gather.get(flat.dtype)
+            if gather is None:
+                gather = self._gather[flat.dtype] = np.empty(len(self.indices),
+                                                             dtype=flat.dtype)
+            np.take(flat, self.indices, out=gather, mode='clip')
+            np.copyto(self._gather64, gather)
+        np.add.reduceat(self._gather64, self.starts, out=self._sums)
+        if self.nonempty.all():
+            np.divide(self._sums, self.counts, out=out)
+        else:
+            out[...] = np.nan
+            out[self.nonempty] = self._sums / self.counts[self.nonempty]
+        return out
+
+    def extract_batch(self, frames, out=None):
+        """
+        Calculate the mean value of every ROI in a block of frames with a
+        single matrix product.
+
+        Parameters
+        ----------
+        frames : numpy.ndarray
+            Array of shape (N, height, width) holding N frames.
+        out : numpy.ndarray, optional
+            Float64 array of shape (N, n_roi), which may be a strided view
+            such as a transposed slice of the trace array, receiving the
+            means.
+
+        Returns
+        -------
+        means : numpy.ndarray
+            Float64 array of shape (N, n_roi), NaN for empty ROIs.
+
+        """
+        if frames.shape[1:] != self.frame_shape:
+            raise ValueError(f'Frames of shape {frames.shape[1:]} do not match '
+                             f'mask shape {self.frame_shape}')
+        num_frames = frames.shape[0]
+        if out is None:
+            out = np.empty((num_frames, self.n_roi))
+        if len(self.starts) == 0:
+            out[...] = np.nan
+            return out
+        block = frames.reshape(num_frames, -1)
+        pixels = self.pixels
+        gather64 = self._batch_gather64
+        if gather64 is None or gather64.shape[0] < num_frames:
+            gather64 = self._batch_gather64 = np.empty((num_frames, len(pixels)))
+            self._batch_gather = {}
+        gather64 = gather64[:num_frames]
+        if block.dtype == gather64.dtype:
+            np.take(block, pixels, axis=1, out=gather64, mode='clip')
+        else:
+            gather = self._batch_gather.get(block.dtype)
+            if gather is None:
+                gather = self._batch_gather[block.dtype] = np.empty(
+                    self._batch_gather64.shape, dtype=block.dtype)
+            gather = gather[:num_frames]
+            np.take(block, pixels, axis=1, out=gather, mode='clip')
+            np.copyto(gather64, gather)
+        if self.weight_format == 'sparse':
+            out[...] = (self.weights.T @ gather64.T).T
+        else:
+            np.matmul(gather64, self.weights, out=out)
+        if not self.nonempty.all():
+            out[:, ~self.nonempty] = np.nan
+        return out
 
 
 def get_valid_images(path, prefix):
@@ -196,32 +1000,85 @@ def npy_circlemask(sizex: int, sizey: int, circlex: int, circley: int, radius: i
     Parameters
     ----------
     sizex : int
-        DESCRIPTION.
+        Width of the mask in pixels.
     sizey : int
-        DESCRIPTION.
+        Height of the mask in pixels.
     circlex : int
-        DESCRIPTION.
+        X coordinate of the circle center.
     circley : int
-        DESCRIPTION.
+        Y coordinate of the circle center.
     radius : int
-        DESCRIPTION.
+        Radius of the circle in pixels.
 
     Returns
     -------
     mask : np.array of numpy.bool_
-        Array of bool values to be used a mask over a specific circular region.
+        Array of bool values of shape (sizey, sizex) to be used a mask over a
+        specific circular region.
 
     """
-    mask = np.empty((sizex, sizey), dtype="bool_")
-    for x in range(sizex):
-        for y in range(sizey):
-            if ((x-circlex)**2 + (y-circley)**2)**(0.5) <= radius:
-                mask[y, x] = 1
-            else:
-                mask[y, x] = 0
+    y, x = np.ogrid[:sizey, :sizex]
+    return (x - circlex)**2 + (y - circley)**2 <= radius**2
+
+
+@lru_cache(maxsize=128)
+def get_circlemask(frame_shape: Tuple[int, int], circlex, circley, radius):
+    """
+    Cached mask factory. Masks are keyed by (frame shape, center, radius) so
+    repeated processing sessions and the region selection reuse them.
+
+    Parameters
+    ----------
+    frame_shape : tuple of int
+        (height, width) of the frames the mask will be applied to.
+    circlex, circley, radius :
+        Circle parameters as accepted by npy_circlemask.
+
+    Returns
+    -------
+    mask : np.array of numpy.bool_
+        Read-only mask array, shared between all callers.
+
+    """
+    mask = npy_circlemask(frame_shape[1], frame_shape[0],
+                          circlex, circley, radius)
+    mask.flags.writeable = False
     return mask
 
 
+def fiber_masks_from_coords(fiber_coords, frame_shape):
+    """
+    Convert fiber selection coordinates into circular masks.
+
+    Parameters
+    ----------
+    fiber_coords : list of tuple
+        (x0, y0, x1, y1) bounding box of each selected fiber.
+    frame_shape : tuple of int
+        (height, width) of the frames.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        One read-only boolean mask per fiber.
+
+    """
+    fiber_coords_xyr = [(sum(coord[0:3:2])/2, # X coordinate
+                         sum(coord[1:4:2])/2, # Y coordinate
+                         (coord[2] - coord[0])/2) # Radius of circle
+                        for coord in fiber_coords]
+    return [get_circlemask(tuple(frame_shape), *coords)
+            for coords in fiber_coords_xyr]
+
+
+def get_frame_shape(img_path):
+    """
+    Read the (height, width) of an image from its header only.
+    """
+    with Image.open(img_path) as img:
+        return (img.height, img.width)
+
+
 def subtractbackgroundsignal(traces : List[np.ndarray]): 
     """
     Subtract background signal from each trace.
@@ -295,6 +1152,194 @@ def reshapetraces(traces,imgptrial):
     return reshapedtraces
 
 
+class TiffFrameReader:
+    """
+    Fast reader for the uncompressed single page grayscale TIFF frames
+    written by the camera.
+
+    The header of a template frame is parsed once per run. Every other frame
+    is checked by comparing its header and IFD bytes, plus any out-of-line
+    strip tables, with the template. When they match, the strip layout is
+    identical, so the pixel data is read with a single readinto into the
+    frame buffer. Frames that do not match the template, or a template that
+    is not a plain uncompressed TIFF, are read with PIL instead.
+
+    Parameters
+    ----------
+    template_path : str
+        Path of a frame with the layout expected for the run.
+    """
+
+    def __init__(self, template_path):
+        try:
+            self.layout = _parse_tiff_layout(template_path)
+        except (OSError, ValueError, struct.error):
+            self.layout = None
+
+    @property
+    def shape(self):
+        return None if self.layout is None else self.layout['shape']
+
+    @property
+    def dtype(self):
+        return None if self.layout is None else self.layout['dtype']
+
+    def new_buffer(self):
+        """
+        Allocate a frame buffer matching the template, None when frames are
+        read through PIL.
+        """
+        if self.layout is None:
+            return None
+        return np.empty(self.shape, dtype=self.dtype)
+
+    def read(self, path, out=None):
+        """
+        Read a frame, into out when given.
+
+        Parameters
+        ----------
+        path : str
+            Path of the frame.
+        out : numpy.ndarray, optional
+            C-contiguous buffer with the template shape and dtype. Frames
+            read through PIL are copied into it when their shape matches.
+
+        Returns
+        -------
+        numpy.ndarray
+            The frame, out itself when the frame was read into it.
+
+        """
+        if self.layout is not None:
+            if out is None or out.shape != self.shape or out.dtype != self.dtype:
+                buffer = np.empty(self.shape, dtype=self.dtype)
+            else:
+                buffer = out
+            # Unbuffered, so the pixels go straight from the OS into buffer
+            with open(path, 'rb', buffering=0) as file:
+                if self._matches(file) and _readinto_at(file, buffer,
+                                                        self.layout['data_offset']):
+                    return buffer
+        img_np = loadimg(path)
+        if out is not None and out.shape == img_np.shape:
+            np.copyto(out, img_np, casting='unsafe')
+            return out
+        return img_np
+
+    def _matches(self, file):
+        for offset, signature in self.layout['signature']:
+            file.seek(offset)
+            if file.read(len(signature)) != signature:
+                return False
+        return True
+
+
+def _readinto_at(file, buffer, offset):
+    """
+    Fill buffer with the bytes of file starting at offset, returns False if
+    the file is too short.
+    """
+    view = memoryview(buffer).cast('B')
+    file.seek(offset)
+    filled = 0
+    while filled < len(view):
+        read = file.readinto(view[filled:])
+        if not read:
+            return False
+        filled += read
+    return True
+
+
+_TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2,
+                    9: 4, 10: 8, 11: 4, 12: 8, 16: 8}
+_TIFF_TYPE_CODES = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 16: 'Q'}
+_TIFF_SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def _parse_tiff_layout(path):
+    """
+    Parse the layout of an uncompressed single page, single sample TIFF.
+
+    Returns
+    -------
+    dict
+        shape, dtype and data_offset of the pixel data, and signature, a
+        list of (offset, bytes) regions that must be identical in a frame
+        with the same layout.
+
+    Raises
+    ------
+    ValueError
+        If the file is not a TIFF with a layout supported by the fast path.
+
+    """
+    with open(path, 'rb') as file:
+        header = file.read(8)
+        if header[:2] == b'II':
+            byteorder = '<'
+        elif header[:2] == b'MM':
+            byteorder = '>'
+        else:
+            raise ValueError('Not a TIFF file')
+        magic, ifd_offset = struct.unpack(f'{byteorder}HI', header[2:8])
+        if magic != 42:
+            raise ValueError('Only classic TIFF files are supported')
+        file.seek(ifd_offset)
+        num_entries_bytes = file.read(2)
+        num_entries, = struct.unpack(f'{byteorder}H', num_entries_bytes)
+        entries = file.read(num_entries * 12)
+        next_ifd_bytes = file.read(4)
+        if struct.unpack(f'{byteorder}I', next_ifd_bytes)[0] != 0:
+            raise ValueError('Multi page TIFF files are not supported')
+        signature = [(0, header),
+                     (ifd_offset, num_entries_bytes + entries + next_ifd_bytes)]
+
+        tags = {}
+        for ind in range(num_entries):
+            tag, typ, count = struct.unpack(f'{byteorder}HHI',
+                                            entries[ind * 12:ind * 12 + 8])
+            if typ not in _TIFF_TYPE_CODES:
+                continue
+            value_bytes = entries[ind * 12 + 8:ind * 12 + 12]
+            size = _TIFF_TYPE_SIZES[typ] * count
+            if size > 4:
+                value_offset, = struct.unpack(f'{byteorder}I', value_bytes)
+                file.seek(value_offset)
+                value_bytes = file.read(size)
+                # Out-of-line strip tables are part of the layout
+                if tag in (273, 279):
+                    signature.append((value_offset, value_bytes))
+            tags[tag] = struct.unpack(f'{byteorder}{count}{_TIFF_TYPE_CODES[typ]}',
+                                      value_bytes[:size])
+
+    # Tiled files have tile tables instead of strips
+    missing = [tag for tag in (256, 257, 273, 279) if tag not in tags]
+    if missing:
+        raise ValueError(f'TIFF tags {missing} are missing')
+    width, = tags[256]
+    height, = tags[257]
+    bits, = tags.get(258, (1,))
+    if tags.get(259, (1,))[0] != 1:
+        raise ValueError('Compressed TIFF files are not supported')
+    if tags.get(277, (1,))[0] != 1:
+        raise ValueError('Only single sample TIFF files are supported')
+    kind = _TIFF_SAMPLE_KINDS.get(tags.get(339, (1,))[0])
+    if kind is None or bits not in (8, 16, 32, 64):
+        raise ValueError('Unsupported TIFF sample format')
+    dtype = np.dtype(f'{byteorder}{kind}{bits // 8}')
+    offsets = tags[273]
+    counts = tags[279]
+    nbytes = width * height * dtype.itemsize
+    if any(offset + count != next_offset for offset, count, next_offset
+           in zip(offsets, counts, offsets[1:])) or sum(counts) != nbytes:
+        raise ValueError('TIFF strips are not contiguous')
+    return {'shape': (height, width),
+            'dtype': dtype,
+            'data_offset': offsets[0],
+            'signature': signature}
+
+
 def loadimg(path):
     """
     Load an image from the specified path.
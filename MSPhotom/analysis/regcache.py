@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Memoized regression results, so runs whose traces and parameters did not
+change are not regressed again.
+"""
+import os
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+import numpy as np
+
+SIDECAR_SUFFIX = '.regcache'
+DEFAULT_MAX_BYTES = 1024**3
+
+
+class RegressionCache:
+    """
+    Least recently used cache of per-run regression results.
+
+    Entries are keyed by regression_key, a hash of the content of the input
+    traces of a run together with the bin size and the algorithm version,
+    so an entry can only be served for identical inputs. The cache lives in
+    memory and can be saved next to a data file with save and restored with
+    load.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Total size of the cached arrays beyond which the least recently
+        used entries are evicted.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def nbytes(self):
+        return sum(self._sizes.values())
+
+    def get(self, key):
+        """
+        Cached result for key, None when missing. Counts hits and misses.
+        """
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        """
+        Store the result of a run, evicting least recently used entries
+        when the cache grows beyond max_bytes.
+        """
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            self._sizes[key] = _result_nbytes(result)
+            self._evict(keep=key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+
+    def save(self, path):
+        """
+        Write the entries to path, most recently used last.
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump({'max_bytes': self.max_bytes, 'entries': entries}, file)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """
+        Add the entries saved at path, returns False if there is no readable
+        cache there.
+
+        UNSAFE! Like the data files, the cache is a pickle and must only be
+        loaded from trusted sources.
+        """
+        try:
+            with open(path, 'rb') as file:
+                saved = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+        for key, result in saved['entries']:
+            if key not in self:
+                self.put(key, result)
+        return True
+
+    def _evict(self, keep=None):
+        total = sum(self._sizes.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            del self._entries[key]
+            total -= self._sizes.pop(key)
+
+
+def sidecar_path(data_path):
+    """
+    Path of the regression cache saved alongside a data file.
+    """
+    return f'{data_path}{SIDECAR_SUFFIX}'
+
+
+def traces_hash(traces):
+    """
+    Content hash of the traces of a run, including keys, shapes and dtypes.
+    """
+    digest = hashlib.sha1()
+    for key in sorted(traces):
+        trace = np.ascontiguousarray(traces[key])
+        digest.update(f'{key}|{trace.dtype.str}|{trace.shape}|'.encode('utf-8'))
+        digest.update(trace.data)
+    return digest.hexdigest()
+
+
+def regression_key(traces, binsize, version, **params):
+    """
+    Cache key of the regression of a run.
+
+    Parameters
+    ----------
+    traces : dict
+        Traces of the run keyed by signal names.
+    binsize : int
+        Number of trials binned together.
+    version : int
+        Version of the regression algorithm, results of other versions are
+        never served.
+    **params
+        Other parameters changing the result.
+    """
+    options = ','.join(f'{name}={value}' for name, value in sorted(params.items()))
+    return f'{traces_hash(traces)}-b{binsize}-v{version}-{options}'
+
+
+def _result_nbytes(result):
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, dict):
+        return sum(_result_nbytes(value) for value in result.values())
+    if isinstance(result, (list, tuple)):
+        return sum(_result_nbytes(value) for value in result)
+    return 0
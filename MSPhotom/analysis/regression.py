@@ -2,51 +2,91 @@
 Perform Studentized Residual Regression from organized trace data
 """
 from typing import Dict
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
 import numpy as np
-from MSPhotom.data import MSPData
+from MSPhotom.data import MSPData, precision_dtype
+from MSPhotom.analysis.regcache import regression_key
 
+# Bump when a change to the regression alters its results, so that cached
+# results of the previous version are not served
+REGRESSION_VERSION = 1
 
-def regression_main(data: MSPData, controller=None):
+
+def regression_main(data: MSPData, controller=None, max_workers=1,
+                    progress=None, online=False, cache=None, precision=None):
     """
     Perform regression on the data traces organized by runs and return regressed signals.
 
+    Runs are independent and can be regressed in parallel by a process pool,
+    see regress_runs. The results are identical to a serial regression.
+
     Args:
         data (MSPData): The data object containing traces organized by runs.
         controller (optional): Controller object to update data if provided.
+        max_workers (int, optional): Number of worker processes, None for the
+            CPU count. Defaults to 1, which regresses the runs serially in
+            this process. Scripts that request a pool must guard their entry
+            point with if __name__ == '__main__'.
+        progress (callable, optional): Called as progress(done, total, run_key)
+            after each run. Defaults to driving the regression progress bar
+            of the controller.
+        online (bool, optional): Regress each run trial by trial with
+            OnlineRegression, holding one bin of samples at a time.
+        cache (RegressionCache, optional): Results of runs whose traces,
+            bin size and algorithm version are unchanged are served from the
+            cache, only the other runs are regressed and then cached. The
+            progress callback is first called once for all cached runs, with
+            run_key None.
+        precision (str, optional): One of PRECISIONS, the dtype traces are
+            regressed and residuals stored as. Defaults to data.precision.
+            Regression sums are accumulated in float64 either way.
 
     Returns:
         Dict: A dictionary containing dictionaries of regressed signals for each run.
     """
-    # Initializes the main dictionaries
-    regressed_traces_by_run_signal_trial = {}
-    corrsig_reg_results = {}
+    if progress is None and controller is not None:
+        def progress(done, total, run_key):
+            controller.view.regression_tab.runprog['value'] = 100 * done / total
 
-    # Extracts the data we need
+    if precision is None:
+        precision = data.precision
+    dtype = precision_dtype(precision)
     traces_by_run = data.traces_by_run_signal_trial
-    binsize = data.bin_size
-    # Iterate through each run in the nested dictionary
-    for run_key, run_dict in traces_by_run.items():
-        # Assign the nested dictionary (traces within each run) to `traces`
-        traces = run_dict
-        region_names = [key.split('_')[1] for key in traces.keys()
-                        if key.split('_')[1] != 'corrsig']
-
-        channel_names = [key.split('_')[2] for key in traces.keys()]
+    results = {}
+    keys = {}
+    if cache is not None:
+        for run_key, traces in traces_by_run.items():
+            keys[run_key] = regression_key(traces, data.bin_size,
+                                           REGRESSION_VERSION, online=online,
+                                           precision=precision)
+            cached = cache.get(keys[run_key])
+            if cached is not None:
+                results[run_key] = cached
+    pending = {run_key: traces for run_key, traces in traces_by_run.items()
+               if run_key not in results}
+    num_cached = len(results)
+    if progress is not None and num_cached > 0:
+        progress(num_cached, len(traces_by_run), None)
 
-        channel_names_ch0_removed = [key.split('_')[2] for key in traces.keys()
-                                     if key.split('_')[2] != 'ch0']
+    def run_progress(done, total, run_key):
+        if progress is not None:
+            progress(num_cached + done, len(traces_by_run), run_key)
 
-        # Removes duplicate channel and region names
-        unique_channels = unique_list(channel_names)
-        unique_regions = unique_list(region_names)
-        unique_channels_ch0_removed = unique_list(channel_names_ch0_removed)
-
-        # Does the regression and outputs regression dictionary
-        regressed_signals, corrsig_reg_results = regression_func(traces, binsize, unique_channels, unique_regions,
-                                                                 unique_channels_ch0_removed)
-
-        regressed_traces_by_run_signal_trial[run_key] = regressed_signals
-        corrsig_reg_results[run_key] = corrsig_reg_results
+    regressed = regress_runs(pending, data.bin_size, max_workers=max_workers,
+                             progress=run_progress, online=online, dtype=dtype)
+    for run_key, result in regressed.items():
+        if cache is not None:
+            cache.put(keys[run_key], result)
+        results[run_key] = result
+    results = {run_key: results[run_key] for run_key in traces_by_run}
+    regressed_traces_by_run_signal_trial = {run_key: regressed_signals
+                                            for run_key, (regressed_signals, _)
+                                            in results.items()}
+    corrsig_reg_results = {run_key: run_corrsig_results
+                           for run_key, (_, run_corrsig_results)
+                           in results.items()}
 
     # Temp data updating
     data.regressed_traces_by_run_signal_trial = regressed_traces_by_run_signal_trial
@@ -55,83 +95,818 @@ def regression_main(data: MSPData, controller=None):
     if controller is not None:
         controller.view.update_state('RG - Regression Done Ready to Graph')
         controller.view.regression_tab.runprog['value'] = 100
+    return regressed_traces_by_run_signal_trial
 
 
-def regression_func(traces, binsize, unique_channels, unique_regions, unique_channels_ch0_removed):
+def regress_runs(traces_by_run, binsize, max_workers=1, progress=None,
+                 online=False, dtype=None):
+    """
+    Regress several runs, in parallel when more than one worker is allowed.
+
+    The trace arrays of each run are copied once into a shared memory block
+    that the worker process maps, instead of being pickled to it. Only the
+    runs being regressed have a block, at most max_workers of them. Results
+    are collected in the order of traces_by_run whatever the completion
+    order, so the output does not depend on scheduling.
+
+    Parameters
+    ----------
+    traces_by_run : dict
+        Traces of each run keyed by signal names, as in
+        MSPData.traces_by_run_signal_trial.
+    binsize : int
+        Number of trials binned together.
+    max_workers : int, optional
+        Number of worker processes, None for the CPU count. Runs are
+        regressed serially in this process when 1, the default, or for a
+        single run.
+    progress : callable, optional
+        Called as progress(done, total, run_key) after each run.
+    online : bool, optional
+        Regress each run with regress_run_online.
+    dtype : numpy.dtype, optional
+        Type traces are regressed and residuals stored as, see
+        regression_func.
+
+    Returns
+    -------
+    dict
+        (regressed_signals, corrsig_reg_results) of each run, see
+        regression_func.
+
+    """
+    run_keys = list(traces_by_run)
+    total = len(run_keys)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, total)
+    results = {}
+    if max_workers <= 1:
+        for done, run_key in enumerate(run_keys, start=1):
+            results[run_key] = regress_run(traces_by_run[run_key], binsize,
+                                           online, dtype)
+            if progress is not None:
+                progress(done, total, run_key)
+        return results
+
+    pending = iter(run_keys)
+    blocks = {}
+    done = 0
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+
+            def submit_next():
+                run_key = next(pending, None)
+                if run_key is None:
+                    return
+                block, layout = share_traces(traces_by_run[run_key])
+                blocks[run_key] = block
+                futures[executor.submit(_regress_shared_run, block.name,
+                                        layout, binsize, online, dtype)] = run_key
+
+            for _ in range(max_workers):
+                submit_next()
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    run_key = futures.pop(future)
+                    results[run_key] = future.result()
+                    _release_block(blocks.pop(run_key))
+                    done += 1
+                    if progress is not None:
+                        progress(done, total, run_key)
+                    submit_next()
+    finally:
+        for block in blocks.values():
+            _release_block(block)
+    return {run_key: results[run_key] for run_key in run_keys}
+
+
+def regress_run(traces, binsize, online=False, dtype=None):
+    """
+    Regress the traces of one run, see regression_func and
+    regress_run_online.
+    """
+    if online:
+        return regress_run_online(traces, binsize, dtype)
+    # Does the regression and outputs regression dictionary
+    return regression_func(traces, binsize, *run_labels(traces), dtype=dtype)
+
+
+def run_labels(traces):
+    """
+    Channel and region names of the traces of a run.
+
+    Parameters
+    ----------
+    traces : dict
+        Traces keyed by signal names such as 'sig_region_ch0'.
+
+    Returns
+    -------
+    unique_channels : list of str
+    unique_regions : list of str
+        Regions other than 'corrsig'.
+    unique_channels_ch0_removed : list of str
+
+    """
+    region_names = [key.split('_')[1] for key in traces.keys()
+                    if key.split('_')[1] != 'corrsig']
+
+    channel_names = [key.split('_')[2] for key in traces.keys()]
+
+    channel_names_ch0_removed = [key.split('_')[2] for key in traces.keys()
+                                 if key.split('_')[2] != 'ch0']
+
+    # Removes duplicate channel and region names
+    unique_channels = unique_list(channel_names)
+    unique_regions = unique_list(region_names)
+    unique_channels_ch0_removed = unique_list(channel_names_ch0_removed)
+    return unique_channels, unique_regions, unique_channels_ch0_removed
+
+
+def share_traces(traces):
+    """
+    Copy the trace arrays of a run into one shared memory block.
+
+    Parameters
+    ----------
+    traces : dict
+        Trace arrays keyed by signal names.
+
+    Returns
+    -------
+    block : multiprocessing.shared_memory.SharedMemory
+        Block holding the arrays, to be closed and unlinked by the caller.
+    layout : list of tuple
+        (key, shape, dtype, offset) of every array in the block.
+
+    """
+    arrays = {key: np.asarray(trace) for key, trace in traces.items()}
+    layout = []
+    offset = 0
+    for key, array in arrays.items():
+        layout.append((key, array.shape, array.dtype.str, offset))
+        # Keep every array aligned on 64 bytes
+        offset += -(-array.nbytes // 64) * 64
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for key, shape, dtype, offset in layout:
+        np.copyto(np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset),
+                  arrays[key])
+    return block, layout
+
+
+def _release_block(block):
+    block.close()
+    block.unlink()
+
+
+def _regress_shared_run(block_name, layout, binsize, online=False, dtype=None):
+    """
+    Process pool task, regress a run whose traces are in shared memory.
+    """
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        traces = {key: np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+                  for key, shape, dtype, offset in layout}
+        result = regress_run(traces, binsize, online, dtype)
+        # The views must be released before the block can be closed
+        del traces
+        return result
+    finally:
+        block.close()
+
+
+def regression_func(traces, binsize, unique_channels, unique_regions, unique_channels_ch0_removed,
+                    dtype=None):
     """
     Perform regression analysis on traces to remove correction fibers and channel 0.
 
+    The traces of a run are assembled into a (region, channel, sample, trial)
+    array and binned along the trial axis with bin_views. The correction
+    fiber of each channel is then regressed out of every region in one
+    broadcasted pass, and ch0 out of every other channel of each region in
+    a second pass. Residuals are written through bin views straight into
+    preallocated (sample, trial) outputs, so there is no debinning step.
+    The NaN samples of each pass are located once, only in the trials the
+    column_validity bitmap flags, so bins without NaN skip masking entirely.
+
     Parameters
     ----------
     traces : dict
         Dictionary of traces keyed by signal names.
+    binsize : int
+        Number of trials binned together.
+    unique_channels : list of str
+        Channel names, such as 'ch0'.
+    unique_regions : list of str
+        Region names, excluding 'corrsig'.
+    unique_channels_ch0_removed : list of str
+        Channel names other than 'ch0'.
+    dtype : numpy.dtype, optional
+        Type the traces are regressed and residuals stored as, float32 or
+        float64. Defaults to float32 when all traces are float32.
 
     Returns
     -------
     dict
         Dictionary containing residuals for each region and channel combination.
+    dict
+        Dictionary containing the correction fiber regressed residuals for
+        each region and channel combination.
     """
+    control, signals = stack_run(traces, unique_channels, unique_regions, dtype)
+    ch0 = _channel_index([unique_channels.index('ch0')])
+    targets = _channel_index([unique_channels.index(channel)
+                              for channel in unique_channels_ch0_removed])
+    num_regions, num_channels, trial_length, num_trials = signals.shape
+    dtype = np.result_type(control, signals, np.float32)
+    corrsig_debinned = np.empty(signals.shape, dtype)
+    ch0_debinned = np.empty((num_regions, len(unique_channels_ch0_removed),
+                             trial_length, num_trials), dtype)
 
-    # Initializes blank dictionaries to be filled by regression
-    regions_correction_fiber_regressed_b = {}
-    regions_correction_fiber_regressed_b_r = {}
-    region_residuals_ch0_regressed = {}
-    corrsig_reg_results = {}
-    # This first for loop regresses the correction fiber out
-    for channel in unique_channels:
-        # Assigns the control trace
-        control_trace = traces[f'sig_corrsig_{channel}']
-        # Transposes the array to have trials as columns instead of rows
-        control_trace = np.transpose(control_trace)
-        # bins the control trace
-        control_trace_b, control_trace_b_r = bin_trials(control_trace,
-                                                        binsize)
-
-        # For each unique region, the correction fiber is regressed out of the binned traces
-        for region in unique_regions:
-            # Assigns the target trace for regression
-            target_trace = traces[f'sig_{region}_{channel}']
-            target_trace = np.transpose(target_trace)
-            # Bins the target trace by binsize
-            # _b = binned & _r = remainder trials
-            target_trace_b, target_trace_b_r = bin_trials(
-                target_trace, binsize)
-            # This Calculates the studentized residuals which regresses the correction fiber out
-            res_studentized_b = calculate_studentized_residuals(
-                control_trace_b, target_trace_b)
-            res_studentized_b_r = calculate_studentized_residuals(
-                control_trace_b_r, target_trace_b_r)
-
-            res_studentized_debinned = debin_me(res_studentized_b, res_studentized_b_r, binsize)
-            corrsig_reg_results[f'{region}_{channel}'] = res_studentized_debinned
-            # Saves the studentized residuals to a dictionary for further regression
-            regions_correction_fiber_regressed_b[f'{region}_{channel}_b'] = res_studentized_b
-            regions_correction_fiber_regressed_b_r[f'{region}_{channel}_b_r'] = res_studentized_b_r
-
-    # This for loop regresses ch0 out to output residuals for each region by channel
-    for region in unique_regions:
-        # Assigns ch0 as the control channel to be regressed out
-        control_channel_b = regions_correction_fiber_regressed_b[f'{region}_ch0_b']
-        control_channel_b_r = regions_correction_fiber_regressed_b_r[f'{region}_ch0_b_r']
-
-        for channel in unique_channels_ch0_removed:
-            # Identifies the target channel for regression
-            target_channel_b = regions_correction_fiber_regressed_b[f'{region}_{channel}_b']
-            target_channel_b_r = regions_correction_fiber_regressed_b_r[f'{region}_{channel}_b_r']
-            # Regresses the control channel from the target channel
-            res_studentized_b = calculate_studentized_residuals(
-                control_channel_b, target_channel_b)
-            res_studentized_b_r = calculate_studentized_residuals(
-                control_channel_b_r, target_channel_b_r)
-            # Debins the residuals to create a unified dataset
-            debinned_region_residuals = debin_me(res_studentized_b, res_studentized_b_r, binsize)
-
-            # Saves the output residuals into a dictionary
-            region_residuals_ch0_regressed[f'{region}_{channel}'] = debinned_region_residuals
+    # The NaN samples are located once for the run, in the trials the
+    # validity bitmap flags, so that bins without NaN skip masking
+    control = np.broadcast_to(control, signals.shape)
+    trial_validity = column_validity(control) & column_validity(signals)
+    nan_control = bin_positions(nan_positions(control, trial_validity), binsize, num_trials)
+    nan_signals = bin_positions(nan_positions(signals, trial_validity), binsize, num_trials)
+    # _b = binned & _r = remainder trials, each part is regressed on its own
+    for control_part, signal_part, corrsig_part, nan_X, nan_Y in zip(
+            bin_views(control, binsize), bin_views(signals, binsize),
+            bin_views(corrsig_debinned, binsize), nan_control, nan_signals):
+        if signal_part is None:
+            continue
+        # The correction fiber of each channel is regressed out of all regions
+        calculate_studentized_residuals(control_part, signal_part,
+                                        axis=BIN_SAMPLE_AXES, out=corrsig_part,
+                                        nan_positions=(nan_X, nan_Y))
+
+    corrsig_ch0 = np.broadcast_to(corrsig_debinned[:, ch0], ch0_debinned.shape)
+    corrsig_targets = corrsig_debinned[:, targets]
+    trial_validity = column_validity(corrsig_debinned)
+    trial_validity = trial_validity[:, ch0] & trial_validity[:, targets]
+    nan_ch0 = bin_positions(nan_positions(corrsig_ch0, trial_validity), binsize, num_trials)
+    nan_targets = bin_positions(nan_positions(corrsig_targets, trial_validity), binsize,
+                                num_trials)
+    for ch0_part, target_part, out_part, nan_X, nan_Y in zip(
+            bin_views(corrsig_ch0, binsize), bin_views(corrsig_targets, binsize),
+            bin_views(ch0_debinned, binsize), nan_ch0, nan_targets):
+        if target_part is None:
+            continue
+        # ch0 is regressed out of the other channels of the same region
+        calculate_studentized_residuals(ch0_part, target_part,
+                                        axis=BIN_SAMPLE_AXES, out=out_part,
+                                        nan_positions=(nan_X, nan_Y))
 
+    corrsig_reg_results = {f'{region}_{channel}': corrsig_debinned[r, c]
+                           for c, channel in enumerate(unique_channels)
+                           for r, region in enumerate(unique_regions)}
+    region_residuals_ch0_regressed = {f'{region}_{channel}': ch0_debinned[r, c]
+                                      for r, region in enumerate(unique_regions)
+                                      for c, channel in enumerate(unique_channels_ch0_removed)}
     return region_residuals_ch0_regressed, corrsig_reg_results
 
 
+def nan_positions(values, trial_validity):
+    """
+    Index arrays of the NaN samples of values, of shape (..., sample, trial),
+    only scanning the trials flagged invalid in any row of trial_validity.
+    None when more than SPARSE_NAN_TRIALS of the trials hold NaNs, full
+    size masks are then cheaper.
+    """
+    leading = tuple(range(trial_validity.ndim - 1))
+    trials = np.flatnonzero(~trial_validity.all(axis=leading))
+    if len(trials) > SPARSE_NAN_TRIALS * values.shape[-1]:
+        return None
+    *positions, trial = np.nonzero(np.isnan(values[..., trials]))
+    return (*positions, trials[trial])
+
+
+def bin_positions(positions, binsize, num_trials):
+    """
+    Convert positions of a (..., sample, trial) array, as returned by
+    nan_positions, to positions in its bin_views.
+
+    Returns
+    -------
+    tuple
+        Positions in the binned view and in the remainder view, None
+        without remainder. Both are None when positions is None.
+    """
+    if positions is None:
+        return None, None
+    *leading, trial = positions
+    trimmed_signal_length = binsize * (num_trials // binsize)
+    binned = trial < trimmed_signal_length
+    binned_positions = (*(index[binned] for index in leading),
+                        trial[binned] // binsize, trial[binned] % binsize)
+    if trimmed_signal_length == num_trials:
+        return binned_positions, None
+    remainder = ~binned
+    remainder_positions = (*(index[remainder] for index in leading),
+                           np.zeros(np.count_nonzero(remainder), dtype=trial.dtype),
+                           trial[remainder] - trimmed_signal_length)
+    return binned_positions, remainder_positions
+
+
+def stack_run(traces, unique_channels, unique_regions, dtype=None):
+    """
+    Assemble the traces of a run into arrays with trials as columns, cast
+    to dtype when given.
+
+    Returns
+    -------
+    control : numpy.ndarray
+        Correction fiber traces, of shape (channel, sample, trial).
+    signals : numpy.ndarray
+        Region traces, of shape (region, channel, sample, trial).
+    """
+    signals = np.array([[traces[f'sig_{region}_{channel}'] for channel in unique_channels]
+                        for region in unique_regions], dtype=dtype).swapaxes(-1, -2)
+    control = np.array([traces[f'sig_corrsig_{channel}']
+                        for channel in unique_channels], dtype=dtype).swapaxes(-1, -2)
+    return control, signals
+
+
+def sweep_bin_sizes(traces_by_run, bin_sizes, progress=None):
+    """
+    Evaluate the correction fiber regression for several bin sizes in one
+    pass over the samples.
+
+    The samples are read once to compute per-trial sufficient statistics
+    (count, means, centered sums of squares and cross-product of the
+    correction fiber and region traces). The fit of every bin, for every
+    bin size, is then obtained by pooling the statistics of its trials, as
+    bin_trials would group them with the remainder trials as a last bin.
+    Unlike calculate_studentized_residuals, means are taken over the
+    samples where both traces are valid, so with NaNs the diagnostics can
+    differ slightly from a full regression. The ch0 regression depends on
+    the studentized residuals of this first stage and is not part of the
+    sweep.
+
+    Parameters
+    ----------
+    traces_by_run : dict
+        Traces of each run keyed by signal names, as in
+        MSPData.traces_by_run_signal_trial.
+    bin_sizes : iterable of int
+        Bin sizes to evaluate.
+    progress : callable, optional
+        Called as progress(done, total, run_key) after each run.
+
+    Returns
+    -------
+    dict
+        Diagnostics of each bin size:
+            'num_bins' : total number of bins over all runs.
+            'r_squared' : mean coefficient of determination of the fits.
+            'mse' : mean residual mean square of the fits.
+            'slope_cv' : mean coefficient of variation of the slope across
+                the bins of a run, region and channel, NaN with one bin.
+            'min_samples' : smallest number of samples of a fit.
+            'by_run' : for each run, 'regions' and 'channels' labels and
+                'n', 'slope', 'intercept', 'mse' and 'r_squared' arrays of
+                shape (region, channel, bin).
+
+    """
+    bin_sizes = [int(bin_size) for bin_size in bin_sizes]
+    if any(bin_size < 1 for bin_size in bin_sizes):
+        raise ValueError('Bin sizes must be positive integers')
+    by_bin_size = {bin_size: {} for bin_size in bin_sizes}
+    total = len(traces_by_run)
+    for done, (run_key, traces) in enumerate(traces_by_run.items(), start=1):
+        unique_channels, unique_regions, _ = run_labels(traces)
+        control, signals = stack_run(traces, unique_channels, unique_regions)
+        stats = trial_statistics(control[np.newaxis], signals)
+        for bin_size in bin_sizes:
+            fit = fit_statistics(pool_statistics(stats, bin_size))
+            fit['regions'] = unique_regions
+            fit['channels'] = unique_channels
+            by_bin_size[bin_size][run_key] = fit
+        if progress is not None:
+            progress(done, total, run_key)
+
+    diagnostics = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for bin_size, by_run in by_bin_size.items():
+            fits = list(by_run.values())
+
+            def gather(name):
+                return np.concatenate([fit[name].ravel() for fit in fits]) if fits else np.empty(0)
+
+            slope_cv = [np.nanstd(fit['slope'], axis=-1) / np.abs(np.nanmean(fit['slope'], axis=-1))
+                        for fit in fits if fit['slope'].shape[-1] > 1]
+            diagnostics[bin_size] = {
+                'num_bins': sum(fit['n'].shape[-1] for fit in fits),
+                'r_squared': _finite_mean(gather('r_squared')),
+                'mse': _finite_mean(gather('mse')),
+                'slope_cv': _finite_mean(np.concatenate([cv.ravel() for cv in slope_cv])
+                                         if slope_cv else np.empty(0)),
+                'min_samples': int(gather('n').min()) if fits else 0,
+                'by_run': by_run,
+            }
+    return diagnostics
+
+
+def trial_statistics(X, Y):
+    """
+    Sufficient statistics of the regression of Y on X for every trial.
+
+    Parameters
+    ----------
+    X, Y : numpy.ndarray
+        Broadcastable arrays of shape (..., sample, trial).
+
+    Returns
+    -------
+    dict
+        Arrays of shape (..., trial): 'n' the number of samples where both
+        are valid, 'mean_x' and 'mean_y' their means, 'sxx', 'syy' and 'sxy'
+        the centered sums of squares and cross-product.
+    """
+    X, Y = np.broadcast_arrays(np.asarray(X, dtype=np.float64),
+                               np.asarray(Y, dtype=np.float64))
+    valid = ~np.isnan(X) & ~np.isnan(Y)
+    n = np.count_nonzero(valid, axis=-2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        X = np.where(valid, X, 0)
+        Y = np.where(valid, Y, 0)
+        mean_x = X.sum(axis=-2) / n
+        mean_y = Y.sum(axis=-2) / n
+        X = np.where(valid, X - mean_x[..., np.newaxis, :], 0)
+        Y = np.where(valid, Y - mean_y[..., np.newaxis, :], 0)
+    return {'n': n,
+            'mean_x': np.where(n > 0, mean_x, 0),
+            'mean_y': np.where(n > 0, mean_y, 0),
+            'sxx': np.einsum('...ij,...ij->...j', X, X),
+            'syy': np.einsum('...ij,...ij->...j', Y, Y),
+            'sxy': np.einsum('...ij,...ij->...j', X, Y)}
+
+
+def pool_statistics(stats, binsize):
+    """
+    Pool per-trial statistics into bins of binsize consecutive trials, the
+    remainder trials forming a last bin, as in bin_trials.
+
+    Groups are combined with the pairwise update of centered sums, which
+    avoids the cancellation of raw sums of squares.
+    """
+    num_trials = stats['n'].shape[-1]
+    num_bins = num_trials // binsize
+    trimmed = num_bins * binsize
+    groups = [(slice(0, trimmed), num_bins, binsize)]
+    if trimmed < num_trials:
+        groups.append((slice(trimmed, num_trials), 1, num_trials - trimmed))
+    pooled = {key: [] for key in stats}
+    for trials, count, size in groups:
+        grouped = {key: value[..., trials].reshape(*value.shape[:-1], count, size)
+                   for key, value in stats.items()}
+        n_trial = grouped['n']
+        n = n_trial.sum(axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            safe_n = np.where(n > 0, n, 1)
+            mean_x = (n_trial * grouped['mean_x']).sum(axis=-1) / safe_n
+            mean_y = (n_trial * grouped['mean_y']).sum(axis=-1) / safe_n
+        dx = grouped['mean_x'] - mean_x[..., np.newaxis]
+        dy = grouped['mean_y'] - mean_y[..., np.newaxis]
+        pooled['n'].append(n)
+        pooled['mean_x'].append(mean_x)
+        pooled['mean_y'].append(mean_y)
+        pooled['sxx'].append(grouped['sxx'].sum(axis=-1) + (n_trial * dx * dx).sum(axis=-1))
+        pooled['syy'].append(grouped['syy'].sum(axis=-1) + (n_trial * dy * dy).sum(axis=-1))
+        pooled['sxy'].append(grouped['sxy'].sum(axis=-1) + (n_trial * dx * dy).sum(axis=-1))
+    return {key: np.concatenate(values, axis=-1) for key, values in pooled.items()}
+
+
+def fit_statistics(stats):
+    """
+    Ordinary least squares fit of every bin from its pooled statistics.
+
+    Returns
+    -------
+    dict
+        'n', 'slope', 'intercept', 'mse' and 'r_squared' arrays, NaN where
+        the fit is undefined.
+    """
+    n = stats['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = stats['sxy'] / stats['sxx']
+        intercept = stats['mean_y'] - slope * stats['mean_x']
+        sse = np.maximum(stats['syy'] - slope * stats['sxy'], 0)
+        mse = np.where(n > 2, sse / (n - 2), np.nan)
+        r_squared = 1 - sse / stats['syy']
+    return {'n': n, 'slope': slope, 'intercept': intercept, 'mse': mse,
+            'r_squared': r_squared}
+
+
+def _finite_mean(values):
+    values = values[np.isfinite(values)]
+    return float(values.mean()) if len(values) else np.nan
+
+
+class RunningRegression:
+    """
+    Welford style running statistics of the regression of Y on X, for a
+    batch of independent regressions.
+
+    Samples are added in blocks with update. Besides the statistics over
+    samples where both X and Y are valid, the means of X and Y over their
+    own valid samples are kept, so that studentize reproduces
+    calculate_studentized_residuals on the concatenated blocks.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the batch of regressions, the blocks passed to update have
+        shape (*shape, samples).
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        # Own valid samples of X and Y
+        self.n_x = np.zeros(self.shape)
+        self.mean_x_own = np.zeros(self.shape)
+        self.n_y = np.zeros(self.shape)
+        self.mean_y_own = np.zeros(self.shape)
+        # Jointly valid samples
+        self.n = np.zeros(self.shape)
+        self.mean_x = np.zeros(self.shape)
+        self.mean_y = np.zeros(self.shape)
+        self.m2_x = np.zeros(self.shape)
+        self.m2_y = np.zeros(self.shape)
+        self.c_xy = np.zeros(self.shape)
+
+    def update(self, X, Y):
+        """
+        Add a block of samples of shape (*shape, samples).
+        """
+        X, Y = np.broadcast_arrays(X, Y)
+        valid_x = ~np.isnan(X)
+        valid_y = ~np.isnan(Y)
+        self.n_x, self.mean_x_own = _merge_means(self.n_x, self.mean_x_own,
+                                                 *_block_mean(X, valid_x))
+        self.n_y, self.mean_y_own = _merge_means(self.n_y, self.mean_y_own,
+                                                 *_block_mean(Y, valid_y))
+        valid = valid_x & valid_y
+        n_block, mean_x = _block_mean(X, valid)
+        _, mean_y = _block_mean(Y, valid)
+        dx = np.where(valid, X - mean_x[..., np.newaxis], 0)
+        dy = np.where(valid, Y - mean_y[..., np.newaxis], 0)
+        m2_x = np.einsum('...i,...i->...', dx, dx)
+        m2_y = np.einsum('...i,...i->...', dy, dy)
+        c_xy = np.einsum('...i,...i->...', dx, dy)
+        # Chan et al. pairwise combination of the block with the running stats
+        n = self.n + n_block
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(n > 0, self.n * n_block / n, 0)
+            delta_x = mean_x - self.mean_x
+            delta_y = mean_y - self.mean_y
+            self.m2_x = self.m2_x + m2_x + delta_x * delta_x * weight
+            self.m2_y = self.m2_y + m2_y + delta_y * delta_y * weight
+            self.c_xy = self.c_xy + c_xy + delta_x * delta_y * weight
+        _, self.mean_x = _merge_means(self.n, self.mean_x, n_block, mean_x)
+        _, self.mean_y = _merge_means(self.n, self.mean_y, n_block, mean_y)
+        self.n = n
+
+    def studentize(self, X, Y):
+        """
+        Externally studentized residuals of samples of shape
+        (*shape, samples), using the fit of all samples added so far.
+        """
+        X, Y = np.broadcast_arrays(X, Y)
+        n = self.n[..., np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_x = np.where(self.n_x > 0, self.mean_x_own, np.nan)
+            mean_y = np.where(self.n_y > 0, self.mean_y_own, np.nan)
+            # Sums centered on the own means, from the joint statistics
+            offset_x = self.mean_x - mean_x
+            offset_y = self.mean_y - mean_y
+            diff_mean_sqr = self.m2_x + self.n * offset_x ** 2
+            beta1 = (self.c_xy + self.n * offset_x * offset_y) / diff_mean_sqr
+            beta0 = mean_y - beta1 * mean_x
+            mean_residual = self.mean_y - beta0 - beta1 * self.mean_x
+            sse = (self.m2_y - 2 * beta1 * self.c_xy + beta1 ** 2 * self.m2_x
+                   + self.n * mean_residual ** 2)
+            MSE = (sse / (self.n - 2))[..., np.newaxis]
+            residuals = Y - (beta0[..., np.newaxis] + beta1[..., np.newaxis] * X)
+            leverage = ((X - mean_x[..., np.newaxis]) ** 2 / diff_mean_sqr[..., np.newaxis]
+                        + 1 / n)
+            SE_regression = np.sqrt(MSE * (1 - leverage))
+            r = np.where(SE_regression != 0, residuals / SE_regression, 0)
+            studentized_residuals = r * np.sqrt((n - 2 - 1) / (n - 2 - r ** 2))
+        studentized_residuals[np.isnan(X) | np.isnan(Y)] = np.nan
+        return studentized_residuals
+
+
+def _block_mean(values, valid):
+    count = np.count_nonzero(valid, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total = np.where(valid, values, 0).sum(axis=-1, dtype=np.float64)
+        mean = np.where(count > 0, total / count, 0)
+    return count, mean
+
+
+def _merge_means(n_a, mean_a, n_b, mean_b):
+    n = n_a + n_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(n > 0, mean_a + (mean_b - mean_a) * n_b / n, 0)
+    return n, mean
+
+
+class OnlineRegression:
+    """
+    Online version of regression_func consuming a run one trial at a time.
+
+    Trials are accumulated into the current bin while running regression
+    statistics of the correction fiber fit are updated. When the bin is
+    full, its correction fiber and ch0 studentized residuals are computed
+    and returned, and the bin buffers are reused for the next bin. Memory
+    is therefore bounded by one bin whatever the session length. The
+    remainder trials are emitted as a last bin by finish, so concatenating
+    the bins gives the output of regression_func.
+
+    Parameters
+    ----------
+    binsize : int
+        Number of trials binned together.
+    unique_channels, unique_regions, unique_channels_ch0_removed : list of str
+        Labels of the run, see run_labels.
+    trial_length : int
+        Number of samples of a trial.
+    dtype : numpy.dtype, optional
+        Type of the bin buffers, the running statistics are float64.
+    """
+
+    def __init__(self, binsize, unique_channels, unique_regions,
+                 unique_channels_ch0_removed, trial_length, dtype=np.float64):
+        self.binsize = binsize
+        self.unique_channels = unique_channels
+        self.unique_regions = unique_regions
+        self.unique_channels_ch0_removed = unique_channels_ch0_removed
+        self.trial_length = trial_length
+        self.ch0_index = unique_channels.index('ch0')
+        self.target_indices = [unique_channels.index(channel)
+                               for channel in unique_channels_ch0_removed]
+        num_channels, num_regions = len(unique_channels), len(unique_regions)
+        # Binned column layout, trial j of the bin at samples j * L to (j + 1) * L
+        self._control = np.empty((num_channels, binsize * trial_length), dtype)
+        self._signals = np.empty((num_regions, num_channels, binsize * trial_length),
+                                 dtype)
+        self._trials_in_bin = 0
+        self._stats = RunningRegression((num_regions, num_channels))
+        self.trials_done = 0
+
+    def add_trial(self, trial):
+        """
+        Add the next trial of the run.
+
+        Parameters
+        ----------
+        trial : dict
+            One trial of each trace, 1D arrays keyed by signal names.
+
+        Returns
+        -------
+        tuple or None
+            (regressed_signals, corrsig_reg_results) of the bin completed
+            by this trial, arrays of shape (trial_length, binsize), or None.
+        """
+        start = self._trials_in_bin * self.trial_length
+        samples = slice(start, start + self.trial_length)
+        for c, channel in enumerate(self.unique_channels):
+            self._control[c, samples] = trial[f'sig_corrsig_{channel}']
+            for r, region in enumerate(self.unique_regions):
+                self._signals[r, c, samples] = trial[f'sig_{region}_{channel}']
+        self._stats.update(self._control[np.newaxis, :, samples],
+                           self._signals[:, :, samples])
+        self._trials_in_bin += 1
+        self.trials_done += 1
+        if self._trials_in_bin == self.binsize:
+            return self._emit()
+        return None
+
+    def finish(self):
+        """
+        Emit the remainder trials as a last bin, None if there are none.
+        """
+        if self._trials_in_bin == 0:
+            return None
+        return self._emit()
+
+    def _emit(self):
+        num_trials = self._trials_in_bin
+        length = num_trials * self.trial_length
+        control = self._control[np.newaxis, :, :length]
+        signals = self._signals[:, :, :length]
+        corrsig_regressed = self._stats.studentize(control, signals)
+        # ch0 is regressed out of the other channels over the whole bin
+        ch0 = corrsig_regressed[:, [self.ch0_index]]
+        targets = corrsig_regressed[:, self.target_indices]
+        ch0_stats = RunningRegression(targets.shape[:-1])
+        ch0_stats.update(ch0, targets)
+        ch0_regressed = ch0_stats.studentize(ch0, targets)
+
+        self._stats = RunningRegression(self._stats.shape)
+        self._trials_in_bin = 0
+
+        def debin(residuals):
+            # (..., trial * L) to (..., L, trial)
+            return residuals.reshape(*residuals.shape[:-1], num_trials,
+                                     self.trial_length).swapaxes(-1, -2)
+
+        corrsig_debinned = debin(corrsig_regressed)
+        ch0_debinned = debin(ch0_regressed)
+        corrsig_reg_results = {f'{region}_{channel}': corrsig_debinned[r, c]
+                               for c, channel in enumerate(self.unique_channels)
+                               for r, region in enumerate(self.unique_regions)}
+        region_residuals_ch0_regressed = {f'{region}_{channel}': ch0_debinned[r, c]
+                                          for r, region in enumerate(self.unique_regions)
+                                          for c, channel in enumerate(self.unique_channels_ch0_removed)}
+        return region_residuals_ch0_regressed, corrsig_reg_results
+
+
+def regress_trials(trials, binsize, labels=None, dtype=np.float64):
+    """
+    Regress a stream of trials bin by bin with OnlineRegression.
+
+    Parameters
+    ----------
+    trials : iterable of dict
+        Trials of a run in order, each a dict of 1D arrays keyed by signal
+        names, see iter_trials.
+    binsize : int
+        Number of trials binned together.
+    labels : tuple, optional
+        Output of run_labels, taken from the first trial if not given.
+    dtype : numpy.dtype, optional
+        Type trials are regressed and residuals stored as.
+
+    Yields
+    ------
+    tuple
+        (first_trial, regressed_signals, corrsig_reg_results) of each bin.
+    """
+    online = None
+    first_trial = 0
+    for trial in trials:
+        if online is None:
+            online = OnlineRegression(binsize, *(labels or run_labels(trial)),
+                                      trial_length=len(next(iter(trial.values()))),
+                                      dtype=dtype)
+        result = online.add_trial(trial)
+        if result is not None:
+            yield (first_trial,) + result
+            first_trial = online.trials_done
+    if online is not None:
+        result = online.finish()
+        if result is not None:
+            yield (first_trial,) + result
+
+
+def iter_trials(traces):
+    """
+    Iterate over the trials of a run, as dicts of row views of the
+    (trial, sample) trace arrays.
+    """
+    num_trials = len(next(iter(traces.values())))
+    for ind in range(num_trials):
+        yield {key: trace[ind] for key, trace in traces.items()}
+
+
+def regress_run_online(traces, binsize, dtype=None):
+    """
+    Regress the traces of one run with OnlineRegression, same output as
+    regress_run. Each output array is allocated once and filled bin by bin.
+    """
+    labels = run_labels(traces)
+    num_trials, trial_length = next(iter(traces.values())).shape
+    if dtype is None:
+        dtype = np.result_type(*traces.values(), np.float32)
+    regressed_signals = {}
+    corrsig_reg_results = {}
+    for first_trial, regressed, corrsig in regress_trials(iter_trials(traces),
+                                                          binsize, labels, dtype):
+        for output, bin_output in ((regressed_signals, regressed),
+                                   (corrsig_reg_results, corrsig)):
+            for key, residuals in bin_output.items():
+                if key not in output:
+                    output[key] = np.empty((trial_length, num_trials), dtype)
+                output[key][:, first_trial:first_trial + residuals.shape[1]] = residuals
+    return regressed_signals, corrsig_reg_results
+
+
+def _channel_index(indices):
+    """
+    Slice selecting indices when they are consecutive, so that indexing
+    returns a view, the list of indices otherwise.
+    """
+    if len(indices) > 0 and list(indices) == list(range(indices[0], indices[-1] + 1)):
+        return slice(indices[0], indices[-1] + 1)
+    return indices
+
+
 def unique_list(iterable):
     """
     Return unique elements from an iterable while preserving order.
@@ -153,32 +928,86 @@ def unique_list(iterable):
     return new_list
 
 
+# Axes of the samples of one bin in the views of bin_views
+BIN_SAMPLE_AXES = (-3, -1)
+# Fraction of trials holding NaNs beyond which full size masks are used
+# rather than the positions of the NaN samples
+SPARSE_NAN_TRIALS = 0.25
+
+
+def bin_views(signal, binsize):
+    """
+    Bin trials of a signal as strided views, without copying.
+
+    The trial axis is split into (bin, trial in bin), so the samples of bin
+    k are view[..., :, k, :], reduced over BIN_SAMPLE_AXES. Writing into the
+    views of an output array writes the original (sample, trial) layout
+    directly, replacing bin_trials and debin_me.
+
+    Parameters
+    ----------
+    signal : numpy.ndarray
+        Array of shape (..., trial_length, num_trials).
+    binsize : int
+        Number of trials to bin together.
+
+    Returns
+    -------
+    binned : numpy.ndarray
+        View of shape (..., trial_length, num_trials // binsize, binsize).
+    remainder : numpy.ndarray
+        View of shape (..., trial_length, 1, num_trials % binsize) over the
+        remainder trials, None without remainder.
+    """
+    num_trials = signal.shape[-1]
+    trimmed_signal_length = binsize * (num_trials // binsize)
+    binned = _split_trials(signal[..., :trimmed_signal_length], binsize)
+    if trimmed_signal_length == num_trials:
+        return binned, None
+    return binned, _split_trials(signal[..., trimmed_signal_length:],
+                                 num_trials - trimmed_signal_length)
+
+
+def _split_trials(signal, binsize):
+    *leading, trial_length, num_trials = signal.shape
+    trial_stride = signal.strides[-1]
+    return np.lib.stride_tricks.as_strided(
+        signal,
+        shape=(*leading, trial_length, num_trials // binsize, binsize),
+        strides=(*signal.strides[:-1], trial_stride * binsize, trial_stride),
+        writeable=signal.flags.writeable)
+
+
 def bin_trials(signal: np.ndarray, binsize):
     """
     Bin trials of a signal into groups for noise reduction.
 
+    Column k of the binned signal holds trials k * binsize to
+    (k + 1) * binsize - 1 one after the other.
+
     Parameters
     ----------
     signal : numpy.ndarray
-        Array of signals where trials are columns.
+        Array of signals where trials are columns, of shape
+        (..., trial_length, num_trials). Leading dimensions are binned
+        independently.
     binsize : int
         Number of trials to bin together.
 
     Returns
     -------
     binned_signal : numpy.ndarray
-        array containing binned signal.
+        array containing binned signal, of shape
+        (..., binsize * trial_length, num_trials // binsize).
     binned_remainder : numpy.ndarray
-        array containing remainder trial signals.
+        array containing remainder trial signals, of shape
+        (..., remainder * trial_length, 1), None without remainder.
     """
     # Take an arbitrary amount of trials and bin them together for less noisy processing
-    match signal.shape:
-        case (trial_length, num_trials):
-            pass  # num_trials is already assigned
-        case (trial_length, ):
-            num_trials = 1
-            binned_signal = signal[:, np.newaxis]
-            return binned_signal, None
+    if signal.ndim == 1:
+        binned_signal = signal[:, np.newaxis]
+        return binned_signal, None
+    num_trials = signal.shape[-1]
 
     # Calculates new amount of columns for reshaping the binned data
     num_binned_columns = num_trials // binsize
@@ -187,31 +1016,51 @@ def bin_trials(signal: np.ndarray, binsize):
     # Calculates the number of rows in the reshaped array
     trimmed_signal_length = binsize * num_binned_columns
 
-    # Initializes new arrays to be reshaped
-    trimmed_signal = signal[:, :trimmed_signal_length]
-    signal_remainder = signal[:, trimmed_signal_length:]
-
     # Reshapes the arrays into properly binned data with the remaining trials in a new array
+    binned_signal = _stack_trials(signal[..., :trimmed_signal_length], binsize)
     if remainder_columns == 0:
-        binned_signal = trimmed_signal.reshape(
-            (binsize * trial_length, num_binned_columns), order='F')
         return binned_signal, None
+    binned_remainder = _stack_trials(signal[..., trimmed_signal_length:],
+                                     remainder_columns)
+    return binned_signal, binned_remainder
 
-    # This step confirms the arrays are the right size
-    binned_signal = trimmed_signal.reshape(
-        (binsize * trial_length, num_binned_columns), order='F')
-    binned_remainder = signal_remainder.reshape(
-        (remainder_columns * trial_length, 1), order='F')
 
-    return binned_signal, binned_remainder
+def _stack_trials(signal, binsize):
+    """
+    Stack each group of binsize consecutive trials into one column.
+    """
+    *leading, trial_length, num_trials = signal.shape
+    grouped = signal.reshape(*leading, trial_length, num_trials // binsize, binsize)
+    return np.moveaxis(grouped, -1, -3).reshape(
+        *leading, binsize * trial_length, num_trials // binsize)
+
+
+def _unstack_trials(binned_signal, binsize):
+    """
+    Inverse of _stack_trials.
+    """
+    *leading, bin_length, num_bin_trials = binned_signal.shape
+    grouped = binned_signal.reshape(*leading, binsize, bin_length // binsize, num_bin_trials)
+    return np.moveaxis(grouped, -3, -1).reshape(
+        *leading, bin_length // binsize, num_bin_trials * binsize)
 
 
-def calculate_studentized_residuals(X, Y):
-    # This logic is here to quickly exit the function if there is no binned remainder
+def calculate_studentized_residuals(X, Y, axis=-2, out=None, nan_positions=None):
     """
     This Function calculates internally studentized residuals and externally
     (deleted) studentized residuals.
 
+    Every column (trial or bin) is regressed independently, but all columns
+    are computed at once with reductions along the sample axis, so there is
+    no Python loop over trials. Samples where X or Y is NaN are left out of
+    the fit of their column and get a NaN residual. As in the per-trial
+    formulation, the means of X and Y are taken over all of their own
+    non-NaN samples.
+
+    Without NaN, a dense path builds no mask at all. Otherwise only the NaN
+    samples, such as those of dropped frames, are excluded through their
+    positions, so a handful of them costs little more than the dense path.
+
     This function has also been checked against the statsmodels package 0.14.0.
     Below are some useful links to understand studentization:
     Course : https://online.stat.psu.edu/stat501/lesson/11/11.4
@@ -221,8 +1070,18 @@ def calculate_studentized_residuals(X, Y):
 
     Parameters
     ----------
-    X (numpy.ndarray): an array with columns being trails(binned) or to be regressed out
-    Y (numpy.ndarray) : The dependent variable array
+    X (numpy.ndarray): an array with columns being trails(binned) or to be regressed out,
+        of shape (..., samples, trials). Leading dimensions are independent
+        regressions as well.
+    Y (numpy.ndarray) : The dependent variable array, same shape as X
+    axis (int or tuple of int, optional) : Sample axes reduced by each regression,
+        such as (-3, -1) for the (..., sample, bin, trial) views of bin_views.
+    out (numpy.ndarray, optional) : Array, or view, the residuals are written to
+    nan_positions (tuple, optional) : Index arrays of the NaN samples of X and
+        of Y in the broadcast shape, such as those regression_func finds
+        once per run. NaNs are masked with full size masks if not given.
+    Float32 inputs give float32 residuals, the regression sums and means are
+    accumulated in float64 either way.
     Returns
     -------
     Studentized Residuals (numpy.ndarray) :
@@ -233,56 +1092,185 @@ def calculate_studentized_residuals(X, Y):
         X.shape
     except AttributeError:
         return None
-    # Logic is here to extract num_trials from a 1 and 2 dimensional array
-    match X.shape:
-        case (trial_length, num_trials):
-            pass  # num_trials is already assigned
-        case (trial_length, ):
-            num_trials = 1
-
-    # Initializes Blank arrays
-    studentized_residuals = np.full(Y.shape, np.nan, dtype=np.float64)
-    internally_studentized_residuals = np.full(Y.shape, np.nan, dtype=np.float64)
-    # For loop to go trial by trial
-    for i in range(num_trials):
-        # Do calculations using valid values(not nans)
-        valid_mask = ~np.isnan(X[:, i]) & ~np.isnan(Y[:, i])
-        # Masks are used to ensure data does not lose its position when removing nans
-        X_valid = X[valid_mask, i]
-        Y_valid = Y[valid_mask, i]
-
-        # Calculate means for further calculations
-        mean_X = np.nanmean(X[:, i])
-        mean_Y = np.nanmean(Y[:, i])
+    X = np.asarray(X)
+    Y = np.asarray(Y)
+    # float32 inputs keep float32 full size arrays, sums are always float64
+    dtype = np.result_type(X.dtype, Y.dtype, np.float32)
+    one_dimensional = X.ndim == 1
+    if one_dimensional:
+        X, Y = X[:, np.newaxis], Y[:, np.newaxis]
+        if out is not None:
+            out = out[:, np.newaxis]
+    shape = np.broadcast_shapes(X.shape, Y.shape)
+    axis = tuple(np.atleast_1d(axis) % len(shape))
+    if out is None:
+        out = np.empty(shape, dtype)
+    _studentize(X, Y, axis, shape, dtype, out, *(nan_positions or (None, None)))
+    return out[:, 0] if one_dimensional else out
+
+
+def column_validity(values, axis=-2):
+    """
+    Validity bitmap of the columns of values, True where a column has no
+    NaN along the sample axis, keeping the reduced axes.
+
+    regression_func computes it once per run for whole trials, to only look
+    for NaN samples in the trials holding some, see nan_positions.
+    """
+    return ~np.isnan(values).any(axis=axis, keepdims=True)
+
+
+def _studentize(X, Y, axis, shape, dtype, out, nan_X=None, nan_Y=None):
+    """
+    Studentized residuals of calculate_studentized_residuals written to out.
+
+    nan_X and nan_Y are index arrays of the NaN samples of X and Y in
+    shape, only those samples are then excluded. Without them, NaNs are
+    found with full size masks. Either way, when there is no NaN every
+    sample is valid and nothing is masked.
+    """
+    num_samples = np.prod([shape[ind] for ind in axis])
+    if nan_X is None:
+        nan_X = np.isnan(X)
+        nan_Y = np.isnan(Y)
+        masked = nan_X.any() or nan_Y.any()
+    else:
+        masked = len(nan_X[0]) > 0 or len(nan_Y[0]) > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        X_centered = np.empty(shape, dtype)
+        Y_centered = np.empty(shape, dtype)
+        if masked and isinstance(nan_X, np.ndarray):
+            # Means of each column over its own non-NaN values
+            mean_X = _masked_mean_columns(X, nan_X, axis)
+            mean_Y = _masked_mean_columns(Y, nan_Y, axis)
+            # Do calculations using valid values(not nans), the mask keeps positions
+            invalid = nan_X | nan_Y
+            np.subtract(X, mean_X, out=X_centered)
+            np.subtract(Y, mean_Y, out=Y_centered)
+            X_centered[invalid] = 0
+            Y_centered[invalid] = 0
+            n = num_samples - np.count_nonzero(invalid, axis=axis, keepdims=True)
+        elif masked:
+            # Dense means, redone over their own non-NaN values only for
+            # the columns holding NaNs
+            mean_X = _nan_column_means(X, nan_X, shape, axis)
+            mean_Y = _nan_column_means(Y, nan_Y, shape, axis)
+            np.subtract(X, mean_X, out=X_centered)
+            np.subtract(Y, mean_Y, out=Y_centered)
+            # Do calculations using valid values(not nans), samples where
+            # either is NaN are zeroed so they drop out of the sums
+            invalid = np.unravel_index(
+                np.union1d(np.ravel_multi_index(nan_X, shape),
+                           np.ravel_multi_index(nan_Y, shape)), shape)
+            X_centered[invalid] = 0
+            Y_centered[invalid] = 0
+            n = num_samples - _column_counts(invalid, shape, axis)
+        else:
+            mean_X = X.sum(axis=axis, keepdims=True, dtype=np.float64) / num_samples
+            mean_Y = Y.sum(axis=axis, keepdims=True, dtype=np.float64) / num_samples
+            np.subtract(X, mean_X, out=X_centered)
+            np.subtract(Y, mean_Y, out=Y_centered)
+            n = num_samples
 
         # This calculates the residuals(not studentized yet)
-        n = len(X_valid)
-        diff_mean_sqr = np.dot((X_valid - mean_X), (X_valid - mean_X))
-        beta1 = np.dot((X_valid - mean_X), (Y_valid - mean_Y)) / diff_mean_sqr
+        diff_mean_sqr = _sum_products(X_centered, X_centered, axis)
+        beta1 = _sum_products(X_centered, Y_centered, axis) / diff_mean_sqr
         beta0 = mean_Y - beta1 * mean_X
-        y_hat = beta0 + beta1 * X_valid
-        residuals_valid = Y_valid - y_hat
-
-        # Calculates the leverage value
-        h_ii = (X_valid - mean_X) ** 2 / diff_mean_sqr + (1 / n)
+        # Full size arrays are updated in place to limit temporaries
+        residuals = Y_centered
+        np.multiply(beta1, X, out=residuals)
+        residuals += beta0
+        np.subtract(Y, residuals, out=residuals)
+        if masked:
+            residuals[invalid] = 0
 
         # Calculates the internally studentized MSE(current value included)
-        MSE = sum((Y_valid - y_hat) ** 2) / (n - 2)
-        SE_regression = ((MSE * (1 - h_ii)) ** 0.5)
+        MSE = _sum_products(residuals, residuals, axis) / (n - 2)
+        # Calculates the leverage value, reusing X_centered
+        leverage = X_centered
+        leverage **= 2
+        leverage /= diff_mean_sqr
+        leverage += 1 / n
+        SE_regression = leverage
+        np.subtract(1, leverage, out=SE_regression)
+        SE_regression *= MSE
+        np.sqrt(SE_regression, out=SE_regression)
 
-        # np.where logic is to ensure residuals get encoded as zero instead of 
-        # nans if sum((Y_valid - y_hat) = 0
-        internally_studentized_residuals_valid = np.where(SE_regression != 0, residuals_valid / SE_regression, 0)
-        # Returns internally studentized residuals to their correct location using the valid mask
-        internally_studentized_residuals[valid_mask, i] = internally_studentized_residuals_valid
+        # Residuals get encoded as zero instead of nans if sum((Y_valid - y_hat) = 0
+        zero_error = SE_regression == 0
+        r = residuals
+        r /= SE_regression
+        r[zero_error] = 0
 
         # Converts internally studentized residuals to externally studentized residuals Note: Formula found in links
-        r = internally_studentized_residuals_valid
-        n = len(r)
-        studentized_residuals_valid = [r_i * np.sqrt((n - 2 - 1) / (n - 2 - r_i ** 2)) for r_i in r]
-        studentized_residuals[valid_mask, i] = studentized_residuals_valid
+        scale = SE_regression
+        np.square(r, out=scale)
+        np.subtract(n - 2, scale, out=scale)
+        np.divide(n - 2 - 1, scale, out=scale)
+        np.sqrt(scale, out=scale)
+        np.multiply(r, scale, out=out)
+    if masked:
+        out[invalid] = np.nan
+
 
-    return studentized_residuals.flatten() if studentized_residuals.ndim == 1 else studentized_residuals
+def _masked_mean_columns(values, nan_mask, axis):
+    """
+    Mean over axis of the non-NaN samples, NaN where there are none, keeping
+    the reduced axes. Equivalent to np.nanmean without warnings.
+    """
+    sums = np.where(nan_mask, 0, values).sum(axis=axis, keepdims=True,
+                                             dtype=np.float64)
+    return sums / np.count_nonzero(~nan_mask, axis=axis, keepdims=True)
+
+
+def _nan_column_means(values, positions, shape, axis):
+    """
+    Means over axis of values broadcast to shape, keeping the reduced axes.
+    The columns holding the NaN samples at positions are averaged over
+    their own non-NaN samples, gathering only those columns.
+    """
+    num_samples = np.prod([shape[ind] for ind in axis])
+    means = values.sum(axis=axis, keepdims=True, dtype=np.float64) / num_samples
+    if len(positions[0]) == 0:
+        return means
+    kept = [ind for ind in range(len(shape)) if ind not in axis]
+    kept_sizes = [shape[ind] for ind in kept]
+    columns = np.unravel_index(
+        np.unique(np.ravel_multi_index([positions[ind] for ind in kept], kept_sizes)),
+        kept_sizes)
+    reduced = tuple(range(len(kept), len(shape)))
+    gathered = np.moveaxis(np.broadcast_to(values, shape), axis, reduced)[columns]
+    means = np.broadcast_to(means, [1 if ind in axis else size
+                                    for ind, size in enumerate(shape)]).copy()
+    index = [np.zeros_like(columns[0])] * len(shape)
+    for ind, column_index in zip(kept, columns):
+        index[ind] = column_index
+    means[tuple(index)] = _masked_mean_columns(
+        gathered, np.isnan(gathered), tuple(range(1, gathered.ndim))).reshape(-1)
+    return means
+
+
+def _column_counts(positions, shape, axis):
+    """
+    Number of the samples at positions, index arrays into shape, falling in
+    each column, keeping the reduced axes.
+    """
+    counts = np.zeros([1 if ind in axis else size for ind, size in enumerate(shape)],
+                      dtype=np.int64)
+    np.add.at(counts, tuple(np.zeros_like(index) if ind in axis else index
+                            for ind, index in enumerate(positions)), 1)
+    return counts
+
+
+def _sum_products(a, b, axis):
+    """
+    Sum of a * b over axis keeping the reduced axes, with einsum to avoid
+    the product temporary.
+    """
+    letters = 'abcdefghijklmnopqrstuvwxyz'[:a.ndim]
+    kept = ''.join(letter for ind, letter in enumerate(letters) if ind not in axis)
+    sums = np.einsum(f'{letters},{letters}->{kept}', a, b, dtype=np.float64)
+    return np.expand_dims(sums, axis)
 
 
 def debin_me(binned_signal, binned_signal_remainder, binsize):
@@ -292,7 +1280,7 @@ def debin_me(binned_signal, binned_signal_remainder, binsize):
     Parameters
     ----------
     binned_signal : numpy.ndarray
-        Binned signal array.
+        Binned signal array, as returned by bin_trials.
     binned_signal_remainder : numpy.ndarray
         Remainder of binned signals.
     binsize : int
@@ -304,31 +1292,19 @@ def debin_me(binned_signal, binned_signal_remainder, binsize):
         Debinned signal array.
     """
     # This converts the binned signals back to initial array structure
-    # Logic is here to extract num_bin_trials from a 1 and 2 dimensional array
-    match binned_signal.shape:
-        case (bin_length, num_bin_trials):
-            pass  # num_bin_trials is already assigned
-        case (bin_length, ):
-            num_bin_trials = 1
-            pass
-
-    # Calculations to get the correct array sizes to ensure proper concatenation
-    trial_length = bin_length // binsize
-    total_trials = num_bin_trials * binsize
-
+    if binned_signal.ndim == 1:
+        binned_signal = binned_signal[:, np.newaxis]
     # Reshapes the arrays to have equal row lengths equal to the initial trial lengths
-    net_res_reshaped = binned_signal.reshape(
-        (trial_length, total_trials), order='F')
+    net_res_reshaped = _unstack_trials(binned_signal, binsize)
     if binned_signal_remainder is None:
         return net_res_reshaped
 
-    # More reshaping math
-    r_bin_length = binned_signal_remainder.shape[0]
-    r_total_trials = r_bin_length // trial_length
+    # The remainder column holds all remaining trials of the initial length
+    trial_length = net_res_reshaped.shape[-2]
+    r_total_trials = binned_signal_remainder.shape[-2] // trial_length
 
     # Combines the remainder array back into the primary array.
-    net_res_reshaped_r = binned_signal_remainder.reshape(
-        (trial_length, r_total_trials), order='F')
+    net_res_reshaped_r = _unstack_trials(binned_signal_remainder, r_total_trials)
     net_res_debinned = np.concatenate(
-        [net_res_reshaped, net_res_reshaped_r], axis=1)
+        [net_res_reshaped, net_res_reshaped_r], axis=-1)
     return net_res_debinned
@@ -4,16 +4,33 @@ Contains Dataclass that contains all photometry data and parameters and related
 functions for saving/accessing or general utilities for dealing with that data.
 """
 from typing import List, Tuple, Dict
-from dataclasses import dataclass, field
+from collections.abc import Mapping
+from dataclasses import dataclass, field, fields as dataclass_fields
 import numpy as np
 from datetime import datetime
+import os
 import pickle
-import h5py
+from MSPhotom.h5store import (H5Mapping, save_h5store, open_h5store, append_h5store,
+                              export_h5, load_h5, h5_format, EXPORT_FORMAT_NAME)
+from MSPhotom.memmapstore import save_memmap, load_memmap, is_memmap_path
+from MSPhotom.sectionfile import (save_sections, load_sections, read_index,
+                                  is_section_path)
+
+# Extensions saved and loaded as HDF5 stores rather than pickles
+H5STORE_EXTENSIONS = ('.h5', '.hdf5')
+
+# Floating point types traces can be stored as, see MSPData.precision
+PRECISIONS = ('float64', 'float32')
+
+# Version of the MSPData fields. Saved data of older versions is upgraded by
+# MIGRATIONS when loaded, see MSPData.from_dict
+SCHEMA_VERSION = 2
 
 
 @dataclass
 class MSPData:
     # General Data
+    schema_version: int = SCHEMA_VERSION
     data_creation_date: str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     logs: list = field(default_factory=lambda: [])
 
@@ -41,68 +58,216 @@ class MSPData:
     traces_raw_by_run_reg: Dict[str, Dict[str, np.ndarray]] = None
     traces_by_run_signal_trial: Dict[str, Dict[str, np.ndarray]] = None
     source_image_modification_times_by_run : Dict[str, np.ndarray] = None
+    # Storage type of the raw, split and regressed traces, one of PRECISIONS.
+    # float32 halves memory, statistics are still accumulated in float64
+    precision: str = 'float64'
     
     # Regression
-    regression_bin_size: int = None
+    bin_size: int = None
     corrsig_reg_results: Dict[str, Dict[str, np.ndarray]] = None
     regressed_traces_by_run_signal_trial: Dict[str, Dict[str, np.ndarray]] = None
     
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Create data from saved fields, migrating them from the schema version
+        they were saved with. Keys that are not fields are kept as attributes.
+        """
+        values = migrate(values)
+        names = {data_field.name for data_field in dataclass_fields(cls)}
+        data = cls(**{name: value for name, value in values.items()
+                      if name in names})
+        data.__dict__.update({name: value for name, value in values.items()
+                              if name not in names})
+        return data
+
     def log(self, msg : str):
         self.logs.append(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")} - {msg}')
         
     def __add__(self, other):
-        # Self is assumed to be the 'primary' instance of data.
+        """
+        Merge two data objects. Self is assumed to be the 'primary' instance,
+        its values take precedence and its runs come first. The merge is
+        shallow, the arrays of both objects are shared rather than copied.
+        """
         merged_data_attr = {}
         shared_attribs = self.__dict__.keys() & other.__dict__.keys()
         orphan_attribs = self.__dict__.keys() - other.__dict__.keys()
+        other_orphan_attribs = other.__dict__.keys() - self.__dict__.keys()
         for attr in shared_attribs:
             merged_data_attr[attr] = agnostic_merge(self.__dict__[attr],
                                                     other.__dict__[attr])
         for attr in orphan_attribs:
             merged_data_attr[attr] = self.__dict__[attr]
-            
-def agnostic_merge(*args):
-    pass
+        for attr in other_orphan_attribs:
+            merged_data_attr[attr] = other.__dict__[attr]
+        merged = MSPData()
+        merged.__dict__.update(merged_data_attr)
+        return merged
+
+
+def _migrate_v1(values):
+    """
+    Version 1 data predates the schema. bin_size was set outside the
+    dataclass, while the declared regression_bin_size was never used.
+    """
+    values = dict(values)
+    regression_bin_size = values.pop('regression_bin_size', None)
+    if values.get('bin_size') is None:
+        values['bin_size'] = regression_bin_size
+    return values
+
+
+# Functions upgrading the fields saved with each schema version to the next
+MIGRATIONS = {1: _migrate_v1}
+
+
+def migrate(values):
+    """
+    Upgrade saved fields to SCHEMA_VERSION. Fields saved without a schema
+    version are version 1.
+    """
+    version = values.get('schema_version', 1)
+    if version > SCHEMA_VERSION:
+        raise ValueError(f'Data of schema version {version} was saved by a newer '
+                         f'version of MSPhotom, this version reads up to {SCHEMA_VERSION}')
+    for old_version in range(version, SCHEMA_VERSION):
+        values = MIGRATIONS[old_version](values)
+    return {**values, 'schema_version': SCHEMA_VERSION}
+
+
+def select_fields(data, names):
+    """
+    Copy of data holding only the fields in names, all fields if None.
+    """
+    if names is None:
+        return data
+    return MSPData(**{name: getattr(data, name) for name in names})
+
+
+def precision_dtype(precision):
+    """
+    Numpy dtype of a precision setting, one of PRECISIONS.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}, expected one of {PRECISIONS}')
+    return np.dtype(precision)
+
+
+def agnostic_merge(primary, secondary):
+    """
+    Merge two attribute values of MSPData without copying their contents.
+
+    Dictionaries are merged key by key and lists are joined without
+    duplicates, with the primary entries first and winning conflicts. For
+    any other type the primary value is kept unless it is None.
+    """
+    if primary is None:
+        return secondary
+    if secondary is None:
+        return primary
+    # Lazily opened stores hold H5Mappings rather than dicts, a copy of
+    # them stays lazy
+    if isinstance(primary, Mapping) and isinstance(secondary, Mapping):
+        merged = primary.copy() if isinstance(primary, H5Mapping) else dict(primary)
+        for key in secondary:
+            if key not in merged:
+                merged[key] = secondary[key]
+        return merged
+    if isinstance(primary, list) and isinstance(secondary, list):
+        return primary + [item for item in secondary if item not in primary]
+    return primary
+
 
 class DataManager:
     def __init__(self, data):
         self.data = data
 
     def save(self, file):
+        """
+        Save data to file, as an HDF5 store for H5STORE_EXTENSIONS, as a
+        memory-mapped store for MEMMAP_EXTENSION, as a sectioned container
+        for SECTION_EXTENSION and as a pickle otherwise.
+        """
+        if is_h5store_path(file):
+            save_h5store(self.data, file)
+            return
+        if is_memmap_path(file):
+            save_memmap(self.data, file)
+            return
+        if is_section_path(file):
+            save_sections(self.data, file)
+            return
         with open(file, 'wb') as f:
             pickle.dump(self.data.__dict__, f)
         return
 
-    def load(self, file):
+    def load(self, file, fields=None, mmap_mode='r'):
+        """
+        Load data from file, migrated to the current schema version.
+
+        HDF5 stores are opened lazily, run arrays are only read when
+        accessed, see open_h5store. HDF5 exports written by saveto_h5 are
+        read in full. The arrays of memory-mapped stores are read-only views
+        of the file, shared with other processes, see load_memmap.
+
+        Parameters
+        ----------
+        file : str
+            Path of the data.
+        fields : iterable of str, optional
+            Names of the MSPData fields to load, the others are left at
+            their defaults. Sectioned containers and HDF5 exports only read
+            the requested fields, pickles are read in full. All fields are
+            loaded if not given.
+        mmap_mode : str, optional
+            Mode of the arrays of memory-mapped stores, 'c' for writeable
+            copy on write views, see load_memmap.
+        """
+        if fields is not None:
+            fields = list(fields)
+            unknown = set(fields) - {data_field.name for data_field in dataclass_fields(MSPData)}
+            if unknown:
+                raise ValueError(f'Unknown MSPData fields {sorted(unknown)}')
+        if is_section_path(file):
+            # Older containers are migrated in full, their fields may differ
+            if read_index(file)['schema_version'] < SCHEMA_VERSION:
+                return select_fields(MSPData.from_dict(load_sections(file)), fields)
+            return select_fields(MSPData.from_dict(load_sections(file, fields)), fields)
+        if is_h5store_path(file):
+            if h5_format(file) == EXPORT_FORMAT_NAME:
+                return select_fields(load_h5(file, fields), fields)
+            return select_fields(open_h5store(file), fields)
+        if is_memmap_path(file):
+            return select_fields(load_memmap(file, mmap_mode), fields)
         with open(file, 'rb') as f:
             data_dict = pickle.load(f)
         if isinstance(data_dict, MSPData):
-            return data_dict
-        return MSPData(**data_dict)
+            data_dict = data_dict.__dict__
+        return select_fields(MSPData.from_dict(data_dict), fields)
+
+    def append(self, file, journal=None):
+        """
+        Update the HDF5 store at file with only what changed since the write
+        described by journal, see append_h5store. Returns the journal of
+        this write, to pass to the next one.
+        """
+        return append_h5store(self.data, file, journal)
 
     def saveto_h5(self, path):
         """
-        Save specific attributes from the dataclass instance stored in `self.data` to an HDF5 file.
+        Export the data to an HDF5 file readable without python, such as
+        from MATLAB, see export_h5. Runs are written one at a time.
+        """
+        export_h5(self.data, path)
+
+    def load_h5(self, path):
         """
-        traces = self.data.traces_by_run_signal_trial
-        regressed_traces = self.data.regressed_traces_by_run_signal_trial
-
-        with h5py.File(path, 'w') as hdf5_file:
-            if traces is not None:
-                traces_group = hdf5_file.create_group('traces_by_run_signal_trial')
-                unpack_dict_to_hdf5(traces_group, traces)
-            if regressed_traces is not None:
-                regressed_traces_group = hdf5_file.create_group('regressed_traces_by_run_signal_trial')
-                unpack_dict_to_hdf5(regressed_traces_group, regressed_traces)
-
-def unpack_dict_to_hdf5(group, d):
-    for key, value in d.items():
-        if isinstance(value, dict):
-            sub_group = group.create_group(key)
-            unpack_dict_to_hdf5(sub_group, value)
-        elif isinstance(value, list):
-            group.create_dataset(key, data=value)
-        elif isinstance(value, np.ndarray):
-            group.create_dataset(key, data=value)
-        else:
-            group.attrs[key] = value
+        Load data exported with saveto_h5.
+        """
+        return load_h5(path)
+
+
+def is_h5store_path(file):
+    return os.path.splitext(str(file))[1].lower() in H5STORE_EXTENSIONS
+
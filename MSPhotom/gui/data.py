@@ -4,6 +4,7 @@ Data related GUI elements
 """
 
 import tkinter as tk
+from collections.abc import Mapping
 
 
 class DataTab(tk.Frame):
@@ -34,7 +35,7 @@ class DataTab(tk.Frame):
             self.current.append(label)
             if isinstance(item, (int,str,float)) or key == 'roi_names':
                 disp_item = str(item)
-            elif isinstance(item, (list,dict)):
+            elif isinstance(item, (list, Mapping)):
                 disp_item = f'Contains {len(item)} items'
             elif item is None:
                 disp_item = 'NA'
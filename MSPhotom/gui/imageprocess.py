@@ -29,7 +29,7 @@ class ImageProcessTab(tk.Frame):
         self.loadbutton.grid(column=0, row=0,padx=0, pady=(0,10), sticky="se")
         self.regselbutton.grid(column=0, row=1,padx=0, pady=(0,10), sticky="se")
         self.processbutton.grid(column=0, row=2,padx=0, pady=(0,10), sticky="se")
-        self.reset_button.grid(column=0, row=5,padx=2, pady=(0,10), sticky="se")
+        self.reset_button.grid(column=0, row=7,padx=2, pady=(0,10), sticky="se")
         
 
         #String Variables and Defaults
@@ -59,16 +59,24 @@ class ImageProcessTab(tk.Frame):
         
         #Integer Variables and defaults
         self.threading_enabled = tk.IntVar()
+        self.multiprocess_enabled = tk.IntVar()
         self.autosave_enabled = tk.IntVar()
+        self.cache_enabled = tk.IntVar()
         
         self.threading_enabled.set(1)
+        self.multiprocess_enabled.set(0)
         self.autosave_enabled.set(1)
+        self.cache_enabled.set(1)
         
         #Checkbox and Numerical Entry
         self.threading_checkbox = tk.Checkbutton(buttoncanvas, text = 'Enable High Speed\n(EXPERIMENTAL)', variable=self.threading_enabled)
         self.threading_checkbox.grid(column = 0, row = 3, padx=(0,0), pady=(0,10), sticky="e")
+        self.multiprocess_checkbox = tk.Checkbutton(buttoncanvas, text = 'Use Process Pool', variable=self.multiprocess_enabled)
+        self.multiprocess_checkbox.grid(column = 0, row = 4, padx=(10,0), pady=(0,10), sticky="e")
         self.autosave_checkbox = tk.Checkbutton(buttoncanvas, text = 'Enable Autosave', variable=self.autosave_enabled)
-        self.autosave_checkbox.grid(column = 0, row = 4, padx=(10,0), pady=(0,10), sticky="e")
+        self.autosave_checkbox.grid(column = 0, row = 5, padx=(10,0), pady=(0,10), sticky="e")
+        self.cache_checkbox = tk.Checkbutton(buttoncanvas, text = 'Cache ROI Means', variable=self.cache_enabled)
+        self.cache_checkbox.grid(column = 0, row = 6, padx=(10,0), pady=(0,10), sticky="e")
         
         #Static Labels
         tk.Label(self, text="Dataset Folder Path", anchor="w",width=20).grid(column=0, row=0, padx=10, pady=(10,0))
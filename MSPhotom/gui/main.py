@@ -56,7 +56,9 @@ class AppView:
                     self.image_tab.processbutton,
                     self.image_tab.reset_button,
                     self.image_tab.threading_checkbox,
-                    self.image_tab.autosave_checkbox
+                    self.image_tab.multiprocess_checkbox,
+                    self.image_tab.autosave_checkbox,
+                    self.image_tab.cache_checkbox
                 ],
             'IP - Processing Images': 
                 [
@@ -66,11 +68,13 @@ class AppView:
                 [
                     self.regression_tab.binsizeentry,
                     self.regression_tab.load_button,
+                    self.regression_tab.sweep_button,
                     self.regression_tab.reset_button
                 ],
             'RG - Ready to Regress' :
                 [
                     self.regression_tab.regress_button,
+                    self.regression_tab.sweep_button,
                     self.regression_tab.reset_button,
                     self.image_tab.reset_button
                 ],
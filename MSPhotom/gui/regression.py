@@ -22,6 +22,7 @@ class RegressionTab(tk.Frame):
         self.load_button = tk.Button(buttoncanvas, text="Set Bin")
         self.regress_button = tk.Button(buttoncanvas, text="REGRESS!!!")
         self.reset_button = tk.Button(buttoncanvas, text="RESET")
+        self.sweep_button = tk.Button(buttoncanvas, text="Sweep Bins")
 
         self.graph_corrsig_button = tk.Button(graphbuttoncanvas, text="Corrsig Reg Graph")
         self.graph_channel_button = tk.Button(graphbuttoncanvas, text="Ch0 Reg Graph")
@@ -30,6 +31,7 @@ class RegressionTab(tk.Frame):
         self.load_button.grid(column=0, row=1, padx=0, pady=(0, 10), sticky="se")
         self.regress_button.grid(column=0, row=2, padx=0, pady=(0, 10), sticky="se")
         self.reset_button.grid(column=0, row=3, padx=2, pady=(0, 10), sticky="se")
+        self.sweep_button.grid(column=0, row=4, padx=0, pady=(0, 10), sticky="se")
 
         self.graph_corrsig_button.grid(column=0, row=9, padx=0, pady=(0, 10), sticky="sw")
         self.graph_channel_button.grid(column=0, row=10, padx=0, pady=(0, 10), sticky="sw")
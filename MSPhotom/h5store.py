@@ -0,0 +1,789 @@
+# -*- coding: utf-8 -*-
+"""
+Native HDF5 store of MSPData, with per-run groups of chunked, compressed
+datasets that are only read when a run is accessed.
+
+A store can be updated in place with append_h5store, which writes only the
+entries that changed since the last write as a new record of the /journal
+group. Records are replayed over the base layout when the store is opened.
+
+export_h5 and load_h5 write and read a flat HDF5 export meant for other
+tools such as MATLAB, with one group per field and plain datasets.
+"""
+import os
+import json
+import typing
+import threading
+from collections import Counter
+from collections.abc import Mapping, MutableMapping
+from dataclasses import fields
+import numpy as np
+import h5py
+
+FORMAT_NAME = 'msphotom'
+# Version 2 adds the journal of appended records
+FORMAT_VERSION = 2
+# Fields keyed by run, stored under /runs/<run>/<field>
+RUN_FIELDS = ('traces_raw_by_run_reg',
+              'source_image_modification_times_by_run',
+              'traces_by_run_signal_trial',
+              'corrsig_reg_results',
+              'regressed_traces_by_run_signal_trial')
+# Fields keyed by fiber label, stored under /<field>/<label>
+GROUP_FIELDS = ('fiber_masks',)
+COMPRESSION = 'gzip'
+COMPRESSION_LEVEL = 4
+JOURNAL_GROUP = 'journal'
+# Records are written under this name and renamed into the journal once
+# complete, so a record interrupted while written is never replayed
+PENDING_RECORD = 'journal_pending'
+# Appending rewrites the whole store once the journal holds this many records
+MAX_JOURNAL_RECORDS = 64
+# List fields joined with the stored list when appending, rather than
+# replaced, so runs of earlier sessions stay listed
+MERGED_FIELDS = ('run_path_list',)
+EXPORT_FORMAT_NAME = 'msphotom_export'
+EXPORT_FORMAT_VERSION = 1
+# Scalar fields written as datasets of the export rather than in 'fields'
+EXPORT_DATASETS = ('logs', 'fiber_labels', 'fiber_coords')
+
+
+def save_h5store(data, path, compression=COMPRESSION,
+                 compression_opts=COMPRESSION_LEVEL):
+    """
+    Write data to an HDF5 store at path.
+
+    The scalar fields are stored as a JSON attribute of the root, and every
+    run as a group of chunked, compressed datasets. Runs are written one at
+    a time, so runs of a lazily opened store are read one at a time as
+    well. The file is written next to path and renamed once complete, so
+    an interrupted save never leaves a truncated store behind.
+
+    Parameters
+    ----------
+    data : MSPData
+        Data to save.
+    path : str
+        Path of the store, conventionally ending in '.h5'.
+    compression : str, optional
+        h5py compression filter of the datasets, None to disable.
+    compression_opts : int, optional
+        Level of the compression filter.
+    """
+    tmp_path = f'{path}.tmp'
+    options = {'compression': compression, 'compression_opts': compression_opts}
+    if compression is None:
+        options = {}
+    with h5py.File(tmp_path, 'w', track_order=True) as file:
+        file.attrs['format'] = FORMAT_NAME
+        file.attrs['format_version'] = FORMAT_VERSION
+        scalars, present = split_fields(data)
+        file.attrs['fields'] = json.dumps(scalars, default=_json_default)
+        file.attrs['present_fields'] = json.dumps(present)
+        runs = file.create_group('runs', track_order=True)
+        for run_key in store_runs(data):
+            group = runs.create_group(encode_key(run_key), track_order=True)
+            group.attrs['key'] = run_key
+            for field_name in RUN_FIELDS:
+                mapping = getattr(data, field_name, None)
+                if mapping is None or run_key not in mapping:
+                    continue
+                write_value(group, field_name, _peek(mapping, run_key), options)
+        for field_name in GROUP_FIELDS:
+            mapping = getattr(data, field_name, None)
+            if mapping is None:
+                continue
+            group = file.create_group(field_name, track_order=True)
+            for key in mapping:
+                write_value(group, encode_key(key), _peek(mapping, key), options)
+                group[encode_key(key)].attrs['key'] = key
+    os.replace(tmp_path, path)
+    # Data opened from path reads its unread entries from the new layout
+    _rebase_mappings(data, path)
+
+
+def open_h5store(path):
+    """
+    Open an HDF5 store written by save_h5store and append_h5store.
+
+    The records of the journal are replayed over the base layout in the
+    order they were appended. Only the metadata is read, the run and fiber
+    fields of the returned MSPData are H5Mappings which read the arrays of
+    an entry the first time it is accessed.
+    """
+    with h5py.File(path, 'r') as file:
+        if file.attrs.get('format') != FORMAT_NAME:
+            raise ValueError(f'{path} is not an MSPhotom HDF5 store')
+        if file.attrs['format_version'] > FORMAT_VERSION:
+            raise ValueError(f'{path} was written by a newer version of MSPhotom')
+        scalars = json.loads(file.attrs['fields'])
+        present = json.loads(file.attrs['present_fields'])
+        members = {field_name: {} for field_name in RUN_FIELDS + GROUP_FIELDS}
+        add_members(file, '', members)
+        # Records are named by sequence number, so sorted in write order
+        for name, record in file.get(JOURNAL_GROUP, {}).items():
+            scalars.update(json.loads(record.attrs['fields']))
+            scalars['logs'] = (scalars.get('logs') or []) + json.loads(record.attrs['logs'])
+            if 'present_fields' in record.attrs:
+                present = json.loads(record.attrs['present_fields'])
+            for field_name, key in json.loads(record.attrs['deleted']):
+                members[field_name].pop(key, None)
+            add_members(record, f'{JOURNAL_GROUP}/{name}/', members)
+    data = _data_from_scalars(scalars)
+    for field_name in present:
+        setattr(data, field_name, H5Mapping(path, members[field_name]))
+    return data
+
+
+def append_h5store(data, path, journal=None, max_records=MAX_JOURNAL_RECORDS,
+                   compression=COMPRESSION, compression_opts=COMPRESSION_LEVEL):
+    """
+    Update the HDF5 store at path with the changes of data since it was last
+    written, so the cost of a write scales with what changed rather than
+    with the size of the cohort.
+
+    Entries of the run and fiber fields that were added or replaced since
+    the last write, the scalar fields that changed, new log entries and
+    removed entries are written as one record of the journal. The record is
+    written under a pending name and renamed into the journal once
+    complete, an interrupted append leaves the store as it was before.
+
+    Appending never loses what the store already holds. Without a journal,
+    such as on the first autosave of a session, data is merged into the
+    existing store: entries data does not hold are kept, run_path_list is
+    joined with the stored one and log entries are added to the stored
+    ones. Only entries data held and removed since are deleted. Once the
+    journal holds max_records records the store is compacted, see
+    compact_h5store.
+
+    Entries are compared by identity, an array modified in place is not
+    detected as changed. The analysis replaces the results of a run rather
+    than modifying them.
+
+    Parameters
+    ----------
+    data : MSPData
+        Data to save.
+    path : str
+        Path of the store, created with save_h5store if missing.
+    journal : StoreJournal, optional
+        Journal returned by the previous write of data to path, ignored
+        if it tracks other data or another path.
+    max_records : int, optional
+        Number of journal records beyond which the store is compacted.
+    compression, compression_opts : optional
+        See save_h5store.
+
+    Returns
+    -------
+    StoreJournal
+        Journal of this write, to pass to the next one.
+    """
+    if not os.path.exists(path):
+        save_h5store(data, path, compression, compression_opts)
+        return StoreJournal(path, data)
+    # A journal of other data, such as data replaced by a reset or a load,
+    # would delete the entries that data lacks
+    if (journal is None or journal.data is not data
+            or not _same_file(journal.path, path)):
+        journal = StoreJournal.from_store(path, data)
+    changes = journal.changes(data)
+    if changes['present'] is not None or any(changes.values()):
+        _append_record(data, path, changes, compression, compression_opts)
+        journal.commit(data, changes)
+        journal.records += 1
+    if journal.records >= max_records:
+        compact_h5store(path, data, compression, compression_opts)
+        journal.records = 0
+    return journal
+
+
+def compact_h5store(path, data=None, compression=COMPRESSION,
+                    compression_opts=COMPRESSION_LEVEL):
+    """
+    Rewrite the store at path with its journal replayed into the base
+    layout. H5Mappings of data over the store are pointed at the rewritten
+    layout, so their entries that were not read yet stay readable.
+    """
+    save_h5store(open_h5store(path), path, compression, compression_opts)
+    if data is not None:
+        _rebase_mappings(data, path)
+
+
+def _append_record(data, path, changes, compression, compression_opts):
+    options = {'compression': compression, 'compression_opts': compression_opts}
+    if compression is None:
+        options = {}
+    # Values are read before the store is opened for writing, entries of a
+    # lazily opened store are read from the store itself
+    values = [(field_name, key, _peek(getattr(data, field_name), key))
+              for field_name, key in changes['entries']]
+    with h5py.File(path, 'a') as file:
+        if PENDING_RECORD in file:
+            del file[PENDING_RECORD]
+        record = file.create_group(PENDING_RECORD, track_order=True)
+        record.attrs['fields'] = json.dumps(changes['fields'], default=_json_default)
+        record.attrs['logs'] = json.dumps(changes['logs'])
+        if changes['present'] is not None:
+            record.attrs['present_fields'] = json.dumps(changes['present'])
+        record.attrs['deleted'] = json.dumps(changes['deleted'])
+        for field_name, key, value in values:
+            if field_name in RUN_FIELDS:
+                runs = _require_group(record, 'runs')
+                name = encode_key(key)
+                if name not in runs:
+                    runs.create_group(name, track_order=True).attrs['key'] = key
+                write_value(runs[name], field_name, value, options)
+            else:
+                group = _require_group(record, field_name)
+                write_value(group, encode_key(key), value, options)
+                group[encode_key(key)].attrs['key'] = key
+        if JOURNAL_GROUP not in file:
+            file.create_group(JOURNAL_GROUP)
+        file.move(PENDING_RECORD,
+                  f'{JOURNAL_GROUP}/{len(file[JOURNAL_GROUP]):08d}')
+
+
+def export_h5(data, path, compression=COMPRESSION,
+              compression_opts=COMPRESSION_LEVEL):
+    """
+    Export data to a flat HDF5 file for other tools, such as MATLAB.
+
+    Every run and fiber field is a group at the root of the file, with a
+    dataset or a group of datasets per run or fiber label. Link names are
+    encoded with encode_key and the original key is kept in the 'key'
+    attribute. Lists of arrays, the raw traces of a run, are groups of
+    datasets named by index with a 'list' attribute. The logs, fiber
+    labels and fiber coordinates are datasets at the root, every other
+    field is kept in the JSON 'fields' attribute of the root, and the
+    numbers and strings among them as plain root attributes as well.
+    Boolean masks are stored as uint8 with a 'bool' attribute, since HDF5
+    has no boolean type.
+
+    Entries are written one at a time, so the runs of a lazily opened
+    store are only read one at a time. The file is written next to path
+    and renamed once complete.
+
+    Parameters
+    ----------
+    data : MSPData
+        Data to export.
+    path : str
+        Path of the export.
+    compression, compression_opts : optional
+        See save_h5store.
+    """
+    tmp_path = f'{path}.tmp'
+    options = {'compression': compression, 'compression_opts': compression_opts}
+    if compression is None:
+        options = {}
+    with h5py.File(tmp_path, 'w', track_order=True) as file:
+        file.attrs['format'] = EXPORT_FORMAT_NAME
+        file.attrs['format_version'] = EXPORT_FORMAT_VERSION
+        scalars, present = split_fields(data)
+        for name in EXPORT_DATASETS:
+            value = scalars.pop(name, None)
+            if value is not None:
+                _create_dataset(file, name, _export_array(value), options)
+        file.attrs['fields'] = json.dumps(scalars, default=_json_default)
+        file.attrs['present_fields'] = json.dumps(present)
+        for name, value in scalars.items():
+            if (isinstance(value, (str, int, float, np.generic))
+                    and name not in file.attrs):
+                file.attrs[name] = value
+        for field_name in present:
+            mapping = getattr(data, field_name)
+            group = file.create_group(field_name, track_order=True)
+            for key in mapping:
+                value = _peek(mapping, key)
+                if isinstance(value, Mapping):
+                    node = group.create_group(encode_key(key), track_order=True)
+                    for signal, item in value.items():
+                        _export_dataset(node, signal, item, options)
+                elif isinstance(value, list):
+                    # Raw traces, one dataset per ROI as they may differ in length
+                    node = group.create_group(encode_key(key), track_order=True)
+                    node.attrs['list'] = True
+                    for ind, item in enumerate(value):
+                        _export_dataset(node, str(ind), item, options)
+                else:
+                    node = _export_dataset(group, key, value, options)
+                node.attrs['key'] = key
+    os.replace(tmp_path, path)
+
+
+def load_h5(path, fields=None):
+    """
+    Load an HDF5 export written by export_h5.
+
+    Parameters
+    ----------
+    path : str
+        Path of the export.
+    fields : iterable of str, optional
+        Run and fiber fields to read, all of them if not given. The scalar
+        fields are always read.
+
+    Returns
+    -------
+    MSPData
+        Data with every field read, run and fiber fields as dicts.
+    """
+    with h5py.File(path, 'r') as file:
+        if file.attrs.get('format') != EXPORT_FORMAT_NAME:
+            raise ValueError(f'{path} is not an MSPhotom HDF5 export')
+        if file.attrs['format_version'] > EXPORT_FORMAT_VERSION:
+            raise ValueError(f'{path} was written by a newer version of MSPhotom')
+        scalars = json.loads(file.attrs['fields'])
+        for name in EXPORT_DATASETS:
+            if name in file:
+                scalars[name] = _import_array(file[name]).tolist()
+        data = _data_from_scalars(scalars)
+        for field_name in json.loads(file.attrs['present_fields']):
+            if fields is not None and field_name not in fields:
+                continue
+            mapping = {}
+            for node in file[field_name].values():
+                if isinstance(node, h5py.Group) and node.attrs.get('list', False):
+                    mapping[node.attrs['key']] = [_import_array(dataset)
+                                                  for dataset in node.values()]
+                elif isinstance(node, h5py.Group):
+                    mapping[node.attrs['key']] = {
+                        dataset.attrs['key']: _import_array(dataset)
+                        for dataset in node.values()}
+                else:
+                    mapping[node.attrs['key']] = _import_array(node)
+            setattr(data, field_name, mapping)
+    return data
+
+
+def h5_format(path):
+    """
+    Format of an MSPhotom HDF5 file, FORMAT_NAME or EXPORT_FORMAT_NAME, None
+    for other HDF5 files.
+    """
+    with h5py.File(path, 'r') as file:
+        return file.attrs.get('format')
+
+
+class StoreJournal:
+    """
+    State of a store as last written by append_h5store.
+
+    The entries of data written to the store are remembered by identity,
+    so comparing data with the journal costs one lookup per entry and never
+    reads or hashes arrays. Entries of a lazily opened store that were not
+    read yet are remembered by their mapping.
+
+    Parameters
+    ----------
+    path : str
+        Path of the store.
+    data : MSPData
+        Data as written to the store.
+    """
+
+    def __init__(self, path, data):
+        self.path = str(path)
+        # Data the journal tracks, compared by identity
+        self.data = data
+        # Number of records in the journal of the store
+        self.records = 0
+        scalars, self._present = split_fields(data)
+        self._logs = Counter(scalars.pop('logs', None) or [])
+        self._scalars = {name: _dumps(value) for name, value in scalars.items()}
+        self._entries = entry_tokens(data)
+        # Keys of every entry in the store, by field
+        self._stored = {field_name: set() for field_name in RUN_FIELDS + GROUP_FIELDS}
+        for field_name, key in self._entries:
+            self._stored[field_name].add(key)
+
+    @classmethod
+    def from_store(cls, path, data):
+        """
+        Journal of a store written before, by another session, against
+        which data is compared.
+
+        Only the entries of data that are unread entries of the store
+        itself are known to be written already, every other entry of data
+        is written by the next append.
+        """
+        stored = open_h5store(path)
+        journal = cls(path, stored)
+        journal.data = data
+        with h5py.File(path, 'r') as file:
+            journal.records = len(file.get(JOURNAL_GROUP, {}))
+        journal._entries = {}
+        for (field_name, key), token in entry_tokens(data).items():
+            mapping = getattr(data, field_name)
+            stored_mapping = getattr(stored, field_name)
+            if (token is mapping and _same_file(mapping.path, path)
+                    and key in (stored_mapping or ())
+                    and mapping._members.get(key) == stored_mapping._members[key]):
+                journal._entries[field_name, key] = token
+        return journal
+
+    def changes(self, data):
+        """
+        Changes of data since it was written.
+
+        Returns
+        -------
+        dict
+            'fields', the changed scalar fields, 'logs', the log entries
+            not in the store yet, 'present', the run and fiber fields that
+            are not None if they changed, otherwise None, 'entries', the
+            (field, key) of the added or replaced entries and 'deleted',
+            the (field, key) of the entries removed from data.
+        """
+        scalars, _ = split_fields(data)
+        logs = scalars.pop('logs', None) or []
+        fields_changed = {}
+        for name, value in scalars.items():
+            if name in MERGED_FIELDS and name in self._scalars:
+                value = _join_lists(value, json.loads(self._scalars[name]))
+            if _dumps(value) != self._scalars.get(name):
+                fields_changed[name] = value
+        tokens = entry_tokens(data)
+        entries = [entry for entry, token in tokens.items()
+                   if self._entries.get(entry) is not token]
+        deleted = [entry for entry in self._entries if entry not in tokens]
+        stored = self._stored_after(entries, deleted)
+        # Fields of data that are None are kept while the store holds entries
+        present = [field_name for field_name in RUN_FIELDS + GROUP_FIELDS
+                   if getattr(data, field_name, None) is not None
+                   or stored[field_name]]
+        return {'fields': fields_changed,
+                'logs': _new_entries(logs, self._logs),
+                'present': present if present != self._present else None,
+                'entries': entries,
+                'deleted': deleted}
+
+    def commit(self, data, changes):
+        """
+        Remember the changes of data as written.
+        """
+        self._scalars.update({name: _dumps(value)
+                              for name, value in changes['fields'].items()})
+        self._logs.update(changes['logs'])
+        if changes['present'] is not None:
+            self._present = changes['present']
+        self._stored = self._stored_after(changes['entries'], changes['deleted'])
+        self._entries = entry_tokens(data)
+
+    def _stored_after(self, entries, deleted):
+        stored = {field_name: set(keys) for field_name, keys in self._stored.items()}
+        for field_name, key in entries:
+            stored[field_name].add(key)
+        for field_name, key in deleted:
+            stored[field_name].discard(key)
+        return stored
+
+
+class H5Mapping(MutableMapping):
+    """
+    Mapping over the entries of an HDF5 store, read on first access.
+
+    Entries are read from the store the first time they are accessed and
+    kept afterwards. Assigned or deleted entries only change the mapping,
+    the store is not modified. Pickling the mapping reads every entry, without
+    keeping it, and gives a plain dict.
+
+    Parameters
+    ----------
+    path : str
+        Path of the store.
+    members : dict
+        HDF5 path of the dataset or group of each key, in order.
+    """
+
+    def __init__(self, path, members):
+        self.path = path
+        self._members = dict(members)
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        if key in self._loaded:
+            return self._loaded[key]
+        if key not in self._members:
+            raise KeyError(key)
+        with self._lock:
+            if key not in self._loaded:
+                self._loaded[key] = self.read(key)
+        return self._loaded[key]
+
+    def __setitem__(self, key, value):
+        self._members.setdefault(key, None)
+        self._loaded[key] = value
+
+    def __delitem__(self, key):
+        if key not in self._members:
+            raise KeyError(key)
+        del self._members[key]
+        self._loaded.pop(key, None)
+
+    def __contains__(self, key):
+        # Membership never reads the entry
+        return key in self._members
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __repr__(self):
+        return (f'{type(self).__name__}({self.path!r}, {len(self)} entries, '
+                f'{len(self._loaded)} loaded)')
+
+    def __reduce__(self):
+        # Entries that were not read are not kept by pickling either
+        return dict, ({key: self.read(key) for key in self},)
+
+    def is_loaded(self, key):
+        return key in self._loaded
+
+    def copy(self):
+        """
+        Shallow copy, entries that were not read yet stay unread.
+        """
+        copied = type(self)(self.path, self._members)
+        copied._loaded = dict(self._loaded)
+        return copied
+
+    def read(self, key):
+        """
+        Read an entry from the store without keeping it.
+        """
+        if key in self._loaded:
+            return self._loaded[key]
+        with h5py.File(self.path, 'r') as file:
+            return read_value(file[self._members[key]])
+
+
+def add_members(node, prefix, members):
+    """
+    Add the HDF5 paths of the run and fiber entries under node to members,
+    keyed by field and key, prefix being the path of node.
+    """
+    for name, group in node.get('runs', {}).items():
+        for field_name in group:
+            members[field_name][group.attrs['key']] = f'{prefix}runs/{name}/{field_name}'
+    for field_name in GROUP_FIELDS:
+        for name, dataset in node.get(field_name, {}).items():
+            members[field_name][dataset.attrs['key']] = f'{prefix}{field_name}/{name}'
+
+
+def entry_tokens(data):
+    """
+    Identity of every entry of the run and fiber fields of data, keyed by
+    (field, key). Entries of an H5Mapping that were not read are identified
+    by the mapping.
+    """
+    tokens = {}
+    for field_name in RUN_FIELDS + GROUP_FIELDS:
+        mapping = getattr(data, field_name, None)
+        for key in mapping or ():
+            if isinstance(mapping, H5Mapping) and not mapping.is_loaded(key):
+                tokens[field_name, key] = mapping
+            else:
+                tokens[field_name, key] = mapping[key]
+    return tokens
+
+
+def split_fields(data):
+    """
+    Scalar attributes of data, and the names of the run and group fields
+    that are not None.
+    """
+    mapped = RUN_FIELDS + GROUP_FIELDS
+    scalars = {name: value for name, value in data.__dict__.items()
+               if name not in mapped}
+    present = [name for name in mapped if getattr(data, name, None) is not None]
+    return scalars, present
+
+
+def store_runs(data):
+    """
+    Keys of every run of the run fields of data, in order.
+    """
+    runs = {}
+    for field_name in RUN_FIELDS:
+        runs.update(dict.fromkeys(getattr(data, field_name, None) or ()))
+    return list(runs)
+
+
+def write_value(group, name, value, options):
+    """
+    Write an array, a dict of arrays or a list of arrays, such as the raw
+    traces of a run, as a dataset or group of datasets. Items of a list
+    are separate datasets, they may differ in length.
+    """
+    if isinstance(value, list):
+        subgroup = group.create_group(name, track_order=True)
+        subgroup.attrs['list'] = True
+        for ind, item in enumerate(value):
+            _create_dataset(subgroup, str(ind), item, options)
+        return subgroup
+    if isinstance(value, Mapping):
+        subgroup = group.create_group(name, track_order=True)
+        for key, item in value.items():
+            dataset = _create_dataset(subgroup, encode_key(key), item, options)
+            dataset.attrs['key'] = key
+        return subgroup
+    return _create_dataset(group, name, value, options)
+
+
+def read_value(node):
+    """
+    Inverse of write_value.
+    """
+    if isinstance(node, h5py.Group):
+        if node.attrs.get('list', False):
+            return [dataset[()] for dataset in node.values()]
+        return {dataset.attrs['key']: dataset[()] for dataset in node.values()}
+    return node[()]
+
+
+def encode_key(key):
+    """
+    HDF5 link name of a key. Run paths contain '/', which HDF5 would
+    interpret as nested groups, so '%' and '/' are percent encoded. The
+    original key is kept in the 'key' attribute of the link.
+    """
+    name = str(key).replace('%', '%25').replace('/', '%2F')
+    return '%2E' if name == '.' else name
+
+
+def _create_dataset(group, name, value, options):
+    value = np.asarray(value)
+    if value.ndim == 0 or value.size == 0:
+        return group.create_dataset(name, data=value)
+    return group.create_dataset(name, data=value, chunks=True, shuffle=True,
+                                **options)
+
+
+def _export_dataset(group, key, value, options):
+    dataset = _create_dataset(group, encode_key(key), _export_array(value), options)
+    dataset.attrs['key'] = key
+    if np.asarray(value).dtype == bool:
+        dataset.attrs['bool'] = True
+    return dataset
+
+
+def _export_array(value):
+    value = np.asarray(value)
+    if value.dtype == bool:
+        return value.astype(np.uint8)
+    if value.dtype.kind == 'U':
+        return value.astype(h5py.string_dtype())
+    return value
+
+
+def _import_array(dataset):
+    if dataset.attrs.get('bool', False):
+        return dataset[()].astype(bool)
+    if h5py.check_string_dtype(dataset.dtype) is not None:
+        return dataset.asstr()[()]
+    return dataset[()]
+
+
+def _data_from_scalars(scalars):
+    """
+    MSPData of the scalar fields read from a store or export, migrated to
+    the current schema.
+    """
+    from MSPhotom.data import MSPData
+    known = {data_field.name: data_field for data_field in fields(MSPData)}
+    return MSPData.from_dict({
+        name: _restore_type(value, known[name].type) if name in known else value
+        for name, value in scalars.items()})
+
+
+def _rebase_mappings(data, path):
+    """
+    Point the H5Mappings of data over the store at path to the entries of
+    the base layout, after the store was rewritten.
+    """
+    for field_name in RUN_FIELDS + GROUP_FIELDS:
+        mapping = getattr(data, field_name, None)
+        if not isinstance(mapping, H5Mapping) or not _same_file(mapping.path, path):
+            continue
+        for key, member in mapping._members.items():
+            if member is None:
+                continue
+            if field_name in RUN_FIELDS:
+                mapping._members[key] = f'runs/{encode_key(key)}/{field_name}'
+            else:
+                mapping._members[key] = f'{field_name}/{encode_key(key)}'
+
+
+def _same_file(path, other):
+    return (os.path.normcase(os.path.abspath(str(path)))
+            == os.path.normcase(os.path.abspath(str(other))))
+
+
+def _join_lists(value, stored):
+    """
+    value followed by the items of the stored list it lacks.
+    """
+    if not isinstance(stored, list):
+        return value
+    value = list(value or [])
+    return value + [item for item in stored if item not in value]
+
+
+def _new_entries(logs, written):
+    """
+    Entries of logs beyond the ones written, counting repeated entries.
+    """
+    written = written.copy()
+    new = []
+    for entry in logs:
+        if written[entry] > 0:
+            written[entry] -= 1
+        else:
+            new.append(entry)
+    return new
+
+
+def _dumps(value):
+    return json.dumps(value, default=_json_default)
+
+
+def _require_group(group, name):
+    if name not in group:
+        return group.create_group(name, track_order=True)
+    return group[name]
+
+
+def _peek(mapping, key):
+    # Read entries of a store without keeping them, to bound memory
+    if isinstance(mapping, H5Mapping):
+        return mapping.read(key)
+    return mapping[key]
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'Cannot store {type(value).__name__} in an MSPhotom HDF5 store')
+
+
+def _restore_type(value, annotation):
+    """
+    Restore the tuples JSON turned into lists, following the dataclass
+    annotation of the field.
+    """
+    if value is None:
+        return None
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    if origin is tuple:
+        return tuple(value)
+    if origin is list and args and typing.get_origin(args[0]) is tuple:
+        return [tuple(item) for item in value]
+    return value
@@ -21,7 +21,9 @@ import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 import numpy as np
 from copy import deepcopy
-from datetime import datetime
+
+# Store in the target directory that autosaves are appended to
+AUTOSAVE_NAME = 'msphotom_autosave.h5'
 
 
 class MSPApp:
@@ -37,6 +39,10 @@ class MSPApp:
         self.settings = Settings()
         self.view = AppView()
         self.data = MSPData()
+        # Regression results of unchanged runs are reused across regressions
+        self.regression_cache = analysis.regcache.RegressionCache()
+        # What the last autosave wrote, so the next one only appends changes
+        self.autosave_journal = None
 
         # Setup Events
         self.view.image_tab.fileselectbutton.config(
@@ -66,6 +72,8 @@ class MSPApp:
             command=self.input_bin)
         self.view.regression_tab.regress_button.config(
             command=self.regress_fibers)
+        self.view.regression_tab.sweep_button.config(
+            command=self.sweep_bins)
         self.view.regression_tab.graph_corrsig_button.config(
             command=lambda: self.update_canvas_with_plot(1))
         self.view.regression_tab.graph_channel_button.config(
@@ -83,6 +91,7 @@ class MSPApp:
                                 'img_prefix': self.view.image_param_tab.img_prefix,
                                 'img_per_trial_per_channel': self.view.image_param_tab.img_per_trial_per_channel,
                                 'num_interpolated_channels': self.view.image_param_tab.num_interpolated_channels,
+                                'extraction_cache_enabled': self.view.image_tab.cache_enabled,
                                 } | {f'ROI_{ind}' : field 
                                      for ind, field in enumerate(self.view.image_param_tab.roi_names)}
         self.apply_settings()
@@ -228,6 +237,8 @@ class MSPApp:
                             'displayimg': self.region_selection_get_image(),
                             'mask_coords': []
                             }
+        self.data_regsel['frame_shape'] = (self.data_regsel['displayimg'].height(),
+                                           self.data_regsel['displayimg'].width())
         popout = self.view.popout_regsel(reg_names=self.data_regsel['ROIs'],
                                          img=self.data_regsel['displayimg'])
 
@@ -296,6 +307,9 @@ class MSPApp:
             # Time to quit and dump all data_regsel into data
             self.data.fiber_labels = self.data_regsel['ROIs']
             self.data.fiber_coords = self.data_regsel['mask_coords']
+            # Masks are cached by the factory and reused during processing
+            analysis.imageprocess.fiber_masks_from_coords(
+                self.data.fiber_coords, self.data_regsel['frame_shape'])
             self.view.regsel.container.destroy()
             self.view.update_state('IP - Ready to Process')
         else:
@@ -310,13 +324,29 @@ class MSPApp:
         """
         # Update View
         self.view.update_state('IP - Processing Images')
-        # Get Threaded State
-        threaded = self.view.image_tab.threading_enabled.get() == 1
+        # Get Extraction Mode
+        if self.view.image_tab.multiprocess_enabled.get() == 1:
+            mode = 'process'
+        elif self.view.image_tab.threading_enabled.get() == 1:
+            mode = 'threaded'
+        else:
+            mode = 'sync'
+        # Images already extracted with the same masks are read from the
+        # cache, stored in the dataset folder when enabled. Its size limit is
+        # the extraction_cache_max_gb entry of the settings file
+        cache = None
+        if self.view.image_tab.cache_enabled.get() == 1:
+            max_gb = self.settings.settings_dict.setdefault(
+                'extraction_cache_max_gb',
+                analysis.extractcache.DEFAULT_MAX_BYTES / 1024**3)
+            cache = analysis.extractcache.ExtractionCache.for_dataset(
+                self.data.target_directory, max_bytes=int(float(max_gb) * 1024**3))
         # Create and initialize the thread for image loading/processing
         pross_thread = threading.Thread(target=analysis.imageprocess.process_main,
                                         args=(self.data,
-                                              self,
-                                              threaded),
+                                              self),
+                                        kwargs={'mode': mode,
+                                                'cache': cache},
                                         daemon=True)
         pross_thread.start()
         
@@ -324,10 +354,13 @@ class MSPApp:
         if self.view.image_tab.autosave_enabled.get() == 0:
             return
         manage = DataManager(self.data)
-        timecode = datetime.now().strftime("%Y-%m-%d_%H-%M")
         autosave_path = os.path.join(self.data.target_directory,
-                                     f'{timecode}.pkl')
-        manage.save(autosave_path)
+                                     AUTOSAVE_NAME)
+        # The first autosave of a session merges into the store left by
+        # earlier sessions, later ones only append the runs, results and logs
+        # that changed since
+        self.autosave_journal = manage.append(autosave_path,
+                                              self.autosave_journal)
         tk.messagebox.showinfo('Data Autosave',
                                f'Data was autosaved to {autosave_path}')
 
@@ -339,6 +372,7 @@ class MSPApp:
         self.view.update_state('IP - Parameter Entry')
         # Recreate Data
         self.data = MSPData()
+        self.autosave_journal = None
 
     def refresh_data_view(self):
         """
@@ -349,15 +383,20 @@ class MSPApp:
 
     def save_data(self):
         """
-        Save data object to file in pickle format
+        Save data object to file as a sectioned container, in pickle
+        format, or as an HDF5 or memory-mapped store
         """
-        file = filedialog.asksaveasfilename(defaultextension='.pkl',
+        file = filedialog.asksaveasfilename(defaultextension='.msp',
                                             filetypes=[
-                                                ('Python Pickle', '*.pkl')],
+                                                ('MSPhotom data', '*.msp'),
+                                                ('Python Pickle', '*.pkl'),
+                                                ('MSPhotom HDF5 store', '*.h5'),
+                                                ('Memory-mapped NumPy store', '*.npmap')],
                                             title='Save Data')
         if file is not None:
             manage = DataManager(self.data)
             manage.save(file)
+            self.regression_cache.save(analysis.regcache.sidecar_path(file))
 
     def save_h5(self):
         file = filedialog.asksaveasfilename(defaultextension='.h5',
@@ -370,19 +409,27 @@ class MSPApp:
 
     def load_data(self):
         """
-        Load data from pickle file
+        Load data from a sectioned container or pickle file, migrated to
+        the current schema, from an HDF5 store whose runs are
+        read when first accessed, from an HDF5 export or from a
+        memory-mapped store
 
         UNSAFE! Depickling allows the execution of arbitrary code. You should
         NEVER open a pickle file from a non-trusted source.
         """
-        file = filedialog.askopenfilename(defaultextension='.pkl',
+        file = filedialog.askopenfilename(defaultextension='.msp',
                                           filetypes=[
-                                              ('Python Pickle', '*.pkl')],
+                                              ('MSPhotom data', '*.msp'),
+                                              ('Python Pickle', '*.pkl'),
+                                              ('MSPhotom HDF5 store', '*.h5'),
+                                              ('Memory-mapped NumPy store', '*.npmap')],
                                           title='Load Data')
         if not file:
             return
         manage = DataManager(self.data)
-        self.data = MSPData(**manage.load(file).__dict__)
+        self.data = manage.load(file)
+        self.autosave_journal = None
+        self.regression_cache.load(analysis.regcache.sidecar_path(file))
         self.unpack_params_from_data()
         self.set_state_based_on_data()
         # This logic is here to clear the graph plot is a new pickle file is loaded
@@ -390,10 +437,9 @@ class MSPApp:
             widget.destroy()
 
     def unpack_params_from_data(self):
-        loaded_data = deepcopy(self.data.__dict__)
-        for key, value in loaded_data.items():
-            if key not in self.corresponding_params:
-                continue
+        # Only the parameters are copied, run fields may be lazy mappings
+        for key in self.corresponding_params:
+            value = deepcopy(self.data.__dict__.get(key))
             if value is None:
                 continue
             self.settings.settings_dict[key] = value
@@ -421,7 +467,7 @@ class MSPApp:
         """
         bin_size = self.view.regression_tab.bin_size.get()
         if not bin_size.isdigit():
-            bin_size.set('ERROR')
+            self.view.regression_tab.bin_size.set('ERROR')
             return
         bin_size = int(bin_size)
         num_regions = list(filter(None, self.data.roi_names))
@@ -438,6 +484,10 @@ class MSPApp:
         regress_thread = threading.Thread(target=analysis.regression.regression_main,
                                           args=(self.data,
                                                 self),
+                                          # Runs are regressed by a pool of
+                                          # one process per CPU
+                                          kwargs={'cache': self.regression_cache,
+                                                  'max_workers': None},
                                           daemon=True)
         regress_thread.start()
         run_options = list(self.data.traces_by_run_signal_trial.keys())
@@ -453,6 +503,48 @@ class MSPApp:
         self.view.regression_tab.ch_selector.set(ch_options[1])
         self.view.regression_tab.reg_selector.set(reg_options[0])
 
+    def sweep_bins(self):
+        """
+        Evaluate the comma separated bin sizes of the bin size entry in one
+        pass and graph the fit diagnostics of each.
+        """
+        entry = self.view.regression_tab.bin_size
+        bin_sizes = [size.strip() for size in entry.get().split(',')]
+        if not all(size.isdigit() and int(size) > 0 for size in bin_sizes):
+            entry.set('ERROR')
+            return
+        bin_sizes = sorted(set(int(size) for size in bin_sizes))
+        state = self.view.state
+        self.view.update_state('RG - Regressing')
+
+        def progress(done, total, run_key):
+            self.view.regression_tab.runprog['value'] = 100 * done / total
+
+        def sweep():
+            diagnostics = analysis.regression.sweep_bin_sizes(
+                self.data.traces_by_run_signal_trial, bin_sizes, progress)
+            self.view.root.after(0, self.show_bin_sweep, diagnostics, state)
+
+        threading.Thread(target=sweep, daemon=True).start()
+
+    def show_bin_sweep(self, diagnostics, state):
+        """
+        Graph the diagnostics returned by sweep_bin_sizes.
+        """
+        fig = bin_sweep_graph(diagnostics)
+        fig.set_size_inches(self.view.regression_tab.graphcanvas.winfo_width() / fig.get_dpi(),
+                            self.view.regression_tab.graphcanvas.winfo_height() / fig.get_dpi())
+        fig.subplots_adjust(left=0.15, right=.85, top=.945,
+                            bottom=0.11)
+        for widget in self.view.regression_tab.graphcanvas.winfo_children():
+            widget.destroy()
+        canvas = FigureCanvasTkAgg(
+            fig, master=self.view.regression_tab.graphcanvas)
+        canvas.draw()
+        canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.view.regression_tab.graphcanvas.config(width=330, height=330)
+        self.view.update_state(state)
+
     def update_canvas_with_plot(self, mode):
         """
         Updates Plot with corrsig regression test figure
@@ -650,5 +742,28 @@ def channel_test_graph(trial_data_x, trial_data_y, graph_reg, graph_ch, graph_tr
     return fig
 
 
+def bin_sweep_graph(diagnostics):
+
+    plt.style.use('fivethirtyeight')
+    fig = Figure(figsize=(7, 5))
+    ax = fig.add_subplot(111)
+    bin_sizes = list(diagnostics)
+    ax.plot(bin_sizes, [diagnostics[size]['r_squared'] for size in bin_sizes],
+            marker='o', linewidth=2, label='Mean R\u00b2')
+    ax.set_xlabel('Bin Size (Trials)', fontsize=8)
+    ax.set_ylabel('Mean R\u00b2 of Corrsig Fits', fontsize=8)
+    ax_cv = ax.twinx()
+    ax_cv.plot(bin_sizes, [diagnostics[size]['slope_cv'] for size in bin_sizes],
+               marker='s', linewidth=2, color='red', label='Slope CV')
+    ax_cv.set_ylabel('Slope CV Across Bins', fontsize=8)
+    ax_cv.grid(False)
+    ax.set_title('Corrsig Regression by Bin Size', fontsize=8)
+    for axis in (ax, ax_cv):
+        axis.tick_params(axis='both', which='major', labelsize=6)
+        axis.tick_params(axis='both', which='minor', labelsize=4)
+
+    return fig
+
+
 if __name__ == '__main__':
     MSPApp().run()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped store of MSPData, for sharing a cohort between processes.
+
+Every array of the run and fiber fields is laid out in one binary file,
+next to a small JSON manifest holding the scalar fields and the offset,
+dtype and shape of each array. Loading maps the binary file once and
+returns views into it, so processes loading the same store share the page
+cache and only the pages of the runs that are accessed are ever read.
+"""
+import os
+import json
+import uuid
+from collections.abc import Mapping
+import numpy as np
+from MSPhotom.h5store import split_fields, _peek, _json_default, _data_from_scalars
+
+FORMAT_NAME = 'msphotom_memmap'
+# Version 2 keeps lists of arrays, such as the raw traces of a run, as lists
+FORMAT_VERSION = 2
+# Extension of the manifest, the binary file is named after it
+MEMMAP_EXTENSION = '.npmap'
+# Arrays start on multiples of this many bytes of the binary file
+ALIGNMENT = 64
+
+
+def save_memmap(data, path):
+    """
+    Write data to a memory-mapped store whose manifest is path.
+
+    The arrays are written to a new binary file, one entry at a time, and
+    the manifest is replaced once complete. Processes that mapped the
+    previous binary file keep valid views of the previous arrays, the file
+    is removed when possible (on Windows, not while it is still mapped).
+
+    Parameters
+    ----------
+    data : MSPData
+        Data to save.
+    path : str
+        Path of the manifest, conventionally ending in MEMMAP_EXTENSION.
+    """
+    path = str(path)
+    try:
+        previous = _arrays_path(path, _read_manifest(path))
+    except (OSError, ValueError):
+        previous = None
+    arrays_name = f'{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.bin'
+    arrays_path = os.path.join(os.path.dirname(path), arrays_name)
+    scalars, present = split_fields(data)
+    entries = {}
+    try:
+        with open(arrays_path, 'wb') as file:
+            for field_name in present:
+                mapping = getattr(data, field_name)
+                entries[field_name] = {}
+                for key in mapping:
+                    value = _peek(mapping, key)
+                    if isinstance(value, Mapping):
+                        entry = {'arrays': {signal: _write_array(file, item)
+                                            for signal, item in value.items()}}
+                    elif isinstance(value, list):
+                        entry = {'list': [_write_array(file, item) for item in value]}
+                    else:
+                        entry = {'array': _write_array(file, value)}
+                    entries[field_name][key] = entry
+    except BaseException:
+        # Leave no orphan binary file behind
+        os.remove(arrays_path)
+        raise
+    manifest = {'format': FORMAT_NAME,
+                'format_version': FORMAT_VERSION,
+                'arrays_file': arrays_name,
+                'fields': scalars,
+                'entries': entries}
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, default=_json_default)
+    os.replace(tmp_path, path)
+    if previous is not None and previous != arrays_path:
+        try:
+            os.remove(previous)
+        except OSError:
+            pass
+
+
+def load_memmap(path, mmap_mode='r'):
+    """
+    Load a memory-mapped store written by save_memmap.
+
+    Parameters
+    ----------
+    path : str
+        Path of the manifest.
+    mmap_mode : str, optional
+        'r' for read-only views of the shared mapping, 'c' for copy on
+        write views whose changes stay private to this process, None to
+        read every array into memory.
+
+    Returns
+    -------
+    MSPData
+        Data whose run and fiber fields are dicts of arrays, or of lists
+        of arrays as saved.
+    """
+    if mmap_mode not in ('r', 'c', None):
+        raise ValueError(f'Unknown mmap_mode {mmap_mode}, expected r, c or None')
+    path = str(path)
+    manifest = _read_manifest(path)
+    arrays_path = _arrays_path(path, manifest)
+    if os.path.getsize(arrays_path) == 0:
+        buffer = np.empty(0, np.uint8)
+    elif mmap_mode is None:
+        buffer = np.fromfile(arrays_path, np.uint8)
+    else:
+        buffer = np.memmap(arrays_path, np.uint8, mode=mmap_mode)
+    data = _data_from_scalars(manifest['fields'])
+    for field_name, field_entries in manifest['entries'].items():
+        mapping = {}
+        for key, entry in field_entries.items():
+            if 'arrays' in entry:
+                mapping[key] = {signal: _view(buffer, spec)
+                                for signal, spec in entry['arrays'].items()}
+            elif 'list' in entry:
+                mapping[key] = [_view(buffer, spec) for spec in entry['list']]
+            else:
+                mapping[key] = _view(buffer, entry['array'])
+        setattr(data, field_name, mapping)
+    return data
+
+
+def is_memmap_path(file):
+    return os.path.splitext(str(file))[1].lower() == MEMMAP_EXTENSION
+
+
+def _read_manifest(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        try:
+            manifest = json.load(file)
+        except json.JSONDecodeError:
+            manifest = None
+    if not isinstance(manifest, dict) or manifest.get('format') != FORMAT_NAME:
+        raise ValueError(f'{path} is not an MSPhotom memory-mapped store')
+    if manifest['format_version'] > FORMAT_VERSION:
+        raise ValueError(f'{path} was written by a newer version of MSPhotom')
+    return manifest
+
+
+def _arrays_path(path, manifest):
+    return os.path.join(os.path.dirname(path), manifest['arrays_file'])
+
+
+def _write_array(file, value):
+    """
+    Append an array to file at the next aligned offset, returns its spec.
+    """
+    value = np.ascontiguousarray(value)
+    if value.dtype.hasobject:
+        raise TypeError('Cannot memory map arrays of python objects')
+    offset = -(-file.tell() // ALIGNMENT) * ALIGNMENT
+    file.write(bytes(offset - file.tell()))
+    value.tofile(file)
+    return {'offset': offset, 'dtype': value.dtype.str, 'shape': list(value.shape)}
+
+
+def _view(buffer, spec):
+    dtype = np.dtype(spec['dtype'])
+    shape = tuple(spec['shape'])
+    nbytes = dtype.itemsize * int(np.prod(shape))
+    view = buffer[spec['offset']:spec['offset'] + nbytes].view(dtype)
+    # A plain ndarray, still backed by the mapping
+    return np.asarray(view).reshape(shape)
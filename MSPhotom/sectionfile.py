@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Sectioned container of MSPData, one pickle per field behind an index, so
+a subset of the fields can be loaded without reading the others.
+
+Layout of a file:
+    header  magic, offset and length of the index
+    pickle of each field, one after the other
+    index   JSON of the schema version, the offset and length of the
+            section of each field and, for the fields written entry by
+            entry, the key, offset and length of the section of each entry
+"""
+import os
+import json
+import pickle
+import struct
+from MSPhotom.h5store import H5Mapping
+
+FORMAT_MAGIC = b'MSPSECT\x01'
+SECTION_EXTENSION = '.msp'
+_HEADER = struct.Struct('<8sQQ')
+
+
+def save_sections(data, path):
+    """
+    Write every attribute of data to its own section of a container at path.
+
+    Fields of a lazily opened store are written entry by entry, each entry
+    to its own section, so only one run of the store is in memory at a
+    time and none is kept by the store afterwards. The file is written next
+    to path and renamed once complete.
+    """
+    tmp_path = f'{path}.tmp'
+    sections = {}
+    entries = {}
+    with open(tmp_path, 'wb') as file:
+        file.write(bytes(_HEADER.size))
+        for name, value in data.__dict__.items():
+            if isinstance(value, H5Mapping):
+                entries[name] = []
+                for key in value:
+                    offset = file.tell()
+                    pickle.dump(value.read(key), file, protocol=pickle.HIGHEST_PROTOCOL)
+                    entries[name].append([key, offset, file.tell() - offset])
+                continue
+            offset = file.tell()
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+            sections[name] = [offset, file.tell() - offset]
+        index = json.dumps({'schema_version': data.schema_version,
+                            'sections': sections,
+                            'entries': entries}).encode('utf-8')
+        index_offset = file.tell()
+        file.write(index)
+        file.seek(0)
+        file.write(_HEADER.pack(FORMAT_MAGIC, index_offset, len(index)))
+    os.replace(tmp_path, path)
+
+
+def read_index(path):
+    """
+    Index of a container, 'schema_version', the [offset, length] of the
+    section of each field in 'sections' and the [key, offset, length] of
+    the section of each entry of the fields written entry by entry in
+    'entries', if any.
+    """
+    with open(path, 'rb') as file:
+        return _read_index(file, path)
+
+
+def load_sections(path, fields=None):
+    """
+    Read sections of a container written by save_sections.
+
+    UNSAFE! Sections are pickles and must only be loaded from trusted
+    sources.
+
+    Parameters
+    ----------
+    path : str
+        Path of the container.
+    fields : iterable of str, optional
+        Fields to read, every field if not given. Fields without a section
+        are skipped.
+
+    Returns
+    -------
+    dict
+        Values of the sections read keyed by field, along with the
+        'schema_version' of the container.
+    """
+    with open(path, 'rb') as file:
+        index = _read_index(file, path)
+        sections = index['sections']
+        # Containers written before fields were split into entries have none
+        entries = index.get('entries', {})
+        names = [*sections, *entries] if fields is None else [
+            name for name in fields if name in sections or name in entries]
+        values = {}
+        for name in names:
+            if name in entries:
+                values[name] = {}
+                for key, offset, _ in entries[name]:
+                    file.seek(offset)
+                    values[name][key] = pickle.load(file)
+                continue
+            file.seek(sections[name][0])
+            values[name] = pickle.load(file)
+    values['schema_version'] = index['schema_version']
+    return values
+
+
+def is_section_path(file):
+    return os.path.splitext(str(file))[1].lower() == SECTION_EXTENSION
+
+
+def _read_index(file, path):
+    header = file.read(_HEADER.size)
+    if len(header) < _HEADER.size or header[:len(FORMAT_MAGIC)] != FORMAT_MAGIC:
+        raise ValueError(f'{path} is not an MSPhotom sectioned data file')
+    _, offset, length = _HEADER.unpack(header)
+    file.seek(offset)
+    return json.loads(file.read(length).decode('utf-8'))
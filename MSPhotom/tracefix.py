@@ -4,18 +4,28 @@ Created on Mon Jan 13 13:24:38 2025
 
 @author: mbmad
 """
-import pickle
 import numpy as np
 from matplotlib import pyplot as plt
 from MSPhotom.analysis.imageprocess import subtractbackgroundsignal,\
     splittraces, reshapetraces
 from MSPhotom.analysis.regression import regression_main 
-from dataclasses import dataclass
+from MSPhotom.data import MSPData, DataManager
 
-def load(datafile):
-    with open(datafile,'rb') as file:
-        data = pickle.load(file)
-    return data
+# Fields read by evaluate, load only these when the data is not saved back
+EVALUATE_FIELDS = ('traces_raw_by_run_reg',
+                   'source_image_modification_times_by_run')
+
+def load(datafile, fields=None):
+    """
+    Load the fields of a data file as a dictionary, every field if fields
+    is None, e.g. load(datafile, EVALUATE_FIELDS) to only evaluate it.
+    Traces of memory-mapped stores are copy on write views, so they can be
+    fixed in place without changing the store.
+    """
+    data = DataManager(None).load(datafile, fields, mmap_mode='c')
+    if fields is None:
+        return data.__dict__
+    return {name: getattr(data, name) for name in fields}
 
 def save_and_regress(datafile, data, bin_size=1000):
     raw_fixed_traces = data['traces_raw_by_run_reg']
@@ -42,21 +52,14 @@ def save_and_regress(datafile, data, bin_size=1000):
         traces_by_run_signal_trial[run_path] = {label : trace for label, trace 
                                            in zip(trace_labels, traces)}
     data['traces_by_run_signal_trial'] = traces_by_run_signal_trial
+    data['bin_size'] = bin_size
     
-    @dataclass
-    class MSPDataDummy:
-        traces_by_run_signal_trial : any = None
-        bin_size : int = None
-        regressed_traces_by_run_signal_trial = None
-        corrsig_reg_results = None
-        
-    data_obj = MSPDataDummy(traces_by_run_signal_trial=data['traces_by_run_signal_trial'],
-                            bin_size=bin_size)
+    data_obj = MSPData.from_dict(data)
     regression_main(data_obj)
     data['regressed_traces_by_run_signal_trial'] = data_obj.regressed_traces_by_run_signal_trial
+    data['corrsig_reg_results'] = data_obj.corrsig_reg_results
     
-    with open(datafile,'wb') as file:
-        pickle.dump(data, file)
+    DataManager(data_obj).save(datafile)
     print('saved!')
         
 def swap(traces):
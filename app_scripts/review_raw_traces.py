@@ -5,17 +5,17 @@ Created on Thu Aug 29 10:52:56 2024
 @author: mbmad
 """
 
-import pickle
 from matplotlib import pyplot as plt
 import numpy as np
+from MSPhotom.data import DataManager
 
-# data_path = input('path to pickle file: ')
+# data_path = input('path to data file: ')
 data_path = 'G:\\Last_Fucking_Experiment\\ALL_PROCESSED_8.29.24.pkl'
 
-with open(data_path, 'rb') as file:
-    data = pickle.load(file)
-    
-print(f'Loaded data object with {list(data.__dict__.keys())} attributes')
+# Only the raw traces are reviewed, other fields are skipped where the format allows
+data = DataManager(None).load(data_path, fields=['traces_raw_by_run_reg'])
+
+print(f'Loaded raw traces of {len(data.traces_raw_by_run_reg)} runs')
 
 # Unpack desired data
 traces_raw_by_run_reg = data.traces_raw_by_run_reg
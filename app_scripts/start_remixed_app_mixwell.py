@@ -20,17 +20,16 @@ data pipeline and this python app.
 Notable tweaks to app behavior.
 ------------------------------------------------------------------------------
 Partial Analysis
-    -Loading a datafile prior to loading runs causes runs already analyzed to
-    be excluded.
-    -Upon completion of imageprocessing the loaded data and new data will be
-    merged.
+    -Loading a datafile prior to loading runs causes only new or changed runs
+    to be processed (see imageprocess.process_main incremental mode).
+    -New runs are merged into the loaded data in place as they are processed.
     -This allows easier 'day to day' processing of images, rather than analyzing
     an entire cohort in one batch at the very end of an experiment.
 
 Autosave
-    -App autosaves to pickle upon completion of imageprocessing to prevent data loss.
-    -Both a partial save and merged save are completed in case there is an issue
-    with data merge
+    -App autosaves upon completion of imageprocessing to prevent data loss.
+    -Autosaves append only the new runs and logs to a single HDF5 store in
+    the target directory, rather than writing the whole cohort each time.
 
 Created on Wed Aug  7 13:50:39 2024
 
@@ -39,10 +38,7 @@ Created on Wed Aug  7 13:50:39 2024
 
 from MSPhotom.inspectiontools import MSPInspector, MonitoredClass
 from MSPhotom import MSPApp
-from MSPhotom.data import DataManager
 from MSPhotom.analysis import imageprocess
-from copy import deepcopy
-from datetime import datetime
 import threading
 
 
@@ -56,7 +52,7 @@ def main():
 
 def trigger_on_run_call(self):
     self.view.root.title("MSPhotomApp - REMIXED!!! Use at own risk")
-    self.data_old = deepcopy(self.data)
+    self._remix_runs_done = []
     print(__doc__)
     return None
 
@@ -69,7 +65,6 @@ def trigger_on_data_load_return(self: MSPApp, *result):
     runs_done = [f'{run.split("/")[-2]}/{run.split("/")[-1]}'
                  for run in runs_done]
     self._remix_runs_done = runs_done
-    self.data_old = deepcopy(self.data)
     self.view.update_state('IP - Parameter Entry')
     print(f'This file contains {len(runs_done)} runs')
     print(*runs_done, sep='\n')
@@ -79,50 +74,33 @@ def trigger_on_data_load_return(self: MSPApp, *result):
 def trigger_on_load_runs_return(self, *result):
     if self._remix_runs_done == []:
         return result
-    runs_done = self._remix_runs_done
-    new_runs = [run for run in self.data.run_path_list if
-                all([old_run not in run for old_run in runs_done])]
-    self.data.run_path_list = new_runs
-    filetree_entries = [(path.split('/')[-2], path.split('/')[-1])
-                        for path in new_runs]
-    # Update View
-    self.view.updatefiletreedisplay(filetree_entries)
+    new_runs = imageprocess.find_changed_runs(self.data)
+    # Keep the previously loaded fiber selection
     self.view.update_state('IP - Ready to Process')
     self.view.image_tab.regselbutton.config(state='disabled')
-    print(f'Identified {len(new_runs)} new runs:')
+    print(f'Identified {len(new_runs)} new or changed runs:')
     print(*new_runs, sep='\n')
-    print("""Previously analyzed runs were removed.
-          Inspect the filetree or terminal to ensure new runs are detected""")
+    print("""Previously analyzed runs will be skipped.
+          Inspect the terminal to ensure new runs are detected""")
+    return result
+
 
 def processimages_remix(self):
     """
-    Update view and start image processing in another thread
+    Update view and start incremental image processing in another thread
     """
-    def autosave_wrapper(data, controller):
-        imageprocess.process_main(data, controller)
-        now = datetime.now()
-        timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-        manage = DataManager(data)
-        manage.save(f'autosave_partial_{timestamp}')
-        merged_data = merge_data(data, controller.data_old)
-        manage = DataManager(merged_data)
-        manage.save(f'autosave_merged_{timestamp}')
-        controller.data = merged_data
     # Update View
     self.view.update_state('IP - Processing Images')
+    threaded = self.view.image_tab.threading_enabled.get() == 1
     # Create and initialize the thread for image loading/processing
-    pross_thread = threading.Thread(target=autosave_wrapper,
+    pross_thread = threading.Thread(target=imageprocess.process_main,
                                     args=(self.data,
-                                          self),
+                                          self,
+                                          threaded),
+                                    kwargs={'incremental': True},
                                     daemon=True)
     pross_thread.start()
 
-def merge_data(data, old_data):
-    data.run_path_list = [*old_data.run_path_list, *data.run_path_list]
-    data.traces_raw_by_run_reg = {**old_data.traces_raw_by_run_reg,
-                                  **data.traces_raw_by_run_reg}
-    data.traces_by_run_signal_trial = {**old_data.traces_by_run_signal_trial,
-                                       **data.traces_by_run_signal_trial}
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -5,6 +5,10 @@ Created on Tue Jul  2 15:09:43 2024
 @author: mbmad
 """
 
+import multiprocessing
 import MSPhotom
 
-MSPhotom.main.MSPApp().run()
+if __name__ == '__main__':
+    # Required for the process pool extraction mode in frozen executables
+    multiprocessing.freeze_support()
+    MSPhotom.main.MSPApp().run()
@@ -9,8 +9,6 @@ hidden_imports = [
     'matplotlib.backends.backend_tkagg',
     'concurrent.futures',
     'numpy',
-    'asyncio',
-    'nest_asyncio',
     'h5py',
     'cv2'
 ]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Compare per-frame ROI reduction with batched matrix product reduction on
+synthetic frames, to find the batch size from which batching stays faster
+and the fastest batch size. Decoding is excluded, frames are generated in memory.
+"""
+import sys
+import time
+import numpy as np
+sys.path.append(".")
+from MSPhotom.analysis.imageprocess import RoiExtractor, npy_circlemask
+
+FRAME_SHAPE = (424, 424)
+NUM_FRAMES = 512
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64, 128)
+CENTERS = [(60, 60), (200, 210), (230, 200), (300, 100), (100, 300),
+           (350, 350), (212, 60)]
+
+
+def make_masks(radius):
+    return [npy_circlemask(FRAME_SHAPE[1], FRAME_SHAPE[0], cx, cy, radius)
+            for cx, cy in CENTERS]
+
+
+def time_per_frame(func, repeats=3):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best / NUM_FRAMES * 1e6
+
+
+def main():
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 4000, size=(NUM_FRAMES,) + FRAME_SHAPE,
+                          dtype=np.uint16)
+    means = np.empty((NUM_FRAMES, len(CENTERS)))
+    for radius in (5, 20, 60):
+        extractor = RoiExtractor(make_masks(radius))
+
+        def per_frame():
+            for ind, frame in enumerate(frames):
+                extractor.extract(frame, out=means[ind])
+
+        baseline = time_per_frame(per_frame)
+        print(f'ROI radius {radius} px, {extractor.indices.size} ROI pixels')
+        print(f'  per-frame      {baseline:8.2f} us/frame')
+        elapsed_by_size = {}
+        for batch_size in BATCH_SIZES:
+            def batched():
+                for start in range(0, NUM_FRAMES, batch_size):
+                    extractor.extract_batch(frames[start:start + batch_size],
+                                            out=means[start:start + batch_size])
+
+            elapsed = elapsed_by_size[batch_size] = time_per_frame(batched)
+            print(f'  batch {batch_size:<8d} {elapsed:8.2f} us/frame '
+                  f'({baseline / elapsed:4.2f}x)')
+        # Smallest batch size such that it and every larger one beat
+        # per-frame reduction, a single fast size is not a crossover
+        crossover = None
+        for batch_size in reversed(BATCH_SIZES):
+            if elapsed_by_size[batch_size] >= baseline:
+                break
+            crossover = batch_size
+        best = min(elapsed_by_size, key=elapsed_by_size.get)
+        print(f'  batching stays faster from batch size {crossover or "never"}')
+        if elapsed_by_size[best] < baseline:
+            print(f'  fastest batch size {best} '
+                  f'({baseline / elapsed_by_size[best]:4.2f}x)')
+        else:
+            print('  per-frame reduction is fastest')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark regression_main on synthetic cohorts with known ground truth.
+
+Each cohort follows the model of regression_test2.py: every channel sees a
+slow laser fluctuation, also recorded by the correction fiber, every
+region sees motion artifact peaks on all of its channels, and channels
+other than ch0 carry the true signal peaks of the region on top. The
+correction fiber regression removes the laser fluctuation and the ch0
+regression removes the motion, so the regressed traces should recover the
+true signal. Throughput, peak memory and the correlation of the recovered
+traces with the truth are reported for each scale.
+
+Runs headless, e.g.
+    python tests/regression_benchmark.py --runs 4 --trials 120 --samples 200
+    python tests/regression_benchmark.py --trials 400 --dropped-frames 8
+"""
+import sys
+import time
+import argparse
+import tracemalloc
+from dataclasses import dataclass
+import numpy as np
+sys.path.append(".")
+from MSPhotom.data import MSPData
+from MSPhotom.analysis.regression import regression_main
+
+PEAK_HEIGHT = 10
+NOISE_LEVEL = 0.05
+
+
+@dataclass
+class CohortScale:
+    runs: int = 2
+    regions: int = 2
+    channels: int = 2
+    trials: int = 40
+    samples: int = 100
+    bin_size: int = 10
+    # Frames per run that failed to load, NaN in every trace
+    dropped_frames: int = 0
+
+    @property
+    def num_samples(self):
+        """
+        Samples of every signal and run, the input size of the regression.
+        """
+        return (self.runs * (self.regions + 1) * self.channels
+                * self.trials * self.samples)
+
+
+def sig_s(num_points, const):
+    """
+    Slow sinusoidal laser fluctuation.
+    """
+    time = np.arange(num_points)
+    return np.sin(const * np.pi * time / num_points)
+
+
+def randpeaks(num_points, num_peaks, rng, height=PEAK_HEIGHT):
+    """
+    Trace of zeros with num_peaks peaks at random samples.
+    """
+    trace = np.zeros(num_points)
+    trace[rng.integers(0, num_points, num_peaks)] = height
+    return trace
+
+
+def synthetic_cohort(scale, seed=0):
+    """
+    Generate the traces of a cohort with their ground truth.
+
+    Parameters
+    ----------
+    scale : CohortScale
+        Size of the cohort.
+    seed : int, optional
+        Seed of the random generator.
+
+    Returns
+    -------
+    traces_by_run_signal_trial : dict
+        Traces keyed by run and 'sig_{region}_ch{n}', (trial, sample)
+        arrays as produced by process_main.
+    truth_by_run_region : dict
+        True signal keyed by run and region, (trial, sample) arrays.
+    """
+    rng = np.random.default_rng(seed)
+    num_points = scale.trials * scale.samples
+    num_peaks = max(num_points // 30, 1)
+    channels = [f'ch{ind}' for ind in range(scale.channels)]
+    regions = [f'region{ind}' for ind in range(scale.regions)]
+
+    def trials(trace):
+        noise = rng.normal(0, NOISE_LEVEL, num_points)
+        return (trace + noise).reshape(scale.trials, scale.samples)
+
+    traces_by_run_signal_trial = {}
+    truth_by_run_region = {}
+    for run in range(scale.runs):
+        laser_fluct = {channel: sig_s(num_points, 4 + ind + run)
+                       for ind, channel in enumerate(channels)}
+        traces = {f'sig_corrsig_{channel}': trials(laser_fluct[channel])
+                  for channel in channels}
+        truth = {}
+        for region in regions:
+            motion = randpeaks(num_points, num_peaks, rng)
+            true_sig = randpeaks(num_points, num_peaks, rng)
+            truth[region] = true_sig.reshape(scale.trials, scale.samples)
+            for channel in channels:
+                trace = laser_fluct[channel] + motion
+                if channel != 'ch0':
+                    trace = trace + true_sig
+                traces[f'sig_{region}_{channel}'] = trials(trace)
+        dropped = rng.choice(num_points, scale.dropped_frames, replace=False)
+        for trace in traces.values():
+            trace.reshape(-1)[dropped] = np.nan
+        traces_by_run_signal_trial[f'run{run}'] = traces
+        truth_by_run_region[f'run{run}'] = truth
+    return traces_by_run_signal_trial, truth_by_run_region
+
+
+def recovery_scores(regressed_by_run, truth_by_run_region):
+    """
+    Correlation of each regressed trace with the true signal of its region.
+
+    Returns
+    -------
+    dict
+        Correlations keyed by (run, '{region}_{channel}').
+    """
+    scores = {}
+    for run, regressed in regressed_by_run.items():
+        for key, trace in regressed.items():
+            region = key.rsplit('_', 1)[0]
+            # Regressed traces are (sample, trial)
+            recovered = trace.T.ravel()
+            truth = truth_by_run_region[run][region].ravel()
+            valid = np.isfinite(recovered)
+            scores[run, key] = np.corrcoef(recovered[valid], truth[valid])[0, 1]
+    return scores
+
+
+def benchmark(scale, seed=0, max_workers=1, online=False, precision='float64'):
+    """
+    Regress a synthetic cohort with regression_main.
+
+    Returns
+    -------
+    dict
+        'seconds', 'samples_per_second', 'peak_bytes' of the regression,
+        and 'min_score', the worst correlation of a regressed trace with
+        the truth. Peak memory is traced in this process only, so it
+        excludes the workers when max_workers > 1.
+    """
+    traces_by_run_signal_trial, truth = synthetic_cohort(scale, seed)
+    data = MSPData(traces_by_run_signal_trial=traces_by_run_signal_trial,
+                   precision=precision)
+    data.bin_size = scale.bin_size
+    tracemalloc.start()
+    start = time.perf_counter()
+    regressed = regression_main(data, max_workers=max_workers,
+                                progress=lambda *args: None, online=online)
+    seconds = time.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    scores = recovery_scores(regressed, truth)
+    return {'seconds': seconds,
+            'samples_per_second': scale.num_samples / seconds,
+            'peak_bytes': peak_bytes,
+            'min_score': min(scores.values())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    defaults = CohortScale()
+    for name in ('runs', 'regions', 'channels', 'trials', 'samples', 'bin_size',
+                 'dropped_frames'):
+        parser.add_argument(f'--{name.replace("_", "-")}', type=int,
+                            default=getattr(defaults, name))
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--online', action='store_true')
+    parser.add_argument('--precision', default='float64')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-score', type=float, default=0.9,
+                        help='Fail when a regressed trace correlates less '
+                             'with the truth')
+    args = parser.parse_args(argv)
+    scale = CohortScale(args.runs, args.regions, args.channels, args.trials,
+                        args.samples, args.bin_size, args.dropped_frames)
+    result = benchmark(scale, args.seed, args.workers, args.online,
+                       args.precision)
+    print(f'{scale}')
+    print(f'  {result["seconds"]:8.3f} s, '
+          f'{result["samples_per_second"] / 1e6:8.2f} M samples/s, '
+          f'peak {result["peak_bytes"] / 1024**2:8.1f} MiB')
+    print(f'  worst correlation with ground truth {result["min_score"]:.3f}')
+    return 0 if result['min_score'] >= args.min_score else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
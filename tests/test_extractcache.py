@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the extraction cache only recomputes changed images and masks
+"""
+import os
+import numpy as np
+from PIL import Image
+from MSPhotom.analysis.extractcache import ExtractionCache
+from MSPhotom.analysis.imageprocess import npy_circlemask, process_run
+
+
+def _write_run(run_path, num, seed=0):
+    os.makedirs(run_path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for ind in range(num):
+        path = f'{run_path}/img_{ind}.tif'
+        frame = rng.integers(0, 4000, size=(48, 48), dtype=np.uint16)
+        Image.fromarray(frame).save(path)
+        paths.append(path)
+    return paths
+
+
+class _CountingExtract:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, img_paths, masks):
+        self.calls.append((len(img_paths), len(masks)))
+        return process_run(img_paths, masks)
+
+
+def _masks(radius=8):
+    return [npy_circlemask(48, 48, 10, 10, 6),
+            npy_circlemask(48, 48, 30, 30, radius)]
+
+
+def test_cache_skips_unchanged(tmp_path):
+    run_path = f'{tmp_path}/01-01-24/ANI 1 Run 1'
+    paths = _write_run(run_path, 6)
+    cache = ExtractionCache.for_dataset(str(tmp_path))
+    expected, expected_times = process_run(paths, _masks())
+
+    extract = _CountingExtract()
+    traces_raw, mod_times = cache.process(run_path, paths, _masks(), extract)
+    assert extract.calls == [(6, 2)]
+    np.testing.assert_array_equal(np.array(traces_raw), np.array(expected))
+    np.testing.assert_array_equal(mod_times, expected_times)
+
+    extract = _CountingExtract()
+    traces_raw, mod_times = cache.process(run_path, paths, _masks(), extract)
+    assert extract.calls == []
+    np.testing.assert_array_equal(np.array(traces_raw), np.array(expected))
+    np.testing.assert_array_equal(mod_times, expected_times)
+
+
+def test_cache_recomputes_changed_mask_and_image(tmp_path):
+    run_path = f'{tmp_path}/run'
+    paths = _write_run(run_path, 5)
+    cache = ExtractionCache(f'{tmp_path}/cache')
+    cache.process(run_path, paths, _masks(), _CountingExtract())
+
+    extract = _CountingExtract()
+    traces_raw, _ = cache.process(run_path, paths, _masks(radius=5), extract)
+    assert extract.calls == [(5, 1)]
+    expected, _ = process_run(paths, _masks(radius=5))
+    np.testing.assert_array_equal(np.array(traces_raw), np.array(expected))
+
+    frame = np.full((48, 48), 7, dtype=np.uint16)
+    Image.fromarray(frame).save(paths[2])
+    os.utime(paths[2], ns=(0, 10**18))
+    extract = _CountingExtract()
+    traces_raw, _ = cache.process(run_path, paths, _masks(radius=5), extract)
+    assert extract.calls == [(1, 2)]
+    assert traces_raw[0][2] == 7
+
+
+def test_cache_eviction(tmp_path):
+    cache = ExtractionCache(f'{tmp_path}/cache', max_bytes=1)
+    for run in range(3):
+        run_path = f'{tmp_path}/run{run}'
+        paths = _write_run(run_path, 3, seed=run)
+        cache.process(run_path, paths, _masks(), _CountingExtract())
+    entries = [name for name in os.listdir(cache.cache_dir)
+               if name.endswith('.json')]
+    assert len(entries) == 1
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Measure allocations of the extraction loop with tracemalloc
+"""
+import tracemalloc
+import numpy as np
+from PIL import Image
+from MSPhotom.analysis.imageprocess import (RoiExtractor, TiffFrameReader,
+                                            fiber_masks_from_coords,
+                                            process_run)
+
+FRAME_SHAPE = (424, 424)
+FIBER_COORDS = [(10, 10, 90, 90), (150, 150, 250, 250), (200, 180, 300, 280),
+                (300, 40, 400, 140), (40, 300, 140, 400), (300, 300, 400, 400)]
+
+
+def _write_frames(tmp_path, num):
+    rng = np.random.default_rng(0)
+    paths = []
+    for ind in range(num):
+        path = f'{tmp_path}/img_{ind}.tif'
+        frame = rng.integers(0, 4000, size=FRAME_SHAPE, dtype=np.uint16)
+        Image.fromarray(frame).save(path)
+        paths.append(path)
+    return paths
+
+
+def _traced_peak(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_extraction_loop_does_not_allocate_frames(tmp_path):
+    paths = _write_frames(tmp_path, 40)
+    masks = fiber_masks_from_coords(FIBER_COORDS, FRAME_SHAPE)
+    extractor = RoiExtractor(masks)
+    reader = TiffFrameReader(paths[0])
+    frame_buffer = reader.new_buffer()
+    traces = np.full((len(masks), len(paths)), np.nan)
+    # Warm up, the first frame of each dtype allocates the gather buffer
+    extractor.extract(reader.read(paths[0], out=frame_buffer), out=traces[:, 0])
+
+    def loop():
+        for ind, path in enumerate(paths):
+            extractor.extract(reader.read(path, out=frame_buffer),
+                              out=traces[:, ind])
+
+    peak = _traced_peak(loop)
+    # Well below a single frame for the whole run
+    assert peak < frame_buffer.nbytes / 10
+    expected = [[np.asarray(Image.open(path))[mask].mean() for path in paths]
+                for mask in masks]
+    np.testing.assert_allclose(traces, expected, rtol=1e-12)
+
+
+def test_process_run_memory_independent_of_length(tmp_path):
+    paths = _write_frames(tmp_path, 60)
+    masks = fiber_masks_from_coords(FIBER_COORDS, FRAME_SHAPE)
+    process_run(paths[:2], masks)
+    short_peak = _traced_peak(process_run, paths[:20], masks)
+    long_peak = _traced_peak(process_run, paths, masks)
+    # Only the trace outputs may grow with the number of frames
+    per_frame = (long_peak - short_peak) / 40
+    assert per_frame < 1024
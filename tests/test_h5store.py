@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Check the HDF5 store round trip and its lazy per-run loading
+"""
+import copy
+import pickle
+import time
+import numpy as np
+import h5py
+import pytest
+from MSPhotom.data import MSPData, DataManager
+from MSPhotom.h5store import (H5Mapping, encode_key, open_h5store, save_h5store,
+                              append_h5store, export_h5, load_h5, PENDING_RECORD)
+
+
+def make_data(num_runs=3, num_trials=8, imgptrial=20, seed=0):
+    rng = np.random.default_rng(seed)
+    runs = [f'C:/data/01-0{ind + 1}-24/ANI {ind} Run 1' for ind in range(num_runs)]
+    signals = [f'sig_{region}_ch{ch}' for region in ('corrsig', 'A') for ch in range(2)]
+    data = MSPData(target_directory='C:/data', img_prefix='img',
+                   img_per_trial_per_channel=imgptrial, num_interpolated_channels=2,
+                   run_path_list=runs, img_date_range=('01-01-24', '01-03-24'),
+                   fiber_labels=['Background Fiber', 'Correction Fiber', 'A'],
+                   fiber_coords=[(0, 0, 20, 20), (30, 10, 50, 30), (50, 30, 74, 54)],
+                   fiber_masks={'A': rng.random((64, 80)) < 0.1,
+                                'A/B 50%': rng.random((64, 80)) < 0.1},
+                   traces_raw_by_run_reg={run: rng.normal(size=(3, 2 * imgptrial * num_trials))
+                                          for run in runs},
+                   source_image_modification_times_by_run={
+                       run: np.arange(2 * imgptrial * num_trials, dtype=float) for run in runs},
+                   traces_by_run_signal_trial={
+                       run: {signal: rng.normal(size=(num_trials, imgptrial))
+                             for signal in signals} for run in runs},
+                   logs=['created'])
+    # Results of the first run only
+    data.regressed_traces_by_run_signal_trial = {
+        runs[0]: {'A_ch1': rng.normal(size=(imgptrial, num_trials))}}
+    data.bin_size = 4
+    return data
+
+
+def assert_same_data(loaded, data):
+    for name, value in data.__dict__.items():
+        loaded_value = getattr(loaded, name)
+        if isinstance(value, dict):
+            assert list(loaded_value) == list(value)
+            for key, item in value.items():
+                if isinstance(item, dict):
+                    assert list(loaded_value[key]) == list(item)
+                    for signal, trace in item.items():
+                        np.testing.assert_array_equal(loaded_value[key][signal], trace)
+                else:
+                    np.testing.assert_array_equal(loaded_value[key], item)
+        else:
+            assert loaded_value == value, name
+
+
+def test_round_trip(tmp_path):
+    data = make_data()
+    path = tmp_path / 'cohort.h5'
+    save_h5store(data, path)
+    loaded = open_h5store(path)
+    assert_same_data(loaded, data)
+    assert loaded.corrsig_reg_results is None
+    assert isinstance(loaded.img_date_range, tuple)
+    assert isinstance(loaded.fiber_coords[0], tuple)
+
+
+def test_runs_are_groups_of_compressed_datasets(tmp_path):
+    data = make_data()
+    path = tmp_path / 'cohort.h5'
+    save_h5store(data, path)
+    with h5py.File(path, 'r') as file:
+        # Run paths hold '/', they must not create nested groups
+        assert len(file['runs']) == 3
+        group = file['runs'][encode_key(data.run_path_list[0])]
+        assert group.attrs['key'] == data.run_path_list[0]
+        dataset = group['traces_by_run_signal_trial']['sig_A_ch1']
+        assert dataset.chunks is not None and dataset.compression == 'gzip'
+
+
+def test_open_is_lazy(tmp_path):
+    data = make_data()
+    path = tmp_path / 'cohort.h5'
+    DataManager(data).save(str(path))
+    loaded = DataManager(None).load(str(path))
+    traces = loaded.traces_by_run_signal_trial
+    assert isinstance(traces, H5Mapping)
+    assert list(traces) == data.run_path_list
+    assert not any(traces.is_loaded(run) for run in traces)
+    second = data.run_path_list[1]
+    np.testing.assert_array_equal(traces[second]['sig_A_ch0'],
+                                  data.traces_by_run_signal_trial[second]['sig_A_ch0'])
+    assert [traces.is_loaded(run) for run in traces] == [False, True, False]
+    # Edits stay in memory, the store is unchanged
+    del traces[second]
+    traces['new'] = {}
+    assert list(traces) == [data.run_path_list[0], data.run_path_list[2], 'new']
+    assert list(open_h5store(path).traces_by_run_signal_trial) == data.run_path_list
+
+
+def test_membership_does_not_read_entries(tmp_path):
+    data = make_data()
+    path = tmp_path / 'cohort.h5'
+    save_h5store(data, path)
+    traces = open_h5store(path).traces_raw_by_run_reg
+    assert data.run_path_list[0] in traces and 'other' not in traces
+    assert not any(traces.is_loaded(run) for run in data.run_path_list)
+    loaded = open_h5store(path)
+    save_h5store(loaded, tmp_path / 'copy.h5')
+    for field_name in ('traces_raw_by_run_reg', 'traces_by_run_signal_trial'):
+        mapping = getattr(loaded, field_name)
+        assert not any(mapping.is_loaded(run) for run in mapping)
+
+
+def test_raw_trace_lists_stay_lists(tmp_path):
+    data = make_data()
+    # Raw traces are lists of per-ROI traces, tracefix.insert can make
+    # them differ in length
+    raw = {run: [trace[:-ind] if ind else trace for ind, trace in enumerate(traces)]
+           for run, traces in data.traces_raw_by_run_reg.items()}
+    data.traces_raw_by_run_reg = raw
+    path = tmp_path / 'cohort.h5'
+    save_h5store(data, path)
+    loaded = open_h5store(path).traces_raw_by_run_reg
+    for run, traces in raw.items():
+        assert type(loaded[run]) is list
+        assert len(loaded[run]) == len(traces)
+        for trace, expected in zip(loaded[run], traces):
+            np.testing.assert_array_equal(trace, expected)
+
+
+def test_lazy_data_pickles_and_saves_in_full(tmp_path):
+    data = make_data()
+    path = tmp_path / 'cohort.h5'
+    save_h5store(data, path)
+    loaded = open_h5store(path)
+    unpickled = pickle.loads(pickle.dumps(loaded))
+    assert type(unpickled.traces_raw_by_run_reg) is dict
+    assert_same_data(unpickled, data)
+    assert type(copy.deepcopy(loaded.fiber_masks)) is dict
+    # Saving a lazily opened store over itself
+    loaded.logs.append('resaved')
+    save_h5store(loaded, path)
+    data.logs.append('resaved')
+    assert_same_data(open_h5store(path), data)
+
+
+def test_open_reads_only_metadata(tmp_path):
+    data = make_data(num_runs=200, num_trials=100, imgptrial=100)
+    path = tmp_path / 'cohort.h5'
+    save_h5store(data, path, compression=None)
+    start = time.perf_counter()
+    loaded = open_h5store(path)
+    elapsed = time.perf_counter() - start
+    assert len(loaded.traces_by_run_signal_trial) == 200
+    assert elapsed < 1
+
+
+def test_not_a_store(tmp_path):
+    path = tmp_path / 'other.h5'
+    with h5py.File(path, 'w') as file:
+        file.create_dataset('x', data=np.arange(3))
+    with pytest.raises(ValueError):
+        open_h5store(path)
+
+
+def test_append_writes_only_changes(tmp_path):
+    data = make_data()
+    path = tmp_path / 'autosave.h5'
+    journal = append_h5store(data, path)
+    assert journal.records == 0
+    # Nothing changed, nothing is written
+    assert append_h5store(data, path, journal) is journal
+    assert journal.records == 0
+    rng = np.random.default_rng(1)
+    new_run = 'C:/data/01-04-24/ANI 3 Run 1'
+    data.run_path_list.append(new_run)
+    data.traces_raw_by_run_reg[new_run] = rng.normal(size=(3, 320))
+    data.traces_by_run_signal_trial[new_run] = {'sig_A_ch0': rng.normal(size=(8, 20))}
+    data.regressed_traces_by_run_signal_trial[data.run_path_list[1]] = {
+        'A_ch1': rng.normal(size=(20, 8))}
+    del data.source_image_modification_times_by_run[data.run_path_list[0]]
+    data.log('processed')
+    data.bin_size = 5
+    append_h5store(data, path, journal)
+    assert journal.records == 1
+    with h5py.File(path, 'r') as file:
+        record = file['journal']['00000000']
+        assert sorted(record['runs']) == sorted(encode_key(run) for run in
+                                                data.run_path_list[1:4:2])
+        assert 'fiber_masks' not in record
+        assert len(file['runs']) == 3
+    assert_same_data(open_h5store(path), data)
+    # Later records replay over the earlier ones
+    data.traces_raw_by_run_reg[new_run] = rng.normal(size=(3, 320))
+    data.corrsig_reg_results = {new_run: {'A_ch0': rng.normal(size=(20, 8))}}
+    data.log('regressed')
+    append_h5store(data, path, journal)
+    assert journal.records == 2
+    loaded = open_h5store(path)
+    assert_same_data(loaded, data)
+    assert list(loaded.traces_raw_by_run_reg)[-1] == new_run
+
+
+def test_append_rewrites_when_needed(tmp_path):
+    data = make_data()
+    path = tmp_path / 'autosave.h5'
+    journal = append_h5store(data, path)
+    data.traces_raw_by_run_reg[data.run_path_list[0]] = np.zeros((3, 320))
+    journal = append_h5store(data, path, journal, max_records=1)
+    data.traces_raw_by_run_reg[data.run_path_list[1]] = np.zeros((3, 320))
+    journal = append_h5store(data, path, journal, max_records=1)
+    assert journal.records == 0
+    with h5py.File(path, 'r') as file:
+        assert 'journal' not in file
+    assert_same_data(open_h5store(path), data)
+
+
+def test_append_never_drops_stored_logs(tmp_path):
+    data = make_data()
+    path = tmp_path / 'autosave.h5'
+    journal = append_h5store(data, path)
+    logs = list(data.logs)
+    data.logs = ['reset', 'reset']
+    journal = append_h5store(data, path, journal)
+    assert journal.records == 1
+    assert open_h5store(path).logs == logs + ['reset', 'reset']
+
+
+def test_new_session_merges_into_the_store(tmp_path):
+    rng = np.random.default_rng(1)
+    path = tmp_path / 'autosave.h5'
+    first = make_data()
+    append_h5store(first, path)
+    # A later session autosaves other runs to the same path
+    second = make_data()
+    second.run_path_list = ['day2/run1']
+    second.traces_raw_by_run_reg = {'day2/run1': rng.normal(size=(3, 320))}
+    second.traces_by_run_signal_trial = None
+    second.logs = ['day 2']
+    journal = append_h5store(second, path)
+    assert journal.records == 1
+    loaded = open_h5store(path)
+    assert loaded.run_path_list == ['day2/run1'] + first.run_path_list
+    assert loaded.logs == first.logs + ['day 2']
+    for run in first.run_path_list:
+        np.testing.assert_array_equal(loaded.traces_raw_by_run_reg[run],
+                                      first.traces_raw_by_run_reg[run])
+        assert loaded.traces_by_run_signal_trial[run].keys() == \
+            first.traces_by_run_signal_trial[run].keys()
+    np.testing.assert_array_equal(loaded.traces_raw_by_run_reg['day2/run1'],
+                                  second.traces_raw_by_run_reg['day2/run1'])
+    # Only runs of this session are deleted from the store
+    del second.traces_raw_by_run_reg['day2/run1']
+    append_h5store(second, path, journal)
+    loaded = open_h5store(path)
+    assert 'day2/run1' not in loaded.traces_raw_by_run_reg
+    assert list(loaded.traces_raw_by_run_reg) == first.run_path_list
+
+
+def test_reset_then_autosave_keeps_earlier_runs(tmp_path):
+    rng = np.random.default_rng(2)
+    path = tmp_path / 'autosave.h5'
+    data = MSPData()
+    data.run_path_list = ['x/r1', 'x/r2']
+    data.traces_raw_by_run_reg = {run: rng.normal(size=(3, 320))
+                                  for run in data.run_path_list}
+    journal = append_h5store(data, path)
+    # The data is replaced, as by a reset, and the journal passed along
+    data = MSPData()
+    data.run_path_list = ['x/r3']
+    data.traces_raw_by_run_reg = {'x/r3': rng.normal(size=(3, 320))}
+    append_h5store(data, path, journal)
+    loaded = open_h5store(path)
+    assert sorted(loaded.traces_raw_by_run_reg) == ['x/r1', 'x/r2', 'x/r3']
+
+
+def test_rewrite_keeps_unread_entries_readable(tmp_path):
+    data = make_data()
+    path = tmp_path / 'autosave.h5'
+    journal = append_h5store(data, path)
+    data.fiber_masks = {**data.fiber_masks, 'bg': np.ones((4, 4), bool)}
+    append_h5store(data, path, journal)
+    loaded = open_h5store(path)
+    # Saving over the store removes the journal the entries were read from
+    DataManager(loaded).save(str(path))
+    np.testing.assert_array_equal(loaded.fiber_masks['bg'], np.ones((4, 4), bool))
+    assert_same_data(loaded, data)
+    # Compacting the store once the journal is full as well
+    loaded = open_h5store(path)
+    journal = append_h5store(loaded, path)
+    loaded.fiber_masks['extra'] = np.zeros((4, 4), bool)
+    append_h5store(loaded, path, journal, max_records=1)
+    with h5py.File(path, 'r') as file:
+        assert 'journal' not in file
+    data.fiber_masks['extra'] = np.zeros((4, 4), bool)
+    assert_same_data(loaded, data)
+    assert_same_data(open_h5store(path), data)
+
+
+def test_interrupted_append_is_ignored(tmp_path):
+    data = make_data()
+    path = tmp_path / 'autosave.h5'
+    journal = append_h5store(data, path)
+    with h5py.File(path, 'a') as file:
+        file.create_group(PENDING_RECORD).attrs['fields'] = 'truncated'
+    assert_same_data(open_h5store(path), data)
+    data.log('processed')
+    append_h5store(data, path, journal)
+    with h5py.File(path, 'r') as file:
+        assert PENDING_RECORD not in file
+    assert_same_data(open_h5store(path), data)
+
+
+def test_append_to_lazily_opened_store(tmp_path):
+    data = make_data()
+    path = tmp_path / 'autosave.h5'
+    save_h5store(data, path)
+    loaded = open_h5store(path)
+    journal = append_h5store(loaded, path)
+    first = data.run_path_list[0]
+    loaded.traces_raw_by_run_reg[first] = data.traces_raw_by_run_reg[first] + 1
+    append_h5store(loaded, path, journal)
+    with h5py.File(path, 'r') as file:
+        assert list(file['journal']['00000000']['runs']) == [encode_key(first)]
+    data.traces_raw_by_run_reg[first] = data.traces_raw_by_run_reg[first] + 1
+    assert_same_data(open_h5store(path), data)
+
+
+def test_export_round_trip(tmp_path):
+    data = make_data()
+    data.corrsig_reg_results = {data.run_path_list[0]: {'A_ch0': np.ones((20, 8))}}
+    path = tmp_path / 'export.h5'
+    DataManager(data).saveto_h5(str(path))
+    loaded = load_h5(path)
+    assert_same_data(loaded, data)
+    assert loaded.fiber_masks['A'].dtype == bool
+    assert isinstance(loaded.fiber_coords[0], tuple)
+    # The export is recognized when loading any .h5 file
+    assert_same_data(DataManager(None).load(str(path)), data)
+
+
+def test_export_keeps_raw_trace_lists(tmp_path):
+    data = make_data()
+    raw = {run: [trace[:-ind] if ind else trace for ind, trace in enumerate(traces)]
+           for run, traces in data.traces_raw_by_run_reg.items()}
+    data.traces_raw_by_run_reg = raw
+    export_h5(data, tmp_path / 'export.h5')
+    loaded = load_h5(tmp_path / 'export.h5').traces_raw_by_run_reg
+    for run, traces in raw.items():
+        assert type(loaded[run]) is list
+        for trace, expected in zip(loaded[run], traces):
+            np.testing.assert_array_equal(trace, expected)
+
+
+def test_export_layout(tmp_path):
+    data = make_data()
+    path = tmp_path / 'export.h5'
+    export_h5(data, path)
+    with h5py.File(path, 'r') as file:
+        # One group per field, run paths are not nested groups
+        runs = file['traces_raw_by_run_reg']
+        assert len(runs) == 3
+        dataset = runs[encode_key(data.run_path_list[0])]
+        assert dataset.attrs['key'] == data.run_path_list[0]
+        assert dataset.chunks is not None and dataset.compression == 'gzip'
+        signals = file['traces_by_run_signal_trial'][encode_key(data.run_path_list[1])]
+        assert list(signals) == ['sig_corrsig_ch0', 'sig_corrsig_ch1', 'sig_A_ch0', 'sig_A_ch1']
+        assert file['fiber_masks'][encode_key('A/B 50%')].dtype == np.uint8
+        assert file['fiber_coords'].shape == (3, 4)
+        assert list(file['logs'].asstr()[()]) == data.logs
+        assert file.attrs['img_per_trial_per_channel'] == 20
+        assert 'corrsig_reg_results' not in file
+
+
+def test_export_of_lazily_opened_store(tmp_path):
+    data = make_data()
+    store = tmp_path / 'cohort.h5'
+    save_h5store(data, store)
+    loaded = open_h5store(store)
+    export_h5(loaded, tmp_path / 'export.h5')
+    assert not any(loaded.traces_raw_by_run_reg.is_loaded(run) for run in data.run_path_list)
+    assert_same_data(load_h5(tmp_path / 'export.h5'), data)
+    with pytest.raises(ValueError):
+        load_h5(store)
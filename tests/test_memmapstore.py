@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Check the memory-mapped store round trip and that loaded arrays share the
+mapping of the store
+"""
+import pickle
+import subprocess
+import sys
+import numpy as np
+import pytest
+from MSPhotom import tracefix
+from MSPhotom.data import DataManager
+from MSPhotom.h5store import open_h5store, save_h5store
+from MSPhotom.memmapstore import load_memmap, save_memmap
+from tests.test_h5store import make_data, assert_same_data
+
+
+def test_round_trip(tmp_path):
+    data = make_data()
+    data.traces_raw_by_run_reg[data.run_path_list[0]] = np.asfortranarray(
+        data.traces_raw_by_run_reg[data.run_path_list[0]]).astype(np.float32)
+    path = tmp_path / 'cohort.npmap'
+    DataManager(data).save(str(path))
+    loaded = DataManager(None).load(str(path))
+    assert_same_data(loaded, data)
+    assert loaded.corrsig_reg_results is None
+    assert isinstance(loaded.fiber_coords[0], tuple)
+    assert loaded.fiber_masks['A'].dtype == bool
+    assert loaded.traces_raw_by_run_reg[data.run_path_list[0]].dtype == np.float32
+
+
+def test_arrays_are_read_only_views_of_the_mapping(tmp_path):
+    data = make_data()
+    path = tmp_path / 'cohort.npmap'
+    save_memmap(data, path)
+    loaded = load_memmap(path)
+    traces = loaded.traces_by_run_signal_trial[data.run_path_list[1]]['sig_A_ch0']
+    assert type(traces) is np.ndarray
+    assert not traces.flags.owndata and not traces.flags.writeable
+    assert isinstance(traces.base.base, np.memmap)
+    with pytest.raises(ValueError):
+        traces[0, 0] = 0
+    # Copy on write views stay private, in memory arrays are writeable
+    private = load_memmap(path, mmap_mode='c').traces_raw_by_run_reg[data.run_path_list[0]]
+    private[0, 0] = 1e9
+    assert load_memmap(path).traces_raw_by_run_reg[data.run_path_list[0]][0, 0] != 1e9
+    in_memory = load_memmap(path, mmap_mode=None)
+    assert in_memory.fiber_masks['A'].flags.writeable
+    assert type(pickle.loads(pickle.dumps(traces))) is np.ndarray
+
+
+def test_raw_trace_lists_stay_lists(tmp_path):
+    data = make_data()
+    raw = {run: [trace[:-ind] if ind else trace for ind, trace in enumerate(traces)]
+           for run, traces in data.traces_raw_by_run_reg.items()}
+    data.traces_raw_by_run_reg = raw
+    path = tmp_path / 'cohort.npmap'
+    save_memmap(data, path)
+    loaded = load_memmap(path).traces_raw_by_run_reg
+    for run, traces in raw.items():
+        assert type(loaded[run]) is list
+        assert len(loaded[run]) == len(traces)
+        for trace, expected in zip(loaded[run], traces):
+            np.testing.assert_array_equal(trace, expected)
+
+
+def test_tracefix_fixes_mapped_traces_in_place(tmp_path):
+    data = make_data()
+    data.traces_raw_by_run_reg = {run: list(traces) for run, traces
+                                  in data.traces_raw_by_run_reg.items()}
+    path = tmp_path / 'cohort.npmap'
+    save_memmap(data, path)
+    fields = tracefix.load(str(path), tracefix.EVALUATE_FIELDS)
+    traces = fields['traces_raw_by_run_reg'][data.run_path_list[0]]
+    tracefix.wipe(traces, (0, 2))
+    tracefix.swap(traces)
+    tracefix.insert(traces, 2, 0)
+    assert len(traces[0]) == 322 and np.isnan(traces[0][0])
+    # The store is left as saved
+    run = data.run_path_list[0]
+    np.testing.assert_array_equal(load_memmap(path).traces_raw_by_run_reg[run][0],
+                                  data.traces_raw_by_run_reg[run][0])
+
+
+def test_resave_keeps_mapped_arrays_valid(tmp_path):
+    data = make_data()
+    path = tmp_path / 'cohort.npmap'
+    save_memmap(data, path)
+    first = load_memmap(path)
+    expected = data.traces_raw_by_run_reg[data.run_path_list[0]].copy()
+    data.traces_raw_by_run_reg[data.run_path_list[0]] = np.zeros_like(expected)
+    save_memmap(data, path)
+    np.testing.assert_array_equal(first.traces_raw_by_run_reg[data.run_path_list[0]],
+                                  expected)
+    assert_same_data(load_memmap(path), data)
+    # Only the binary file of the latest save is left
+    assert len(list(tmp_path.glob('cohort.npmap.*.bin'))) == 1
+
+
+def test_save_lazily_opened_store(tmp_path):
+    data = make_data()
+    save_h5store(data, tmp_path / 'cohort.h5')
+    save_memmap(open_h5store(tmp_path / 'cohort.h5'), tmp_path / 'cohort.npmap')
+    assert_same_data(load_memmap(tmp_path / 'cohort.npmap'), data)
+
+
+def test_other_process_reads_the_store(tmp_path):
+    data = make_data()
+    path = tmp_path / 'cohort.npmap'
+    save_memmap(data, path)
+    run = data.run_path_list[2]
+    script = ('import sys; from MSPhotom.memmapstore import load_memmap; '
+              f'print(load_memmap(sys.argv[1]).traces_raw_by_run_reg[{run!r}].sum())')
+    output = subprocess.run([sys.executable, '-c', script, str(path)],
+                            capture_output=True, text=True, check=True).stdout
+    assert float(output) == pytest.approx(data.traces_raw_by_run_reg[run].sum())
+
+
+def test_not_a_store(tmp_path):
+    path = tmp_path / 'other.npmap'
+    path.write_text('{"format": "other"}')
+    with pytest.raises(ValueError):
+        load_memmap(path)
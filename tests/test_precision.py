@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Check the float32 precision mode against float64.
+
+Stored traces are rounded to float32 while ROI means and regression sums
+are still accumulated in float64, so the only error is the float32
+rounding of inputs and outputs:
+
+- raw traces are within 1e-6 relative of float64, about 8 float32 ulps.
+  Split traces are background subtracted, so their error is bounded
+  relative to the raw traces they come from,
+- studentized residuals are within 1e-3 absolute of float64. Residuals are
+  z-scores of order 1, the bound leaves room for the rounding of the
+  inputs being amplified by the fit of nearly collinear bins.
+"""
+from dataclasses import replace
+import numpy as np
+import pytest
+from MSPhotom.data import MSPData, precision_dtype
+from MSPhotom.analysis.imageprocess import process_main
+from MSPhotom.analysis.regression import regression_main, regress_run
+from tests.test_process_main import make_dataset
+from tests.test_regression import _run_traces
+
+TRACE_RTOL = 1e-6
+RESIDUAL_ATOL = 1e-3
+
+
+def test_unknown_precision_is_rejected():
+    assert precision_dtype('float32') == np.float32
+    with pytest.raises(ValueError):
+        precision_dtype('float16')
+
+
+@pytest.mark.parametrize('mode', ['sync', 'threaded', 'process'])
+def test_float32_extraction_matches_float64(tmp_path, mode):
+    data = make_dataset(tmp_path)
+    single = replace(data, logs=[], precision='float32')
+    process_main(data, mode=mode)
+    process_main(single, mode=mode)
+    for run_path in data.run_path_list:
+        raw = data.traces_raw_by_run_reg[run_path]
+        for trace, expected in zip(single.traces_raw_by_run_reg[run_path], raw):
+            assert trace.dtype == np.float32
+            np.testing.assert_allclose(trace, expected, rtol=TRACE_RTOL)
+        scale = np.nanmax(np.abs(raw))
+        for key, expected in data.traces_by_run_signal_trial[run_path].items():
+            trace = single.traces_by_run_signal_trial[run_path][key]
+            assert trace.dtype == np.float32
+            np.testing.assert_allclose(trace, expected, rtol=0,
+                                       atol=TRACE_RTOL * scale)
+
+
+@pytest.mark.parametrize('online', [False, True])
+def test_float32_regression_matches_float64(online):
+    traces = _run_traces(0, 23, imgptrial=200)[0]
+    expected = regress_run(traces, 5, online)
+    single = {key: trace.astype(np.float32) for key, trace in traces.items()}
+    result = regress_run(single, 5, online)
+    for expected_dict, result_dict in zip(expected, result):
+        assert list(result_dict) == list(expected_dict)
+        for key, value in expected_dict.items():
+            assert result_dict[key].dtype == np.float32
+            np.testing.assert_allclose(result_dict[key], value, rtol=0,
+                                       atol=RESIDUAL_ATOL, equal_nan=True)
+
+
+def test_regression_main_precision():
+    data = MSPData(precision='float32')
+    data.bin_size = 4
+    data.traces_by_run_signal_trial = {'run1': _run_traces(0, 10)[0]}
+    regression_main(data)
+    assert data.corrsig_reg_results['run1']['a_ch0'].dtype == np.float32
+    regression_main(data, precision='float64')
+    assert data.corrsig_reg_results['run1']['a_ch0'].dtype == np.float64
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Check image processing of whole datasets across extraction modes
+"""
+import os
+from dataclasses import replace
+import numpy as np
+import pytest
+from PIL import Image
+from MSPhotom.data import MSPData, DataManager
+from MSPhotom.analysis.imageprocess import (process_main, ProgressTracker,
+                                            find_changed_runs)
+from MSPhotom.analysis.extractcache import ExtractionCache
+
+
+class _Var:
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+
+class _ImageTab:
+    def __init__(self):
+        self.longprog = {}
+        self.runprog = {}
+        self.longprogstat = _Var()
+        self.shortprogstat = _Var()
+        self.speedout = _Var()
+
+
+class _Controller:
+    def __init__(self):
+        self.view = type('View', (), {})()
+        self.view.image_tab = _ImageTab()
+
+
+def make_dataset(root, num_runs=3, num_imgs=12, shape=(64, 80), seed=0):
+    """
+    Write small runs of synthetic uint16 frames and return an MSPData
+    describing them.
+    """
+    rng = np.random.default_rng(seed)
+    run_paths = []
+    for run in range(num_runs):
+        run_path = f'{root}/01-01-24/ANI {run} Run 1'
+        os.makedirs(run_path)
+        for ind in range(num_imgs):
+            frame = rng.integers(0, 4000, size=shape, dtype=np.uint16)
+            Image.fromarray(frame).save(f'{run_path}/img_{ind}.tif')
+        run_paths.append(run_path)
+    return MSPData(target_directory=str(root),
+                   img_prefix='img',
+                   img_per_trial_per_channel=3,
+                   num_interpolated_channels=2,
+                   run_path_list=run_paths,
+                   fiber_labels=['Background Fiber', 'Correction Fiber', 'A'],
+                   fiber_coords=[(0, 0, 20, 20), (30, 10, 50, 30),
+                                 (50, 30, 74, 54)],
+                   logs=[])
+
+
+@pytest.mark.parametrize('mode', ['threaded', 'process'])
+def test_modes_match_sync(tmp_path, mode):
+    data = make_dataset(tmp_path)
+    other = replace(data, logs=[])
+    process_main(data, mode='sync')
+    process_main(other, mode=mode, max_workers=4, max_parallel_runs=2)
+    assert list(other.traces_raw_by_run_reg) == data.run_path_list
+    for run_path in data.run_path_list:
+        np.testing.assert_array_equal(
+            np.array(other.traces_raw_by_run_reg[run_path]),
+            np.array(data.traces_raw_by_run_reg[run_path]))
+        np.testing.assert_array_equal(
+            other.source_image_modification_times_by_run[run_path],
+            data.source_image_modification_times_by_run[run_path])
+    assert data.traces_by_run_signal_trial[data.run_path_list[0]]['sig_A_ch1'].shape == (2, 3)
+    assert data.fiber_masks['A'].shape == (64, 80)
+
+
+def test_progress_aggregates_runs():
+    controller = _Controller()
+    tracker = ProgressTracker(controller, num_runs=2, min_interval=0)
+    first = tracker.start_run('d/run1', 10)
+    second = tracker.start_run('d/run2', 30)
+    first.advance(10)
+    second.advance(10)
+    image_tab = controller.view.image_tab
+    assert image_tab.runprog['value'] == pytest.approx(50)
+    assert image_tab.longprog['value'] == pytest.approx((1 + 1 / 3) / 2 * 100)
+    first.finish()
+    second.advance(20)
+    second.finish()
+    assert image_tab.longprog['value'] == pytest.approx(100)
+    assert image_tab.runprog['value'] == 100
+    assert tracker.images_done == 40
+
+
+def test_cached_reprocessing(tmp_path):
+    data = make_dataset(tmp_path)
+    cache = ExtractionCache.for_dataset(data.target_directory)
+    process_main(data, mode='threaded', cache=cache)
+    again = replace(data, logs=[])
+    process_main(again, mode='process', cache=cache)
+    for run_path in data.run_path_list:
+        np.testing.assert_array_equal(
+            np.array(again.traces_raw_by_run_reg[run_path]),
+            np.array(data.traces_raw_by_run_reg[run_path]))
+
+
+def test_incremental_processing(tmp_path):
+    data = make_dataset(tmp_path, num_runs=2)
+    process_main(data, mode='sync')
+    first_run = data.run_path_list[0]
+    first_traces = data.traces_raw_by_run_reg[first_run]
+    data.regressed_traces_by_run_signal_trial = {run: {} for run in data.run_path_list}
+
+    # Add a new run and an image to the second run
+    new_run = f'{tmp_path}/01-02-24/ANI 9 Run 1'
+    os.makedirs(new_run)
+    frame = np.full((64, 80), 5, dtype=np.uint16)
+    for ind in range(12):
+        Image.fromarray(frame).save(f'{new_run}/img_{ind}.tif')
+    second_run = data.run_path_list[1]
+    Image.fromarray(frame).save(f'{second_run}/img_12.tif')
+    data.run_path_list = [*data.run_path_list, new_run]
+
+    assert find_changed_runs(data) == [second_run, new_run]
+    process_main(data, mode='sync', incremental=True)
+    assert data.traces_raw_by_run_reg[first_run] is first_traces
+    assert list(data.traces_raw_by_run_reg) == [first_run, second_run, new_run]
+    assert len(data.traces_raw_by_run_reg[second_run][0]) == 13
+    assert list(data.regressed_traces_by_run_signal_trial) == [first_run]
+    assert find_changed_runs(data) == []
+
+
+def test_data_add_is_shallow():
+    trace = np.arange(4.0)
+    first = MSPData(run_path_list=['a'], traces_raw_by_run_reg={'a': [trace]})
+    second = MSPData(run_path_list=['b', 'a'],
+                     traces_raw_by_run_reg={'b': [trace * 2], 'a': [trace * 3]})
+    merged = first + second
+    assert merged.run_path_list == ['a', 'b']
+    assert merged.traces_raw_by_run_reg['a'][0] is trace
+    assert list(merged.traces_raw_by_run_reg) == ['a', 'b']
+
+
+def test_data_add_merges_lazily_opened_store(tmp_path):
+    trace = np.arange(4.0)
+    path = tmp_path / 'old.h5'
+    DataManager(MSPData(run_path_list=['a'],
+                        traces_raw_by_run_reg={'a': [trace]})).save(str(path))
+    old = DataManager(None).load(str(path))
+    new = MSPData(run_path_list=['b'], traces_raw_by_run_reg={'b': [trace * 2]})
+    merged = old + new
+    assert merged.run_path_list == ['a', 'b']
+    assert list(merged.traces_raw_by_run_reg) == ['a', 'b']
+    assert merged.traces_raw_by_run_reg['b'][0] is new.traces_raw_by_run_reg['b'][0]
+    # The runs of the store are still read on demand
+    assert not merged.traces_raw_by_run_reg.is_loaded('a')
+    np.testing.assert_array_equal(merged.traces_raw_by_run_reg['a'][0], trace)
+    assert 'b' not in old.traces_raw_by_run_reg
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Check that regression results are memoized per run and persisted
+"""
+import numpy as np
+from MSPhotom.data import MSPData
+from MSPhotom.analysis.regcache import (RegressionCache, regression_key,
+                                        sidecar_path)
+from MSPhotom.analysis.regression import regression_main
+
+
+def _run_traces(seed, num_trials=10, imgptrial=20):
+    rng = np.random.default_rng(seed)
+    return {f'sig_{region}_{channel}': rng.normal(size=(num_trials, imgptrial))
+            for region in ('corrsig', 'a', 'b') for channel in ('ch0', 'ch1')}
+
+
+def _data(num_runs, bin_size=3):
+    data = MSPData()
+    data.bin_size = bin_size
+    data.traces_by_run_signal_trial = {f'run{ind}': _run_traces(ind)
+                                       for ind in range(num_runs)}
+    return data
+
+
+def test_unchanged_runs_are_served_from_cache():
+    cache = RegressionCache()
+    data = _data(3)
+    regression_main(data, max_workers=1, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 3)
+    expected = data.regressed_traces_by_run_signal_trial
+
+    data.regressed_traces_by_run_signal_trial = None
+    regression_main(data, max_workers=1, cache=cache)
+    assert (cache.hits, cache.misses) == (3, 3)
+    for run_key, regressed in expected.items():
+        for key, value in regressed.items():
+            np.testing.assert_array_equal(
+                data.regressed_traces_by_run_signal_trial[run_key][key], value)
+
+    # Adding a run costs one run of work
+    data.traces_by_run_signal_trial['run3'] = _run_traces(3)
+    regression_main(data, max_workers=1, cache=cache)
+    assert (cache.hits, cache.misses) == (6, 4)
+    assert list(data.corrsig_reg_results) == ['run0', 'run1', 'run2', 'run3']
+
+    # Another bin size is another key
+    data.bin_size = 2
+    regression_main(data, max_workers=1, cache=cache)
+    assert cache.misses == 8
+
+
+def test_key_depends_on_content_and_parameters():
+    traces = _run_traces(0)
+    key = regression_key(traces, 3, 1)
+    assert regression_key({k: v.copy() for k, v in traces.items()}, 3, 1) == key
+    assert regression_key(traces, 4, 1) != key
+    assert regression_key(traces, 3, 2) != key
+    assert regression_key(traces, 3, 1, online=True) != key
+    changed = dict(traces, sig_a_ch0=traces['sig_a_ch0'] + 1e-9)
+    assert regression_key(changed, 3, 1) != key
+
+
+def test_least_recently_used_entries_are_evicted():
+    entry = ({'a': np.zeros(100)}, {'a': np.zeros(100)})
+    cache = RegressionCache(max_bytes=3 * 1600)
+    for key in 'abc':
+        cache.put(key, entry)
+    cache.get('a')
+    cache.put('d', entry)
+    assert 'b' not in cache
+    assert all(key in cache for key in 'acd')
+    assert cache.nbytes <= cache.max_bytes
+
+
+def test_cache_is_saved_alongside_data_file(tmp_path):
+    cache = RegressionCache()
+    data = _data(2)
+    regression_main(data, max_workers=1, cache=cache)
+    path = sidecar_path(str(tmp_path / 'data.pkl'))
+    cache.save(path)
+
+    restored = RegressionCache()
+    assert restored.load(path)
+    assert not RegressionCache().load(str(tmp_path / 'missing.pkl.regcache'))
+    data.regressed_traces_by_run_signal_trial = None
+    regression_main(data, max_workers=1, cache=restored)
+    assert (restored.hits, restored.misses) == (2, 0)
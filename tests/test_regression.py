@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+Check the vectorized studentized residuals against the per-trial loop
+and statsmodels
+"""
+import tracemalloc
+import warnings
+import numpy as np
+import pytest
+from MSPhotom.data import MSPData
+from MSPhotom.analysis import regression
+from MSPhotom.analysis.regression import (bin_trials, bin_views, calculate_studentized_residuals,
+                                          column_validity, debin_me, nan_positions,
+                                          regression_func,
+                                          regression_main, regress_runs,
+                                          regress_run, regress_trials, share_traces,
+                                          sweep_bin_sizes)
+from tests.regression_benchmark import (CohortScale, benchmark, recovery_scores,
+                                        synthetic_cohort)
+
+
+def _loop_studentized_residuals(X, Y):
+    # Per-trial formulation the vectorized function replaced
+    studentized_residuals = np.full(Y.shape, np.nan, dtype=np.float64)
+    for i in range(X.shape[1]):
+        valid_mask = ~np.isnan(X[:, i]) & ~np.isnan(Y[:, i])
+        X_valid = X[valid_mask, i]
+        Y_valid = Y[valid_mask, i]
+        mean_X = np.nanmean(X[:, i])
+        mean_Y = np.nanmean(Y[:, i])
+        n = len(X_valid)
+        diff_mean_sqr = np.dot((X_valid - mean_X), (X_valid - mean_X))
+        beta1 = np.dot((X_valid - mean_X), (Y_valid - mean_Y)) / diff_mean_sqr
+        beta0 = mean_Y - beta1 * mean_X
+        y_hat = beta0 + beta1 * X_valid
+        residuals_valid = Y_valid - y_hat
+        h_ii = (X_valid - mean_X) ** 2 / diff_mean_sqr + (1 / n)
+        MSE = sum((Y_valid - y_hat) ** 2) / (n - 2)
+        SE_regression = ((MSE * (1 - h_ii)) ** 0.5)
+        r = np.where(SE_regression != 0, residuals_valid / SE_regression, 0)
+        n = len(r)
+        studentized_residuals[valid_mask, i] = [
+            r_i * np.sqrt((n - 2 - 1) / (n - 2 - r_i ** 2)) for r_i in r]
+    return studentized_residuals
+
+
+def _traces(seed, samples=200, trials=12, nan_fraction=0.05):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(samples, trials)).cumsum(axis=0)
+    Y = 0.7 * X + rng.normal(size=(samples, trials)) + 3
+    X[rng.random(X.shape) < nan_fraction] = np.nan
+    Y[rng.random(Y.shape) < nan_fraction] = np.nan
+    return X, Y
+
+
+def test_matches_per_trial_loop():
+    X, Y = _traces(0)
+    # A trial with zero residuals and, which the loop could not handle, one
+    # without any valid sample
+    Y[~np.isnan(Y[:, 5]), 5] = 3
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = _loop_studentized_residuals(X, Y)
+    X[:, 3] = np.nan
+    expected[:, 3] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        result = calculate_studentized_residuals(X, Y)
+    np.testing.assert_allclose(result, expected, rtol=1e-10, atol=1e-12,
+                               equal_nan=True)
+    assert np.isnan(result[:, 3]).all()
+
+
+def test_leading_dimensions_are_independent_regressions():
+    pairs = [_traces(seed) for seed in range(4)]
+    X = np.stack([x for x, _ in pairs]).reshape(2, 2, 200, 12)
+    Y = np.stack([y for _, y in pairs]).reshape(2, 2, 200, 12)
+    result = calculate_studentized_residuals(X, Y)
+    for ind, (x, y) in enumerate(pairs):
+        np.testing.assert_allclose(result.reshape(4, 200, 12)[ind],
+                                   calculate_studentized_residuals(x, y),
+                                   rtol=1e-12, equal_nan=True)
+
+
+def test_none_passes_through():
+    assert calculate_studentized_residuals(None, None) is None
+
+
+def test_matches_statsmodels():
+    sm = pytest.importorskip('statsmodels.api')
+    from statsmodels.stats.outliers_influence import OLSInfluence
+    X, Y = _traces(1, nan_fraction=0)
+    result = calculate_studentized_residuals(X, Y)
+    for i in range(X.shape[1]):
+        fit = sm.OLS(Y[:, i], sm.add_constant(X[:, i])).fit()
+        np.testing.assert_allclose(
+            result[:, i], OLSInfluence(fit).resid_studentized_external,
+            rtol=1e-8)
+
+
+def _loop_regression_func(traces, binsize, channels, regions, channels_ch0_removed):
+    # Per-region, per-channel formulation the tensor pass replaced
+    corrsig_b, corrsig_b_r, corrsig_results, ch0_results = {}, {}, {}, {}
+    for channel in channels:
+        control_b, control_b_r = bin_trials(traces[f'sig_corrsig_{channel}'].T, binsize)
+        for region in regions:
+            target_b, target_b_r = bin_trials(traces[f'sig_{region}_{channel}'].T, binsize)
+            res_b = calculate_studentized_residuals(control_b, target_b)
+            res_b_r = calculate_studentized_residuals(control_b_r, target_b_r)
+            corrsig_results[f'{region}_{channel}'] = debin_me(res_b, res_b_r, binsize)
+            corrsig_b[region, channel] = res_b
+            corrsig_b_r[region, channel] = res_b_r
+    for region in regions:
+        for channel in channels_ch0_removed:
+            res_b = calculate_studentized_residuals(corrsig_b[region, 'ch0'],
+                                                    corrsig_b[region, channel])
+            res_b_r = calculate_studentized_residuals(corrsig_b_r[region, 'ch0'],
+                                                      corrsig_b_r[region, channel])
+            ch0_results[f'{region}_{channel}'] = debin_me(res_b, res_b_r, binsize)
+    return ch0_results, corrsig_results
+
+
+def _run_traces(seed, num_trials, imgptrial=30, regions=('a', 'b', 'c'),
+                channels=('ch0', 'ch1', 'ch2')):
+    rng = np.random.default_rng(seed)
+    traces = {}
+    for region in ('corrsig',) + regions:
+        for channel in channels:
+            trace = rng.normal(size=(num_trials, imgptrial)).cumsum(axis=1)
+            trace[rng.random(trace.shape) < 0.02] = np.nan
+            traces[f'sig_{region}_{channel}'] = trace
+    return traces, list(channels), list(regions), list(channels[1:])
+
+
+@pytest.mark.parametrize('num_trials, binsize', [(20, 5), (23, 5), (3, 5), (7, 1)])
+def test_regression_func_matches_loop(num_trials, binsize):
+    traces, channels, regions, channels_ch0_removed = _run_traces(num_trials, num_trials)
+    expected = _loop_regression_func(traces, binsize, channels, regions,
+                                     channels_ch0_removed)
+    result = regression_func(traces, binsize, channels, regions,
+                             channels_ch0_removed)
+    for expected_dict, result_dict in zip(expected, result):
+        assert list(result_dict) == list(expected_dict)
+        for key, value in expected_dict.items():
+            assert result_dict[key].shape == (30, num_trials)
+            np.testing.assert_allclose(result_dict[key], value, rtol=1e-10,
+                                       atol=1e-12, equal_nan=True)
+
+
+def test_bin_trials_roundtrip_matches_fortran_reshape():
+    signal = np.arange(6 * 13, dtype=float).reshape(6, 13)
+    binned, remainder = bin_trials(signal, 4)
+    np.testing.assert_array_equal(
+        binned, signal[:, :12].reshape((24, 3), order='F'))
+    np.testing.assert_array_equal(
+        remainder, signal[:, 12:].reshape((6, 1), order='F'))
+    np.testing.assert_array_equal(debin_me(binned, remainder, 4), signal)
+    stacked = np.stack([signal, signal + 100])
+    binned_stacked, remainder_stacked = bin_trials(stacked, 4)
+    np.testing.assert_array_equal(binned_stacked[1], binned + 100)
+    np.testing.assert_array_equal(debin_me(binned_stacked, remainder_stacked, 4),
+                                  stacked)
+
+
+def test_regression_main_keeps_every_run():
+    data = MSPData()
+    data.bin_size = 4
+    data.traces_by_run_signal_trial = {
+        'run1': _run_traces(0, 10)[0], 'run2': _run_traces(1, 12)[0]}
+    regression_main(data)
+    assert list(data.corrsig_reg_results) == ['run1', 'run2']
+    assert list(data.regressed_traces_by_run_signal_trial) == ['run1', 'run2']
+    assert data.corrsig_reg_results['run2']['a_ch0'].shape == (30, 12)
+
+
+def test_parallel_regression_matches_serial():
+    traces_by_run = {f'run{ind}': _run_traces(ind, 9 + ind)[0] for ind in range(4)}
+    serial = regress_runs(traces_by_run, 4, max_workers=1)
+    calls = []
+    parallel = regress_runs(traces_by_run, 4, max_workers=2,
+                            progress=lambda *args: calls.append(args))
+    assert list(parallel) == list(traces_by_run)
+    for run_key, (regressed, corrsig) in serial.items():
+        for expected, result in zip((regressed, corrsig), parallel[run_key]):
+            assert list(result) == list(expected)
+            for key, value in expected.items():
+                np.testing.assert_array_equal(result[key], value)
+    assert [done for done, _, _ in calls] == [1, 2, 3, 4]
+    assert sorted(run_key for _, _, run_key in calls) == sorted(traces_by_run)
+    assert all(total == 4 for _, total, _ in calls)
+
+
+def test_parallel_regression_shares_only_runs_in_flight(monkeypatch):
+    traces_by_run = {f'run{ind}': _run_traces(ind, 9)[0] for ind in range(5)}
+    live = []
+    most = []
+
+    def share(traces):
+        block, layout = share_traces(traces)
+        live.append(block.name)
+        most.append(len(live))
+        return block, layout
+
+    def release(block):
+        live.remove(block.name)
+        block.close()
+        block.unlink()
+
+    monkeypatch.setattr(regression, 'share_traces', share)
+    monkeypatch.setattr(regression, '_release_block', release)
+    regress_runs(traces_by_run, 4, max_workers=2)
+    assert max(most) == 2
+    assert live == []
+
+
+def _bin_columns(signal, bin_size):
+    # Columns of the binned signal followed by the remainder column
+    return [column for part in bin_trials(signal, bin_size) if part is not None
+            for column in part.T]
+
+
+def test_bin_size_sweep_matches_direct_fits():
+    traces, channels, regions, _ = _run_traces(5, 23)
+    for key, trace in traces.items():
+        traces[key] = np.nan_to_num(trace) + 1000
+    diagnostics = sweep_bin_sizes({'run1': traces}, [1, 4, 5, 30])
+    assert list(diagnostics) == [1, 4, 5, 30]
+    for bin_size, result in diagnostics.items():
+        fit = result['by_run']['run1']
+        num_bins = -(-23 // bin_size)
+        assert fit['slope'].shape == (len(regions), len(channels), num_bins)
+        assert result['num_bins'] == num_bins
+        for r, region in enumerate(regions):
+            for c, channel in enumerate(channels):
+                xs = _bin_columns(traces[f'sig_corrsig_{channel}'].T, bin_size)
+                ys = _bin_columns(traces[f'sig_{region}_{channel}'].T, bin_size)
+                for col, (x, y) in enumerate(zip(xs, ys)):
+                    slope, intercept = np.polyfit(x, y, 1)
+                    mse = ((y - slope * x - intercept) ** 2).sum() / (len(x) - 2)
+                    np.testing.assert_allclose(fit['slope'][r, c, col], slope, rtol=1e-8)
+                    np.testing.assert_allclose(fit['intercept'][r, c, col], intercept, rtol=1e-8)
+                    np.testing.assert_allclose(fit['mse'][r, c, col], mse, rtol=1e-8)
+    assert np.isnan(diagnostics[30]['slope_cv'])
+    assert diagnostics[1]['min_samples'] == 30
+
+
+@pytest.mark.parametrize('num_trials, binsize', [(20, 5), (23, 5), (3, 5), (7, 1)])
+def test_online_regression_matches_batch(num_trials, binsize):
+    traces = _run_traces(num_trials, num_trials)[0]
+    expected = regress_run(traces, binsize)
+    result = regress_run(traces, binsize, online=True)
+    for expected_dict, result_dict in zip(expected, result):
+        assert list(result_dict) == list(expected_dict)
+        for key, value in expected_dict.items():
+            np.testing.assert_allclose(result_dict[key], value, rtol=1e-8,
+                                       atol=1e-10, equal_nan=True)
+
+
+def _trial_stream(num_trials, imgptrial=200):
+    rng = np.random.default_rng(0)
+    keys = [f'sig_{region}_{channel}' for region in ('corrsig', 'a', 'b')
+            for channel in ('ch0', 'ch1')]
+    for _ in range(num_trials):
+        yield {key: rng.normal(size=imgptrial) for key in keys}
+
+
+def test_online_regression_memory_is_bounded_by_a_bin():
+    def peak(num_trials):
+        tracemalloc.start()
+        try:
+            for _ in regress_trials(_trial_stream(num_trials), 10):
+                pass
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    short, long = peak(50), peak(500)
+    assert long < short * 1.2
+
+
+def _traced_copies(func, array):
+    # Number of copies of array worth of memory allocated by func
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / array.nbytes
+    finally:
+        tracemalloc.stop()
+
+
+def test_bin_views_do_not_copy():
+    signal = np.random.default_rng(0).normal(size=(3, 23, 200)).swapaxes(-1, -2)
+    out = np.empty_like(signal)
+    binned, remainder = bin_views(signal, 5)
+    assert binned.shape == (3, 200, 4, 5) and remainder.shape == (3, 200, 1, 3)
+    assert np.shares_memory(binned, signal) and np.shares_memory(remainder, signal)
+    # Same bins as bin_trials, bin k holds trials 5k to 5k + 4 one after the other
+    expected, expected_remainder = bin_trials(signal, 5)
+    for k in range(4):
+        np.testing.assert_array_equal(binned[..., k, :].swapaxes(-1, -2).reshape(3, -1),
+                                      expected[..., k])
+    np.testing.assert_array_equal(remainder[..., 0, :].swapaxes(-1, -2).reshape(3, -1),
+                                  expected_remainder[..., 0])
+
+    def through_views():
+        for source, target in zip(bin_views(signal, 5), bin_views(out, 5)):
+            np.copyto(target, source)
+
+    def through_copies():
+        debin_me(*bin_trials(signal, 5), 5)
+
+    # Only the small iteration buffer of copyto
+    assert _traced_copies(through_views, signal) < 0.1
+    np.testing.assert_array_equal(out, signal)
+    assert _traced_copies(through_copies, signal) >= 1
+
+
+def test_regression_func_writes_preallocated_outputs():
+    traces, channels, regions, channels_ch0_removed = _run_traces(2, 23)
+    regressed, corrsig = regression_func(traces, 5, channels, regions,
+                                         channels_ch0_removed)
+    for results in (regressed, corrsig):
+        bases = {id(value.base) for value in results.values()}
+        assert len(bases) == 1 and next(iter(results.values())).base is not None
+
+
+@pytest.mark.parametrize('online', [False, True])
+def test_synthetic_cohort_recovers_ground_truth(online):
+    scale = CohortScale(runs=2, regions=3, channels=3, trials=23, samples=60,
+                        bin_size=5)
+    traces_by_run, truth = synthetic_cohort(scale, seed=3)
+    # The raw traces are dominated by laser fluctuations and motion
+    raw = {run: {key[len('sig_'):]: trace.T for key, trace in traces.items()
+                 if not key.startswith('sig_corrsig') and not key.endswith('ch0')}
+           for run, traces in traces_by_run.items()}
+    assert min(recovery_scores(raw, truth).values()) < 0.8
+    result = benchmark(scale, seed=3, online=online)
+    assert result['min_score'] > 0.95
+    assert result['peak_bytes'] > 0 and result['samples_per_second'] > 0
+
+
+def _drop_frames(traces, frames, wiped_trial=None):
+    # Failed frames are NaN in every trace, wiped spans in one trace only
+    dropped = {key: trace.copy() for key, trace in traces.items()}
+    for trace in dropped.values():
+        trace.reshape(-1)[frames] = np.nan
+    if wiped_trial is not None:
+        dropped['sig_a_ch1'][wiped_trial, 5:20] = np.nan
+    return dropped
+
+
+@pytest.mark.parametrize('frames, wiped_trial', [([], None), ([40, 333, 334], None),
+                                                 ([], 21), ([7, 615], 3)])
+def test_regression_func_with_dropped_frames_matches_loop(frames, wiped_trial):
+    rng = np.random.default_rng(4)
+    channels, regions = ['ch0', 'ch1', 'ch2'], ['a', 'b']
+    traces = {f'sig_{region}_{channel}': rng.normal(size=(23, 30)).cumsum(axis=1)
+              for region in ['corrsig'] + regions for channel in channels}
+    traces = _drop_frames(traces, frames, wiped_trial)
+    expected = _loop_regression_func(traces, 5, channels, regions, channels[1:])
+    result = regression_func(traces, 5, channels, regions, channels[1:])
+    for expected_dict, result_dict in zip(expected, result):
+        for key, value in expected_dict.items():
+            np.testing.assert_allclose(result_dict[key], value, rtol=1e-10,
+                                       atol=1e-12, equal_nan=True)
+
+
+def test_nan_positions_match_masks():
+    X, Y = _traces(5, trials=12, nan_fraction=0)
+    Y[[3, 50, 51], [0, 4, 4]] = np.nan
+    X[7, 4] = np.nan
+    trial_validity = column_validity(X) & column_validity(Y)
+    np.testing.assert_array_equal(np.flatnonzero(~trial_validity[0]), [0, 4])
+    positions = (nan_positions(X, trial_validity), nan_positions(Y, trial_validity))
+    np.testing.assert_array_equal(positions[0][0], [7])
+    np.testing.assert_array_equal(positions[1][0], [3, 50, 51])
+    np.testing.assert_array_equal(positions[1][1], [0, 4, 4])
+    masked = calculate_studentized_residuals(X, Y)
+    sparse = calculate_studentized_residuals(X, Y, nan_positions=positions)
+    np.testing.assert_allclose(sparse, masked, rtol=1e-10, equal_nan=True)
+    np.testing.assert_allclose(sparse, _loop_studentized_residuals(X, Y),
+                               rtol=1e-10, equal_nan=True)
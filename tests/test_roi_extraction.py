@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Check that precompiled ROI extraction matches boolean mask indexing
+"""
+import numpy as np
+import pytest
+from PIL import Image
+from MSPhotom.analysis.imageprocess import (RoiExtractor, npy_circlemask,
+                                            fiber_masks_from_coords,
+                                            process_run,
+                                            process_run_multiprocess,
+                                            process_run_threaded)
+
+
+def _masks():
+    coords = [(60, 60, 40), (200, 210, 55), (230, 200, 50), (400, 400, 10)]
+    return [npy_circlemask(424, 424, *xyr) for xyr in coords]
+
+
+def test_extract_matches_mask_mean():
+    rng = np.random.default_rng(0)
+    masks = _masks()
+    extractor = RoiExtractor(masks)
+    for _ in range(5):
+        frame = rng.integers(0, 2**16, size=(424, 424), dtype=np.uint16)
+        expected = [frame[mask].mean() for mask in masks]
+        np.testing.assert_allclose(extractor.extract(frame), expected,
+                                   rtol=1e-12)
+
+
+def test_empty_mask_gives_nan():
+    masks = [np.zeros((10, 10), dtype=bool), np.ones((10, 10), dtype=bool)]
+    means = RoiExtractor(masks).extract(np.full((10, 10), 3, dtype=np.uint16))
+    assert np.isnan(means[0])
+    assert means[1] == 3
+
+
+def _write_frames(tmp_path, num):
+    rng = np.random.default_rng(1)
+    frames = [rng.integers(0, 4000, size=(424, 424), dtype=np.uint16)
+              for _ in range(num)]
+    paths = []
+    for ind, frame in enumerate(frames):
+        path = f'{tmp_path}/img_{ind}.tif'
+        Image.fromarray(frame).save(path)
+        paths.append(path)
+    return frames, paths
+
+
+def test_process_run_matches_mask_mean(tmp_path):
+    masks = _masks()
+    frames, paths = _write_frames(tmp_path, 4)
+    traces_raw, mod_times = process_run(paths, masks)
+    assert len(traces_raw) == len(masks)
+    for trace, mask in zip(traces_raw, masks):
+        np.testing.assert_allclose(trace, [f[mask].mean() for f in frames],
+                                   rtol=1e-12)
+    assert not np.isnan(mod_times).any()
+
+
+def _loop_circlemask(sizex, sizey, circlex, circley, radius):
+    mask = np.empty((sizey, sizex), dtype="bool_")
+    for x in range(sizex):
+        for y in range(sizey):
+            mask[y, x] = ((x-circlex)**2 + (y-circley)**2)**(0.5) <= radius
+    return mask
+
+
+def test_circlemask_matches_loop():
+    for xyr in [(20, 30, 10), (20.5, 31.5, 7.5), (0, 0, 12), (45, 3, 0)]:
+        np.testing.assert_array_equal(npy_circlemask(50, 40, *xyr),
+                                      _loop_circlemask(50, 40, *xyr))
+
+
+def test_fiber_masks_are_cached():
+    coords = [(10, 20, 50, 60), (100, 100, 140, 140)]
+    first = fiber_masks_from_coords(coords, (300, 200))
+    second = fiber_masks_from_coords(coords, (300, 200))
+    assert all(a is b for a, b in zip(first, second))
+    assert first[0].shape == (300, 200)
+    assert not first[0].flags.writeable
+
+
+def test_process_pool_matches_sync(tmp_path):
+    masks = _masks()
+    _, paths = _write_frames(tmp_path, 7)
+    paths.insert(3, f'{tmp_path}/missing.tif')
+    expected, expected_times = process_run(paths, masks)
+    traces_raw, mod_times = process_run_multiprocess(paths, masks,
+                                                     max_workers=2,
+                                                     chunksize=3)
+    np.testing.assert_array_equal(np.array(traces_raw), np.array(expected))
+    np.testing.assert_array_equal(mod_times, expected_times)
+
+
+def test_threaded_pipeline_matches_sync(tmp_path):
+    masks = _masks()
+    _, paths = _write_frames(tmp_path, 9)
+    paths.insert(5, f'{tmp_path}/missing.tif')
+    expected, expected_times = process_run(paths, masks)
+    traces_raw, mod_times = process_run_threaded(paths, masks, max_workers=3,
+                                                 num_extractors=2, prefetch=2)
+    np.testing.assert_array_equal(np.array(traces_raw), np.array(expected))
+    np.testing.assert_array_equal(mod_times, expected_times)
+
+
+def test_extract_batch_matches_extract():
+    rng = np.random.default_rng(2)
+    masks = _masks() + [np.zeros((424, 424), dtype=bool)]
+    extractor = RoiExtractor(masks)
+    frames = rng.integers(0, 2**16, size=(6, 424, 424), dtype=np.uint16)
+    traces = np.zeros((len(masks), 10))
+    means = extractor.extract_batch(frames, out=traces[:, 2:8].T)
+    expected = np.array([extractor.extract(frame) for frame in frames])
+    np.testing.assert_allclose(means, expected, rtol=1e-12)
+    np.testing.assert_allclose(traces[:, 2:8].T, expected, rtol=1e-12)
+    assert np.isnan(means[:, -1]).all()
+    # Smaller batches reuse the scratch space of the larger one
+    np.testing.assert_allclose(extractor.extract_batch(frames[:2]),
+                               expected[:2], rtol=1e-12)
+
+
+def test_sparse_weights_match_dense():
+    pytest.importorskip('scipy')
+    rng = np.random.default_rng(3)
+    frames = rng.integers(0, 2**16, size=(4, 424, 424), dtype=np.uint16)
+    dense = RoiExtractor(_masks()).extract_batch(frames)
+    sparse = RoiExtractor(_masks(), weights='sparse').extract_batch(frames)
+    np.testing.assert_allclose(sparse, dense, rtol=1e-12)
+
+
+def test_batched_process_run_matches_per_frame(tmp_path):
+    masks = _masks()
+    _, paths = _write_frames(tmp_path, 11)
+    paths.insert(4, f'{tmp_path}/missing.tif')
+    expected, expected_times = process_run(paths, masks)
+    traces_raw, mod_times = process_run(paths, masks, batch_size=5)
+    np.testing.assert_allclose(np.array(traces_raw), np.array(expected),
+                               rtol=1e-12)
+    assert np.isnan(np.array(traces_raw)[:, 4]).all()
+    np.testing.assert_array_equal(mod_times, expected_times)
+    traces_raw, _ = process_run_multiprocess(paths, masks, max_workers=2,
+                                             chunksize=4, batch_size=3)
+    np.testing.assert_allclose(np.array(traces_raw), np.array(expected),
+                               rtol=1e-12)
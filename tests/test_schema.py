@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Check the migration of saved MSPData and the loading of selected fields
+"""
+import pickle
+import numpy as np
+import pytest
+from MSPhotom import tracefix
+from MSPhotom.data import MSPData, DataManager, SCHEMA_VERSION, migrate
+from MSPhotom.h5store import open_h5store, save_h5store
+from MSPhotom.sectionfile import load_sections, read_index
+from tests.test_h5store import make_data, assert_same_data
+
+FORMATS = ['.msp', '.pkl', '.h5', '.npmap']
+
+
+def legacy_dict():
+    """
+    Fields as pickled before the schema, bin_size set outside the dataclass.
+    """
+    fields = make_data().__dict__
+    del fields['schema_version']
+    fields['regression_bin_size'] = None
+    return fields
+
+
+def test_legacy_pickle_is_migrated(tmp_path):
+    path = tmp_path / 'legacy.pkl'
+    with open(path, 'wb') as file:
+        pickle.dump(legacy_dict(), file)
+    data = DataManager(None).load(str(path))
+    assert data.schema_version == SCHEMA_VERSION
+    assert data.bin_size == 4
+    assert 'regression_bin_size' not in data.__dict__
+    assert_same_data(data, make_data())
+
+
+def test_migration_keeps_unknown_keys_and_rejects_newer_versions():
+    data = MSPData.from_dict({'regression_bin_size': 3, 'analyst_note': 'x'})
+    assert data.bin_size == 3
+    assert data.analyst_note == 'x'
+    with pytest.raises(ValueError):
+        migrate({'schema_version': SCHEMA_VERSION + 1})
+
+
+@pytest.mark.parametrize('extension', FORMATS)
+def test_round_trip(tmp_path, extension):
+    data = make_data()
+    path = str(tmp_path / f'cohort{extension}')
+    DataManager(data).save(path)
+    assert_same_data(DataManager(None).load(path), data)
+
+
+@pytest.mark.parametrize('extension', FORMATS + ['.h5 export'])
+def test_load_selected_fields(tmp_path, extension):
+    data = make_data()
+    if extension == '.h5 export':
+        path = str(tmp_path / 'export.h5')
+        DataManager(data).saveto_h5(path)
+    else:
+        path = str(tmp_path / f'cohort{extension}')
+        DataManager(data).save(path)
+    loaded = DataManager(None).load(path, fields=['traces_raw_by_run_reg', 'bin_size'])
+    assert list(loaded.traces_raw_by_run_reg) == data.run_path_list
+    for run, traces in data.traces_raw_by_run_reg.items():
+        np.testing.assert_array_equal(loaded.traces_raw_by_run_reg[run], traces)
+    assert loaded.bin_size == 4
+    assert loaded.traces_by_run_signal_trial is None
+    assert loaded.run_path_list is None
+    with pytest.raises(ValueError):
+        DataManager(None).load(path, fields=['traces_raw'])
+
+
+def test_sections_are_read_independently(tmp_path):
+    data = make_data()
+    path = tmp_path / 'cohort.msp'
+    DataManager(data).save(str(path))
+    # Overwrite the split traces, loading other fields never reads them
+    offset, length = read_index(path)['sections']['traces_by_run_signal_trial']
+    with open(path, 'r+b') as file:
+        file.seek(offset)
+        file.write(bytes(length))
+    fields = tracefix.load(str(path), tracefix.EVALUATE_FIELDS)
+    assert list(fields) == list(tracefix.EVALUATE_FIELDS)
+    assert list(fields['traces_raw_by_run_reg']) == data.run_path_list
+    with pytest.raises(pickle.UnpicklingError):
+        load_sections(path, ['traces_by_run_signal_trial'])
+
+
+def test_lazily_opened_store_is_saved_entry_by_entry(tmp_path):
+    data = make_data()
+    save_h5store(data, tmp_path / 'cohort.h5')
+    lazy = open_h5store(tmp_path / 'cohort.h5')
+    path = tmp_path / 'cohort.msp'
+    DataManager(lazy).save(str(path))
+    # Saving reads the entries of the store without keeping them
+    assert not any(lazy.traces_raw_by_run_reg.is_loaded(run) for run in data.run_path_list)
+    assert not lazy.fiber_masks.is_loaded('A')
+    entries = read_index(path)['entries']['traces_raw_by_run_reg']
+    assert [key for key, _, _ in entries] == data.run_path_list
+    assert_same_data(DataManager(None).load(str(path)), data)
+    loaded = DataManager(None).load(str(path), fields=['fiber_masks'])
+    assert list(loaded.fiber_masks) == list(data.fiber_masks)
+    assert loaded.traces_raw_by_run_reg is None
+    pickle.dumps(lazy)
+    assert not lazy.fiber_masks.is_loaded('A')
+
+
+def test_older_container_is_migrated_in_full(tmp_path):
+    # A version 1 field renamed by the migration
+    fields = {**legacy_dict(), 'schema_version': 1, 'regression_bin_size': 4}
+    del fields['bin_size']
+    data = MSPData()
+    data.__dict__ = fields
+    path = tmp_path / 'legacy.msp'
+    DataManager(data).save(str(path))
+    loaded = DataManager(None).load(str(path), fields=['bin_size'])
+    assert loaded.bin_size == 4
+    assert loaded.schema_version == SCHEMA_VERSION
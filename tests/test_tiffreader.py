@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Check the fast TIFF frame reader against PIL
+"""
+import struct
+import numpy as np
+from PIL import Image
+from MSPhotom.analysis.imageprocess import TiffFrameReader, loadimg, process_run
+
+
+def _frame(seed, shape=(40, 48), dtype=np.uint16):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 60000, size=shape).astype(dtype)
+
+
+def test_fast_path_reads_into_buffer(tmp_path):
+    paths = []
+    for ind in range(3):
+        paths.append(f'{tmp_path}/img_{ind}.tif')
+        Image.fromarray(_frame(ind)).save(paths[-1])
+    reader = TiffFrameReader(paths[0])
+    assert reader.shape == (40, 48)
+    buffer = np.empty(reader.shape, dtype=reader.dtype)
+    for ind, path in enumerate(paths):
+        frame = reader.read(path, out=buffer)
+        assert frame is buffer
+        np.testing.assert_array_equal(frame, loadimg(path))
+
+
+def test_big_endian(tmp_path):
+    path = f'{tmp_path}/img_0.tif'
+    Image.fromarray(_frame(0, dtype='>u2')).save(path)
+    reader = TiffFrameReader(path)
+    assert reader.layout is not None
+    np.testing.assert_array_equal(reader.read(path), _frame(0))
+
+
+def test_fallback_to_pil(tmp_path):
+    template = f'{tmp_path}/img_0.tif'
+    Image.fromarray(_frame(0)).save(template)
+    other_shape = f'{tmp_path}/img_1.tif'
+    Image.fromarray(_frame(1, shape=(20, 24))).save(other_shape)
+    compressed = f'{tmp_path}/img_2.tif'
+    Image.fromarray(_frame(2)).save(compressed, compression='tiff_lzw')
+
+    reader = TiffFrameReader(template)
+    np.testing.assert_array_equal(reader.read(other_shape), _frame(1, shape=(20, 24)))
+    buffer = np.empty((40, 48), dtype=np.uint16)
+    assert reader.read(compressed, out=buffer) is buffer
+    np.testing.assert_array_equal(buffer, _frame(2))
+
+    compressed_reader = TiffFrameReader(compressed)
+    assert compressed_reader.layout is None
+    np.testing.assert_array_equal(compressed_reader.read(template), _frame(0))
+
+
+def _write_tiled(path, frame, tile=16):
+    """
+    Uncompressed single tile 8 bit TIFF, without strip tags.
+    """
+    height, width = frame.shape
+    tiles = np.zeros((tile, tile), np.uint8)
+    tiles[:height, :width] = frame
+    entries = [(256, 3, width), (257, 3, height), (258, 3, 8), (259, 3, 1),
+               (262, 3, 1), (277, 3, 1), (322, 3, tile), (323, 3, tile),
+               (324, 4, 8 + 2 + 12 * 10 + 4), (325, 4, tiles.nbytes)]
+    ifd = struct.pack('<H', len(entries))
+    for tag, typ, value in entries:
+        ifd += struct.pack('<HHI', tag, typ, 1)
+        ifd += struct.pack('<HH' if typ == 3 else '<I',
+                           *((value, 0) if typ == 3 else (value,)))
+    with open(path, 'wb') as file:
+        file.write(b'II*\x00' + struct.pack('<I', 8) + ifd + struct.pack('<I', 0))
+        file.write(tiles.tobytes())
+
+
+def test_tiled_files_fall_back_to_pil(tmp_path):
+    path = f'{tmp_path}/img_0.tif'
+    frame = _frame(0, shape=(12, 10), dtype=np.uint8)
+    _write_tiled(path, frame)
+    np.testing.assert_array_equal(loadimg(path), frame)
+    reader = TiffFrameReader(path)
+    assert reader.layout is None
+    np.testing.assert_array_equal(reader.read(path), frame)
+    mask = np.zeros(frame.shape, bool)
+    mask[2:5, 3:7] = True
+    traces, _ = process_run([path, path], [mask])
+    np.testing.assert_allclose(traces[0], frame[mask].mean())
@@ -8,7 +8,7 @@ import sys
 sys.path.append('K:/Rutabaga/MSPhotom')
 
 import glob
-from MSPhotom.analysis.imageprocess import process_run, process_run_async_wrapper, get_valid_images, npy_circlemask
+from MSPhotom.analysis.imageprocess import process_run, process_run_threaded, get_valid_images, fiber_masks_from_coords, get_frame_shape
 import time
 import MSPhotom
 import pickle
@@ -20,14 +20,10 @@ def main():
         data = pickle.load(file)
     validimg = get_valid_images(r'K:\Kiwi\Last_Fucking_Experiment\09-22-24\LFE 16 Run 1','lfe0')
     
-    fiber_coords_xyr = [(sum(coord[0:3:2])/2, # X coordinate
-                            sum(coord[1:4:2])/2, # Y coordinate
-                            (coord[2] - coord[0])/2) # Radius of circle
-                           for coord in data.fiber_coords]
-    fiber_masks = [npy_circlemask(424,424,*coords) 
-                   for coords in fiber_coords_xyr]
+    fiber_masks = fiber_masks_from_coords(data.fiber_coords,
+                                          get_frame_shape(validimg[0]))
     
-    global results, results_async
+    global results, results_threaded
     starttime = time.perf_counter()
     results = process_run(validimg,fiber_masks)
     endtime = time.perf_counter()
@@ -35,7 +31,7 @@ def main():
     
     
     starttime = time.perf_counter()
-    results_async = process_run_async_wrapper(validimg,fiber_masks)
+    results_threaded = process_run_threaded(validimg,fiber_masks)
     endtime = time.perf_counter()
     print(f"Execution time: {endtime - starttime:.8f} seconds")
     